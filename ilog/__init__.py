@@ -18,3 +18,5 @@ __description__  = __doc__
 __core_bin_name__  = 'ilog-core'
 __bot_bin_name__   = 'ilog-bot'
 __web_bin_name__   = 'ilog-web'
+__broker_bin_name__ = 'ilog-broker'
+__render_bin_name__ = 'ilog-render'
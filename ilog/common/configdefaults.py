@@ -17,7 +17,38 @@ SQLALCHEMY_NATIVE_UNICODE = False
 SQLALCHEMY_POOL_SIZE = 5
 SQLALCHEMY_POOL_TIMEOUT = 10
 SQLALCHEMY_POOL_RECYCLE = 3600
+SQLALCHEMY_GROUP_COMMIT = False         # Merge concurrent commits, not on SQLite
+SQLALCHEMY_GROUP_COMMIT_WINDOW = 0.002  # Seconds a group waits for commits
 
 BOT_NICK = None
 BOT_PASSWORD = None
 BOT_EMAIL = None
+
+# IRC Events Writer Settings
+IRC_EVENTS_FLUSH_SIZE = 1000    # Number of buffered events to trigger a write
+IRC_EVENTS_FLUSH_INTERVAL = 1   # Maximum seconds an event waits to be written
+
+# IRC Events Transport Settings
+# Endpoints the bots push IRC events to. Bound by the logging core, or by the
+# broker when IRC_EVENTS_BROKERED is enabled.
+IRC_EVENTS_ENDPOINTS = ['ipc:///tmp/ilog-irc-events']
+IRC_EVENTS_HWM = 100000         # Events a bot queues while no core is reachable
+IRC_EVENTS_BROKERED = False     # Connect the logging core to a broker
+IRC_BROKER_ENDPOINTS = ['ipc:///tmp/ilog-irc-events-broker']
+
+# IRC Channels Scheduler Settings
+IRC_SCHEDULER_ENABLED = False   # Spread the channels across the running bots
+IRC_SCHEDULER_HEARTBEATS_ENDPOINT = 'ipc:///tmp/ilog-irc-heartbeats'
+IRC_SCHEDULER_ASSIGNMENTS_ENDPOINT = 'ipc:///tmp/ilog-irc-assignments'
+IRC_SCHEDULER_INTERVAL = 5      # Seconds between heartbeats
+IRC_SCHEDULER_TIMEOUT = 15      # Seconds without heartbeats to consider a bot dead
+
+# IRC Events Storage Settings
+# None to store all events on the irc_events table, "month" for a table per
+# month or "channel-month" for a table per channel and month.
+IRC_EVENTS_PARTITIONING = None
+IRC_EVENTS_RETENTION_DAYS = None    # Drop older partitions. None keeps all
+
+# Events, channels and networks totals
+COUNTERS_FLUSH_INTERVAL = 5     # Seconds between each write of the changes
+COUNTERS_CACHE_TIMEOUT = 10     # Seconds the read totals are kept in memory
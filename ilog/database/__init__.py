@@ -23,7 +23,6 @@ import migrate
 import sqlalchemy
 import sqlalchemy.orm
 from os import path
-from functools import partial
 from giblets import implements, implemented_by, Component, ExtensionPoint
 from math import ceil
 from migrate.versioning.api import upgrade
@@ -44,7 +43,7 @@ from ilog.database import upgrades
 from ilog.common import component_manager
 from ilog.common.interfaces import ComponentBase
 from ilog.common.signals import running
-from .green import GreenQueuePool
+from .green import GreenQueuePool, GroupCommitter
 from .interfaces import IDatabaseManager, IDatabaseUpgradeParticipant
 from .signals import (database_upgraded, database_setup, models_committed,
                       before_models_committed, database_engine_created)
@@ -122,9 +121,13 @@ class _SignallingSession(Session):
                          extension=[_SignallingSessionExtension()],
                          bind=dbm.database_engine, **options)
         self._model_changes = {}
+        self._committer = dbm.committer
 
     def commit(self):
-        gevent.spawn(Session.commit, self).join()
+        if self._committer is not None:
+            self._committer.commit(self)
+        else:
+            Session.commit(self)
 
 
 class _ModelTableNameDescriptor(object):
@@ -258,6 +261,60 @@ class Pagination(object):
                 last = num
 
 
+class KeysetPagination(object):
+    """Internal helper class returned by :meth:`BaseQuery.paginate_after`.
+    Unlike :class:`Pagination`, which skips the previous pages with
+    ``OFFSET`` and gets slower the deeper one pages, each page is fetched by
+    seeking past the last item of the previous page on the `keys` columns,
+    which should be covered by an index.
+    """
+
+    def __init__(self, query, keys, cursor, per_page, items, has_next):
+        #: the unlimited query object that was used to create this
+        #: pagination object.
+        self.query = query
+        #: the columns the items are ordered by
+        self.keys = keys
+        #: the values of `keys` the items come after, `None` for the first page
+        self.cursor = cursor
+        #: the number of items to be displayed on a page.
+        self.per_page = per_page
+        #: the items for the current page
+        self.items = items
+        #: True if a next page exists.
+        self.has_next = has_next
+
+    @property
+    def next_cursor(self):
+        """The cursor of the next page, ie, the values of `keys` on the last
+        item of this page."""
+        if not self.items:
+            return self.cursor
+        last = self.items[-1]
+        return tuple(getattr(last, key.key) for key in self.keys)
+
+    def next(self, error_out=False):
+        """Returns a :class:`KeysetPagination` object for the next page."""
+        assert self.query is not None, 'a query object is required ' \
+                                       'for this method to work'
+        return self.query.paginate_after(self.next_cursor, self.per_page,
+                                         self.keys, error_out)
+
+
+def keyset_criteria(keys, cursor):
+    """Returns the criteria of the rows coming after `cursor`, a tuple with a
+    value for each of the `keys` columns, ordered by them."""
+    # (k0 > c0) OR (k0 = c0 AND k1 > c1) OR ..., with the leading range on
+    # the first key so that the index is used
+    criteria = []
+    for idx, key in enumerate(keys):
+        criteria.append(sqlalchemy.and_(*(
+            [keys[n] == cursor[n] for n in xrange(idx)] +
+            [key > cursor[idx]]
+        )))
+    return sqlalchemy.and_(keys[0] >= cursor[0], sqlalchemy.or_(*criteria))
+
+
 class BaseQuery(orm.Query):
 
     def paginate(self, page, per_page=20, error_out=True):
@@ -275,6 +332,36 @@ class BaseQuery(orm.Query):
             abort(404)
         return Pagination(self, page, per_page, self.count(), items)
 
+    def paginate_after(self, cursor=None, per_page=20, keys=None,
+                       error_out=True):
+        """Returns `per_page` items ordered by the `keys` columns, which
+        default to the primary key, coming after `cursor`, a tuple with a
+        value for each of the `keys`. Pass `None` as the cursor to get the
+        first page. By default it will abort with 404 if the cursor is
+        invalid or if no items were found after it.  This behavor can be
+        disabled by setting `error_out` to `False`.
+
+        Returns a :class:`KeysetPagination` object.
+        """
+        from flask import abort
+        if keys is None:
+            keys = self._mapper_zero().primary_key
+        keys = tuple(keys)
+
+        query = self
+        if cursor is not None:
+            if len(cursor) != len(keys):
+                if error_out:
+                    abort(404)
+                raise ValueError("The cursor needs a value for each key")
+            query = query.filter(keyset_criteria(keys, cursor))
+
+        items = query.order_by(*keys).limit(per_page + 1).all()
+        if not items and cursor is not None and error_out:
+            abort(404)
+        return KeysetPagination(self, keys, cursor, per_page,
+                                items[:per_page], len(items) > per_page)
+
 
 
 class Model(object):
@@ -339,6 +426,12 @@ class DatabaseManager(ComponentBase):
     pool_size = 5
     pool_timeout = 10
     pool_recycle = 3600
+    group_commit = False
+    group_commit_window = 0.002
+    committer = None
+    session = None
+    #: seconds between each log of the live sessions gauge, 0 to disable
+    sessions_log_interval = 300
 
     def set_database_uri(self, uri):
         """Set the database uri"""
@@ -497,18 +590,61 @@ class DatabaseManager(ComponentBase):
         self.database_engine = engine
         self.metadata.bind = engine
 
+        self.committer = None
+        if self.group_commit:
+            if engine.name == 'sqlite':
+                log.warn("Group commit disabled. SQLite savepoints are not "
+                         "usable through pysqlite.")
+            else:
+                self.committer = GroupCommitter(engine,
+                                                self.group_commit_window)
+
         def greenlet_scope():
             return id(gevent.getcurrent())
 
-        self.session = orm.scoped_session(
-            partial(_SignallingSession, self, autoflush=False, autocommit=False),
-            scopefunc=greenlet_scope
-        )
+        self._linked_greenlets = set()
+        self.session = orm.scoped_session(self._create_session,
+                                          scopefunc=greenlet_scope)
 
         gevent.spawn(self.upgrade_database)
+        if self.sessions_log_interval:
+            gevent.spawn(self.log_sessions_periodically)
 
     def on_database_upgraded(self, emitter):
         database_setup.send(self)
 
+    def _create_session(self):
+        current = gevent.getcurrent()
+        key = id(current)
+        if isinstance(current, gevent.Greenlet) and \
+                                        key not in self._linked_greenlets:
+            # Release the greenlet's session once it ends, otherwise the
+            # scoped sessions registry grows without bounds and a greenlet
+            # later reusing the same id would inherit a stale session
+            self._linked_greenlets.add(key)
+            current.link(lambda greenlet: self._release_session(key))
+        return _SignallingSession(self, autoflush=False, autocommit=False)
+
+    def _release_session(self, key):
+        self._linked_greenlets.discard(key)
+        # Called from the hub, drop the session right away, before its
+        # greenlet id can be reused, but close it, which might do I/O, in a
+        # greenlet of its own
+        session = self.session.registry.registry.pop(key, None)
+        if session is not None:
+            gevent.spawn(session.close)
+
+    @property
+    def live_sessions(self):
+        """Number of sessions currently held by greenlets"""
+        if self.session is None:
+            return 0
+        return len(self.session.registry.registry)
+
+    def log_sessions_periodically(self):
+        while True:
+            gevent.sleep(self.sessions_log_interval)
+            log.info("Live database sessions: %d", self.live_sessions)
+
 
 dbm = DatabaseManager(component_manager)
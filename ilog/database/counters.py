@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.counters
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Incrementally maintained totals of the logged IRC events, channels and
+    networks.
+
+    Counting the rows of the ``irc_events`` table gets slower as it grows.
+    Instead, the totals are kept on the ``counters`` table. Each process
+    accumulates its changes to them, the IRC events written by the logging
+    core and the channels and networks added or removed, and adds them to the
+    stored totals in a single batch every :attr:`Counters.flush_interval`
+    seconds.
+
+    Reading the totals is a single query, which result is kept in memory for
+    :attr:`Counters.cache_timeout` seconds.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+import logging
+import gevent
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.common.signals import shutdown
+from ilog.database import dbm
+from ilog.database.signals import database_setup, models_committed
+
+log = logging.getLogger(__name__)
+
+#: the maintained counters
+NAMES = ('irc_events', 'channels', 'networks')
+
+
+class Counters(ComponentBase):
+
+    #: seconds between each write of the accumulated changes
+    flush_interval = 5
+    #: seconds the read totals are kept in memory
+    cache_timeout = 10
+
+    # ComponentBase methods
+    def activate(self):
+        #: counter name -> change not yet written
+        self.deltas = {}
+        self.values = None
+        self.expires = 0
+        self.timer = None
+        self.stopping = False
+
+    def connect_signals(self):
+        from ilog.irc.signals import irc_events_flushed
+        database_setup.connect(self.on_database_setup)
+        models_committed.connect(self.on_models_committed)
+        irc_events_flushed.connect(self.on_irc_events_flushed)
+        shutdown.connect(self.on_shutdown)
+
+    def on_database_setup(self, emitter):
+        if self.timer is None:
+            self.timer = gevent.spawn(self.flush_periodically)
+
+    def on_models_committed(self, emitter, changes=()):
+        from ilog.database.models import IRCEvent, Channel, Network
+        for model, operation in changes:
+            if operation not in ('insert', 'delete'):
+                continue
+            if isinstance(model, IRCEvent):
+                name = 'irc_events'
+            elif isinstance(model, Channel):
+                name = 'channels'
+            elif isinstance(model, Network):
+                name = 'networks'
+            else:
+                continue
+            self.add(name, operation == 'insert' and 1 or -1)
+
+    def on_irc_events_flushed(self, emitter, events=()):
+        self.add('irc_events', len(events))
+        if self.stopping:
+            # Events written by the writer while shutting down
+            self.flush()
+
+    def on_shutdown(self, emitter):
+        self.stopping = True
+        if self.timer is not None:
+            self.timer.kill()
+            self.timer = None
+        self.flush()
+
+    # Counters methods
+    def add(self, name, delta):
+        """Add `delta` to the counter `name`."""
+        if delta:
+            self.deltas[name] = self.deltas.get(name, 0) + delta
+
+    def flush_periodically(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        if not self.deltas or dbm.database_engine is None:
+            return
+        deltas, self.deltas = self.deltas, {}
+
+        from ilog.database.models import Counter
+        counters = Counter.__table__
+        try:
+            dbm.database_engine.execute(
+                counters.update().where(
+                    counters.c.name==dbm.bindparam('counter')
+                ).values(value=counters.c.value + dbm.bindparam('delta')),
+                [{'counter': name, 'delta': delta}
+                 for name, delta in deltas.iteritems()]
+            )
+        except Exception, err:
+            log.exception(err)
+            # Retry on the next flush
+            for name, delta in deltas.iteritems():
+                self.add(name, delta)
+            return
+        # Our own changes are now stored, don't count them twice
+        self.expires = 0
+        log.trace("Updated counters: %s", deltas)
+
+    def get_all(self):
+        """Returns a dictionary of the counters' totals, including the changes
+        made by this process which weren't written yet."""
+        if self.values is None or self.expires < time.time():
+            from ilog.database.models import Counter
+            counters = Counter.__table__
+            values = dict.fromkeys(NAMES, 0)
+            values.update(dbm.database_engine.execute(
+                dbm.select([counters.c.name, counters.c.value])
+            ).fetchall())
+            self.values = values
+            self.expires = time.time() + self.cache_timeout
+
+        values = self.values.copy()
+        for name, delta in self.deltas.iteritems():
+            values[name] = values.get(name, 0) + delta
+        return values
+
+    def get(self, name):
+        return self.get_all().get(name, 0)
+
+counters = Counters(component_manager)
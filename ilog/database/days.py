@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.days
+    ~~~~~~~~~~~~~~~~~~
+
+    Index of the IRC events logged on each channel, per day.
+
+    For each channel and day, the ``irc_event_days`` table holds the first
+    and last ids of the events logged, the table, or partition, they're on
+    and how many there are. Reading a day's events is then a range scan on
+    the events' primary key and the days a channel was logged are listed
+    without touching the events at all.
+
+    The index is updated by the logging core each time a batch of IRC events
+    is written, from the events with an id above the highest one already
+    indexed on their table. Events written before the index existed, or
+    while the core wasn't running, are indexed the same way, in batches of
+    :attr:`DayIndex.batch_size` events.
+
+    With several writers, an event can be committed after others with higher
+    ids were indexed. The last :attr:`DayIndex.rescan_window` ids below the
+    highest indexed one are read again each time, for those not yet indexed
+    by this process. Every writer indexes every event, so the entries of the
+    days events were read for are counted again from the events table, not
+    added to.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import gevent
+import sqlalchemy
+from datetime import datetime, timedelta
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.database import dbm
+from ilog.database.partitions import partitions
+
+log = logging.getLogger(__name__)
+
+
+class DayIndex(ComponentBase):
+
+    #: number of events read at a time while indexing
+    batch_size = 10000
+    #: number of ids below the highest indexed one read again, for the events
+    #: committed after others with higher ids
+    rescan_window = 1000
+
+    # ComponentBase methods
+    def activate(self):
+        #: table name -> highest indexed event id
+        self.watermarks = {}
+        #: table name -> highest event id indexed by other processes, which
+        #: isn't read again
+        self.floors = {}
+        #: table name -> ids within the rescan window indexed by this process
+        self.seen = {}
+        #: table name -> table waiting to be indexed
+        self.dirty = {}
+        self.indexer = None
+
+    def connect_signals(self):
+        from ilog.irc.signals import irc_events_flushed
+        irc_events_flushed.connect(self.on_irc_events_flushed)
+
+    def on_irc_events_flushed(self, emitter, events=()):
+        if not self.watermarks:
+            # First events written by this process, catch up on every table
+            self.schedule(*self.get_tables())
+        elif partitions.enabled:
+            self.schedule(*[
+                partitions.get_table(name) for name in set(
+                    partitions.partition_name(event['channel_id'],
+                                              event['stamp'])
+                    for event in events
+                )
+            ])
+        else:
+            self.schedule(self.get_table('irc_events'))
+
+    # DayIndex methods
+    def get_table(self, name):
+        """Returns the events table, or partition, `name`."""
+        if name == 'irc_events':
+            from ilog.database.models import IRCEvent
+            return IRCEvent.__table__
+        return partitions.define_table(name)
+
+    def get_tables(self):
+        return [self.get_table('irc_events')] + [
+            partitions.tables[name] for name in sorted(partitions.tables)
+        ]
+
+    def schedule(self, *tables):
+        def reset_indexer(gt):
+            self.indexer = None
+            if self.dirty:
+                # Scheduled while the indexer was finishing
+                self.schedule()
+
+        for table in tables:
+            self.dirty[table.name] = table
+        if self.indexer is None and self.dirty:
+            self.indexer = gevent.spawn(self.index_dirty)
+            self.indexer.link(reset_indexer)
+
+    def index_dirty(self):
+        while self.dirty:
+            name, table = self.dirty.popitem()
+            try:
+                self.index_table(table)
+            except Exception, err:
+                # It's retried the next time events are written to it
+                log.exception(err)
+
+    def index_table(self, table):
+        """Index the events of `table` which aren't yet."""
+        from ilog.database.models import IRCEventDay
+        days = IRCEventDay.__table__
+        last_id = self.watermarks.get(table.name)
+        if last_id is None:
+            last_id = self.floors[table.name] = dbm.database_engine.execute(
+                dbm.select([dbm.func.max(days.c.last_id)],
+                           days.c.table_name==table.name)
+            ).scalar() or 0
+        seen = self.seen.setdefault(table.name, set())
+        after = max(last_id - self.rescan_window, self.floors[table.name])
+
+        select = dbm.select([table.c.id, table.c.channel_id, table.c.stamp])
+        while True:
+            rows = dbm.database_engine.execute(
+                select.where(table.c.id>after).order_by(table.c.id)
+                      .limit(self.batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            days_logged = set()
+            for row in rows:
+                if row.id in seen:
+                    continue
+                seen.add(row.id)
+                if row.channel_id is None or row.stamp is None:
+                    continue
+                days_logged.add((row.channel_id, row.stamp.date()))
+            self.store(table, days_logged)
+            after = rows[-1].id
+            last_id = self.watermarks[table.name] = max(last_id, after)
+            # Nothing below the window is read again
+            seen.difference_update([
+                row_id for row_id in seen
+                if row_id <= last_id - self.rescan_window
+            ])
+            log.trace("Indexed %s days of %s up to id %s", len(days_logged),
+                      table.name, last_id)
+            if len(rows) < self.batch_size:
+                break
+            # Allow other things to run
+            gevent.sleep(0)
+        self.watermarks[table.name] = last_id
+
+    def store(self, table, days_logged):
+        """Index the events of `table` logged on `days_logged`, ``(channel id,
+        day)`` pairs, counting them all again."""
+        from ilog.database.models import IRCEventDay
+        days = IRCEventDay.__table__
+        if not days_logged:
+            return
+        entries = []
+        for channel_id, day in days_logged:
+            since = datetime(day.year, day.month, day.day)
+            first_id, last_id, count = dbm.database_engine.execute(
+                dbm.select([dbm.func.min(table.c.id), dbm.func.max(table.c.id),
+                            dbm.func.count(table.c.id)], dbm.and_(
+                    table.c.channel_id==channel_id,
+                    table.c.stamp>=since,
+                    table.c.stamp<since + timedelta(days=1)
+                ))
+            ).first()
+            if count:
+                entries.append({'channel_id': channel_id, 'day': day,
+                                'table_name': table.name,
+                                'first_id': first_id, 'last_id': last_id,
+                                'count': count})
+        if not entries:
+            return
+
+        for attempt in (1, 2):
+            connection = dbm.database_engine.connect()
+            transaction = connection.begin()
+            try:
+                existing = set(
+                    (row.channel_id, row.day) for row in connection.execute(
+                        dbm.select([days.c.channel_id, days.c.day], dbm.and_(
+                            days.c.channel_id.in_(
+                                set(entry['channel_id'] for entry in entries)
+                            ),
+                            days.c.day.in_(
+                                set(entry['day'] for entry in entries)
+                            )
+                        ))
+                    )
+                )
+                inserts = [entry for entry in entries
+                           if (entry['channel_id'], entry['day'])
+                                                            not in existing]
+                updates = [dict(('b_%s' % name, value) for name, value in
+                                entry.iteritems())
+                           for entry in entries
+                           if (entry['channel_id'], entry['day']) in existing]
+                if inserts:
+                    connection.execute(days.insert(), inserts)
+                if updates:
+                    connection.execute(
+                        days.update().where(dbm.and_(
+                            days.c.channel_id==dbm.bindparam('b_channel_id'),
+                            days.c.day==dbm.bindparam('b_day')
+                        )).values(
+                            first_id=dbm.bindparam('b_first_id'),
+                            last_id=dbm.bindparam('b_last_id'),
+                            count=dbm.bindparam('b_count')
+                        ),
+                        updates
+                    )
+                transaction.commit()
+                return
+            except sqlalchemy.exc.IntegrityError:
+                transaction.rollback()
+                if attempt == 2:
+                    raise
+                # Another writer indexed the same day first, update it
+                log.debug("Days of %s indexed concurrently, retrying",
+                          table.name)
+            except:
+                transaction.rollback()
+                raise
+            finally:
+                connection.close()
+
+    def get_days(self, channel_id):
+        """Returns the index entries of `channel_id`, most recent first."""
+        from ilog.database.models import IRCEventDay
+        return IRCEventDay.query.filter(
+            IRCEventDay.channel_id==channel_id
+        ).order_by(IRCEventDay.day.desc()).all()
+
+    def get_summary(self, channel_id):
+        """Returns how many days were logged on `channel_id`, how many events
+        and the highest event id."""
+        from ilog.database.models import IRCEventDay
+        return dbm.session.query(
+            dbm.func.count(IRCEventDay.day), dbm.func.sum(IRCEventDay.count),
+            dbm.func.max(IRCEventDay.last_id)
+        ).filter(IRCEventDay.channel_id==channel_id).one()
+
+    def get_day(self, channel_id, day):
+        """Returns the index entry of `channel_id` on `day`, if any."""
+        from ilog.database.models import IRCEventDay
+        return IRCEventDay.query.get((channel_id, day))
+
+    def get_neighbours(self, channel_id, day):
+        """Returns the days before and after `day` with events logged on
+        `channel_id`, `None` where there are none."""
+        from ilog.database.models import IRCEventDay
+        query = dbm.session.query(IRCEventDay.day).filter(
+            IRCEventDay.channel_id==channel_id
+        )
+        previous = query.filter(IRCEventDay.day<day) \
+                        .order_by(IRCEventDay.day.desc()).first()
+        following = query.filter(IRCEventDay.day>day) \
+                         .order_by(IRCEventDay.day).first()
+        return previous and previous[0], following and following[0]
+
+    def get_events(self, entry):
+        """Returns the events of the index `entry`, in the order logged."""
+        table = self.get_table(entry.table_name)
+        since = datetime(entry.day.year, entry.day.month, entry.day.day)
+        return dbm.database_engine.execute(
+            table.select(dbm.and_(
+                table.c.id.between(entry.first_id, entry.last_id),
+                table.c.channel_id==entry.channel_id,
+                # Events arriving late might have been written between
+                # those of another day
+                table.c.stamp>=since,
+                table.c.stamp<since + timedelta(days=1)
+            )).order_by(table.c.id)
+        ).fetchall()
+
+day_index = DayIndex(component_manager)
@@ -8,28 +8,376 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import time
 import gevent
+from collections import deque
+from gevent.event import AsyncResult
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm.session import Session
 from sqlalchemy.pool import QueuePool
+from sqlalchemy.queue import Empty, Full
 
-class PoolTimeout(Exception):
+class PoolTimeout(TimeoutError):
     """Exception raised when getting a connection from the pool takes too long.
     """
 
 class GreenQueuePool(QueuePool):
-    """Simple subclass of the standard SA QueuePool.
-    Uses a sleep when the pool is empty to green thread switch.
+    """Subclass of the standard SA QueuePool which blocks the requesting
+    greenlet, instead of spinning, while all connections are checked out.
+
+    Waiting greenlets are queued and handed the returned connections in the
+    order they asked for them. Each waits at most ``timeout`` seconds before
+    :class:`PoolTimeout` is raised.
     """
 
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30,
+                 **kwargs):
+        QueuePool.__init__(self, creator, pool_size=pool_size,
+                           max_overflow=max_overflow, timeout=timeout,
+                           **kwargs)
+        self._waiters = deque()
+        #: number of connections handed out
+        self.checkouts = 0
+        #: number of checkouts which had to wait for a connection
+        self.waits = 0
+        #: total and maximum seconds spent waiting for a connection
+        self.wait_time = self.max_wait_time = 0
+        #: number of connections created above ``pool_size``
+        self.overflows = 0
+        #: number of checkouts which gave up waiting
+        self.timeouts = 0
 
     def do_get(self):
-        # while the queue pool is filled, switch to another greenthread until
-        # one is available.
-        timeout = gevent.Timeout(self._timeout, PoolTimeout)
+        started = time.time()
+        waited = False
+        while True:
+            if not self._waiters:
+                # Nobody queued before us, an idle connection or a new one
+                # if the pool still has room for it
+                try:
+                    connection = self._pool.get(False)
+                    break
+                except Empty:
+                    pass
+                if self._max_overflow < 0 or \
+                                    self._overflow < self._max_overflow:
+                    connection = self._create_overflow()
+                    break
+
+            waited = True
+            connection = self._wait(started)
+            if connection is not None:
+                break
+            # A connection creation failed, there's room for a new one
+
+        self.checkouts += 1
+        if waited:
+            elapsed = time.time() - started
+            self.waits += 1
+            self.wait_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, elapsed)
+        return connection
+
+    def do_return_conn(self, connection):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.ready():
+                # Hand it directly to the longest waiting greenlet
+                waiter.set(connection)
+                return
+        try:
+            self._pool.put(connection, False)
+        except Full:
+            connection.close()
+            self._overflow -= 1
+
+    def _create_overflow(self):
+        # Reserve the slot before creating the connection, which switches
+        # to other greenlets
+        self._overflow += 1
         try:
-            while self._max_overflow > -1 and \
-                                        self._overflow >= self._max_overflow:
-                gevent.sleep(0)
+            connection = self.create_connection()
+        except:
+            self._overflow -= 1
+            self._wake_waiter()
+            raise
+        if self._overflow > 0:
+            self.overflows += 1
+        return connection
+
+    def _wake_waiter(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.ready():
+                waiter.set(None)
+                return
+
+    def _wait(self, started):
+        remaining = None
+        if self._timeout is not None:
+            remaining = max(self._timeout - (time.time() - started), 0)
+        waiter = AsyncResult()
+        self._waiters.append(waiter)
+        try:
+            return waiter.get(timeout=remaining)
+        except gevent.Timeout:
+            if waiter.ready():
+                # Got a connection just as the timeout expired
+                return waiter.get(block=False)
+            self.timeouts += 1
+            raise PoolTimeout("QueuePool limit of size %d overflow %d reached, "
+                              "connection timed out, timeout %d" %
+                              (self.size(), self.overflow(), self._timeout))
+        except:
+            # Killed while waiting, don't leak a connection handed to us
+            if waiter.ready() and waiter.value is not None:
+                self.do_return_conn(waiter.value)
+            raise
         finally:
-            timeout.cancel()
-        return super(GreenQueuePool, self).do_get()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def stats(self):
+        """Returns the pool's usage metrics."""
+        return {
+            'size': self.size(),
+            'checkedin': self.checkedin(),
+            'checkedout': self.checkedout(),
+            'overflow': self.overflow(),
+            'waiting': len(self._waiters),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+            'overflows': self.overflows,
+            'timeouts': self.timeouts
+        }
+
+    def status(self):
+        return "%s Waiting: %d Checkouts: %d Waits: %d (%.3fs, max %.3fs) " \
+               "Overflows: %d Timeouts: %d" % (
+                    QueuePool.status(self), len(self._waiters),
+                    self.checkouts, self.waits, self.wait_time,
+                    self.max_wait_time, self.overflows, self.timeouts
+               )
+
+
+class GroupCommitter(object):
+    """Merges the commits of sessions from several greenlets into a single
+    database transaction, paying for one ``COMMIT``, and its disk flush,
+    per group instead of one per session.
+
+    The first greenlet to commit becomes the group's leader. It waits
+    `window` seconds for other sessions to commit, then flushes each of
+    them, inside its own ``SAVEPOINT``, on a shared connection and commits
+    it. A session whose flush fails gets its error without affecting the
+    others. Should the final commit fail, every session in the group gets
+    the error.
+
+    Requires a database with working savepoints. Sessions must not
+    autoflush, so that all their changes are still pending when committed.
+    Sessions waiting on a leader give up after `timeout` seconds.
+    """
+
+    def __init__(self, engine, window=0.002, max_size=100, timeout=30):
+        self.engine = engine
+        self.window = window
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pending = []
+        self.leading = False
+        #: number of groups committed and sessions committed in them
+        self.groups = self.commits = 0
+
+    def commit(self, session):
+        transaction = session.transaction
+        if transaction is None or transaction._parent is not None or \
+                            transaction.nested or session.twophase or \
+                            not (session.new or session.dirty or
+                                 session.deleted):
+            # Nothing to merge with other sessions
+            Session.commit(session)
+            return
+
+        waiter = AsyncResult()
+        self.pending.append((session, waiter))
+        try:
+            if not self.leading:
+                self.lead(session)
+            else:
+                result = waiter.get(timeout=self.timeout)
+                if isinstance(result, AsyncResult):
+                    # Promoted to lead the next group, which includes us
+                    waiter = result
+                    self.lead(session)
+            waiter.get(timeout=self.timeout)
+        except:
+            self.pending = [entry for entry in self.pending
+                            if entry[0] is not session]
+            Session.rollback(session)
+            raise
+        # The changes are committed, finish the session's own transaction,
+        # which has no connections left, to fire its commit hooks and
+        # expire its instances
+        Session.commit(session)
+
+    def lead(self, session):
+        self.leading = True
+        try:
+            gevent.sleep(self.window)
+            group = self.pending[:self.max_size]
+            del self.pending[:self.max_size]
+            self.commit_group(group)
+        finally:
+            self.leading = False
+            # Still pending if interrupted before committing, the leader
+            # can't hand the leadership to itself
+            self.pending = [entry for entry in self.pending
+                            if entry[0] is not session]
+            if self.pending:
+                # Hand the leadership to the longest waiting session, which
+                # then waits on a new result for its own commit
+                session, waiter = self.pending[0]
+                successor = AsyncResult()
+                self.pending[0] = (session, successor)
+                self.leading = True
+                waiter.set(successor)
+
+    def commit_group(self, group):
+        flushed = []
+        connection = self.engine.connect()
+        try:
+            transaction = connection.begin()
+            try:
+                for session, waiter in group:
+                    savepoint = connection.begin_nested()
+                    try:
+                        self.flush(session, connection, savepoint)
+                        savepoint.commit()
+                    except Exception, err:
+                        if savepoint.is_active:
+                            savepoint.rollback()
+                        waiter.set_exception(err)
+                    else:
+                        flushed.append(waiter)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            self.groups += 1
+            self.commits += len(flushed)
+            for waiter in flushed:
+                waiter.set(None)
+        except BaseException, err:
+            # Including the leader being killed or timed out, no session of
+            # the group is left waiting
+            for session, waiter in group:
+                if not waiter.ready():
+                    waiter.set_exception(err)
+            if not isinstance(err, Exception):
+                raise
+        finally:
+            connection.close()
+
+    def flush(self, session, connection, savepoint):
+        transaction = session.transaction
+        # Sessions don't autoflush, the connections they used so far were
+        # only read from. Release them and flush through the shared one.
+        for conn, conn_transaction, autoclose in \
+                                    set(transaction._connections.values()):
+            conn_transaction.commit()
+            if autoclose:
+                conn.close()
+        transaction._connections.clear()
+        transaction._connections[self.engine] = \
+            transaction._connections[connection] = \
+                (connection, savepoint, False)
+        try:
+            session.flush()
+        finally:
+            transaction._connections.clear()
+
+
+if __name__ == '__main__':
+    # Commits per second benchmark. Many greenlets each commit small
+    # sessions, committed from a greenlet spawned per commit, as previously
+    # done, from the committing greenlet, and with group commit.
+    from gevent import monkey
+    monkey.patch_all()
+    import os
+    import tempfile
+    import sqlalchemy
+    from optparse import OptionParser
+    from sqlalchemy import orm
+    from sqlalchemy.ext.declarative import declarative_base
+    parser = OptionParser(usage="%prog [options] [database uri]")
+    parser.add_option('-c', '--concurrency', default=50, type="int",
+                      help="Number of committing greenlets. Default: %default")
+    parser.add_option('-n', '--commits', default=20, type="int",
+                      help="Commits per greenlet. Default: %default")
+    (options, args) = parser.parse_args()
+    database_file = None
+    if args:
+        uri = args[0]
+    else:
+        database_file = tempfile.mktemp(suffix='.db')
+        uri = 'sqlite:///%s' % database_file
+
+    if uri.startswith('sqlite:'):
+        # A single writer at a time
+        engine = sqlalchemy.create_engine(uri, poolclass=GreenQueuePool,
+                                          pool_size=1, max_overflow=0)
+    else:
+        engine = sqlalchemy.create_engine(uri, poolclass=GreenQueuePool,
+                                          pool_size=10, max_overflow=0)
+
+    Base = declarative_base()
+    class BenchmarkRow(Base):
+        __tablename__ = 'group_commit_benchmark'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        value = sqlalchemy.Column(sqlalchemy.Integer)
+    Base.metadata.create_all(engine)
+
+    committer = GroupCommitter(engine)
+
+    class SpawnSession(Session):
+        def commit(self):
+            gevent.spawn(Session.commit, self).join()
+
+    class GroupSession(Session):
+        def commit(self):
+            committer.commit(self)
+
+    def worker(session_class):
+        session = orm.sessionmaker(bind=engine, class_=session_class,
+                                   autoflush=False)()
+        for idx in xrange(options.commits):
+            session.add(BenchmarkRow(value=idx))
+            session.commit()
+        session.close()
+
+    modes = [("spawned greenlet", SpawnSession), ("current greenlet", Session)]
+    if engine.name == 'sqlite':
+        print "Skipping group commit, not supported on SQLite"
+    else:
+        modes.append(("group commit", GroupSession))
+
+    total = options.concurrency * options.commits
+    for name, session_class in modes:
+        start = time.time()
+        gevent.joinall([gevent.spawn(worker, session_class)
+                        for idx in xrange(options.concurrency)], raise_error=True)
+        elapsed = time.time() - start
+        print "%-18s %d commits in %.2f secs, %.0f commits/s" % (
+            name + ':', total, elapsed, total / elapsed
+        )
+    if committer.groups:
+        print "  %.1f commits per group" % (committer.commits /
+                                            float(committer.groups))
 
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+    if database_file is not None:
+        os.unlink(database_file)
@@ -490,15 +490,76 @@ class IRCEventType(dbm.Model):
     def __init__(self, type):
         self.type = type
 
+class IRCEventQuery(BaseQuery):
+
+    def by_channel(self, channel_id, since=None, until=None):
+        query = self.filter(IRCEvent.channel_id==channel_id)
+        if since is not None:
+            query = query.filter(IRCEvent.stamp>=since)
+        if until is not None:
+            query = query.filter(IRCEvent.stamp<until)
+        return query
+
+    def paginate_after(self, cursor=None, per_page=100, keys=None,
+                       error_out=True):
+        if keys is None:
+            keys = (IRCEvent.stamp, IRCEvent.id)
+        return BaseQuery.paginate_after(self, cursor, per_page, keys,
+                                        error_out)
+
 class IRCEvent(dbm.Model):
     __tablename__ = 'irc_events'
     id            = dbm.Column(dbm.Integer, primary_key=True)
     type_id       = dbm.Column(dbm.ForeignKey('irc_event_types.type'))
     channel_id    = dbm.Column(dbm.ForeignKey('channels.id'))
+    nick          = dbm.Column(dbm.String(30))
     stamp         = dbm.Column(dbm.DateTime, default=datetime.utcnow)
-    raw_message   = dbm.Column(dbm.String(30))
-    clean_message = dbm.Column(dbm.String(30))
-    message       = dbm.Column(dbm.String(30))
+    raw_message   = dbm.Column(dbm.Text)
+    clean_message = dbm.Column(dbm.Text)
+    message       = dbm.Column(dbm.Text)
+    # HTML renderings of raw_message, with and without the IRC formatting
+    html_message  = dbm.Column(dbm.Text)
+    clean_html_message = dbm.Column(dbm.Text)
+
+    query_class   = IRCEventQuery
 
     def __init__(self):
         pass
+
+dbm.Index('ix_irc_events_channel_id_stamp_id', IRCEvent.__table__.c.channel_id,
+          IRCEvent.__table__.c.stamp, IRCEvent.__table__.c.id)
+dbm.Index('ix_irc_events_type_id_channel_id', IRCEvent.__table__.c.type_id,
+          IRCEvent.__table__.c.channel_id)
+
+
+class IRCEventDay(dbm.Model):
+    """The range of IRC events ids logged on a channel on a day, maintained by
+    :mod:`ilog.database.days`."""
+    __tablename__ = 'irc_event_days'
+    channel_id    = dbm.Column(dbm.ForeignKey('channels.id'), primary_key=True)
+    day           = dbm.Column(dbm.Date, primary_key=True)
+    # The events table, or partition, holding the day's events
+    table_name    = dbm.Column(dbm.String(40), default='irc_events')
+    first_id      = dbm.Column(dbm.Integer)
+    last_id       = dbm.Column(dbm.Integer)
+    count         = dbm.Column(dbm.Integer, default=0)
+
+    channel       = dbm.relation("Channel", backref=dbm.backref(
+                        "days", lazy="dynamic",
+                        cascade="all, delete, delete-orphan"))
+
+    def __init__(self, channel_id, day, table_name='irc_events'):
+        self.channel_id = channel_id
+        self.day = day
+        self.table_name = table_name
+
+
+class Counter(dbm.Model):
+    """Incrementally maintained totals, see :mod:`ilog.database.counters`."""
+    __tablename__ = 'counters'
+    name          = dbm.Column(dbm.String(50), primary_key=True)
+    value         = dbm.Column(dbm.BigInteger, default=0)
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
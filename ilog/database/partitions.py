@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.partitions
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Optional time partitioned storage of the IRC events.
+
+    When enabled, IRC events are not written to the ``irc_events`` table but
+    to one table per month, ``irc_events_YYYYMM``, or one table per channel
+    and month, ``irc_events_c<channel id>_YYYYMM``. The events of a day are
+    read from the partition the day index recorded for it, and dropping old
+    events is a matter of dropping whole tables instead of running a huge
+    ``DELETE``.
+
+    Plain tables are used, so this works the same on every database engine,
+    SQLite and PostgreSQL included.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import re
+import logging
+import gevent
+import sqlalchemy
+from datetime import datetime, timedelta
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.database import dbm
+from ilog.database.counters import counters
+from ilog.database.search import search_index
+from ilog.database.signals import database_setup
+
+log = logging.getLogger(__name__)
+
+_partition_re = re.compile(r'^irc_events_(?:c(?P<channel_id>\d+)_)?'
+                           r'(?P<year>\d{4})(?P<month>\d{2})$')
+
+SCHEMES = (None, 'month', 'channel-month')
+
+
+def month_range(year, month):
+    """Returns the start of the month and the start of the following one."""
+    start = datetime(year, month, 1)
+    if month == 12:
+        return start, datetime(year + 1, 1, 1)
+    return start, datetime(year, month + 1, 1)
+
+
+class IRCEventsPartitions(ComponentBase):
+
+    #: one of :data:`SCHEMES`. `None` disables partitioning.
+    scheme = None
+    #: drop the partitions holding events older than this many days
+    retention_days = None
+
+    # ComponentBase methods
+    def activate(self):
+        self.metadata = sqlalchemy.MetaData()
+        self.tables = {}
+
+    def connect_signals(self):
+        database_setup.connect(self.on_database_setup)
+
+    def on_database_setup(self, emitter):
+        if self.scheme not in SCHEMES:
+            raise RuntimeError("IRC events partitioning scheme \"%s\" not "
+                               "supported" % self.scheme)
+        for name in dbm.database_engine.table_names():
+            if _partition_re.match(name):
+                self.define_table(name)
+        log.debug("Found %s IRC events partitions", len(self.tables))
+        if self.retention_days:
+            gevent.spawn(self.enforce_retention)
+
+    # Partitions Methods
+    @property
+    def enabled(self):
+        return self.scheme is not None
+
+    def partition_name(self, channel_id, stamp):
+        if self.scheme == 'channel-month':
+            return 'irc_events_c%d_%04d%02d' % (channel_id, stamp.year,
+                                                stamp.month)
+        return 'irc_events_%04d%02d' % (stamp.year, stamp.month)
+
+    def define_table(self, name):
+        table = self.tables.get(name)
+        if table is None:
+            from ilog.database.models import IRCEvent
+            # Same columns as the irc_events table, without the foreign keys,
+            # which would only slow down the inserts
+            table = sqlalchemy.Table(name, self.metadata, *[
+                sqlalchemy.Column(column.name, column.type,
+                                  primary_key=column.primary_key)
+                for column in IRCEvent.__table__.columns
+            ])
+            sqlalchemy.Index('ix_%s_channel_id_stamp_id' % name,
+                             table.c.channel_id, table.c.stamp, table.c.id)
+            self.tables[name] = table
+        return table
+
+    def get_table(self, name):
+        """Returns the partition table `name`, creating it if needed. The
+        table is created outside of any ongoing transaction so that it's not
+        lost if that transaction is rolled back."""
+        if name not in self.tables:
+            log.info("Creating IRC events partition %s", name)
+            table = self.define_table(name)
+            try:
+                table.create(dbm.database_engine, checkfirst=True)
+            except:
+                self.metadata.remove(table)
+                del self.tables[name]
+                raise
+        return self.tables[name]
+
+    def insert(self, connection, events):
+        """Route each of the `events` to its partition."""
+        partitioned = {}
+        for event in events:
+            name = self.partition_name(event['channel_id'], event['stamp'])
+            partitioned.setdefault(name, []).append(event)
+        # Create any missing partitions before writing anything
+        tables = dict((name, self.get_table(name)) for name in partitioned)
+        for name, rows in partitioned.iteritems():
+            connection.execute(tables[name].insert(), rows)
+
+    def prune(self, channel_id=None, since=None, until=None):
+        """Returns the partitions which might hold events for `channel_id`
+        between `since` and `until`, oldest first."""
+        for name in sorted(self.tables):
+            match = _partition_re.match(name)
+            if match.group('channel_id') is not None and \
+                            channel_id is not None and \
+                            int(match.group('channel_id')) != channel_id:
+                continue
+            start, end = month_range(int(match.group('year')),
+                                     int(match.group('month')))
+            if since is not None and end <= since:
+                continue
+            if until is not None and start >= until:
+                continue
+            yield self.tables[name]
+
+    def drop_before(self, stamp):
+        """Drops the partitions which only hold events older than `stamp`."""
+        for table in list(self.prune(until=stamp)):
+            match = _partition_re.match(table.name)
+            start, end = month_range(int(match.group('year')),
+                                     int(match.group('month')))
+            if end > stamp:
+                continue
+            log.info("Dropping IRC events partition %s", table.name)
+            # The search index only refers to the events by time and channel
+            channel_id = match.group('channel_id')
+            search_index.purge(start, end,
+                               channel_id is not None and int(channel_id) or
+                               None)
+            dropped = dbm.database_engine.execute(
+                sqlalchemy.select([sqlalchemy.func.count()], from_obj=[table])
+            ).scalar()
+            table.drop(dbm.database_engine, checkfirst=True)
+            counters.add('irc_events', -dropped)
+            from ilog.database.models import IRCEventDay
+            days = IRCEventDay.__table__
+            dbm.database_engine.execute(
+                days.delete().where(days.c.table_name==table.name)
+            )
+            self.metadata.remove(table)
+            del self.tables[table.name]
+
+    def enforce_retention(self):
+        while True:
+            self.drop_before(
+                datetime.utcnow() - timedelta(days=self.retention_days)
+            )
+            gevent.sleep(3600)
+
+partitions = IRCEventsPartitions(component_manager)
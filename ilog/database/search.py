@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.search
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Full-text search over the logged IRC messages.
+
+    The search index is kept on the ``irc_events_search`` table, updated
+    incrementally each time a batch of IRC events is written. Each indexed
+    entry carries the channel, nick and time of the event so that results can
+    be filtered and displayed without touching the ``irc_events`` table.
+
+    The index is built on the database engine's own full-text search support,
+    an ``FTS5`` virtual table on SQLite and a ``tsvector`` column with a
+    ``GIN`` index on PostgreSQL. Search is disabled on other engines.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import sqlalchemy
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.database import dbm, KeysetPagination, keyset_criteria
+from ilog.database.signals import database_setup
+
+log = logging.getLogger(__name__)
+
+
+class SearchIndex(ComponentBase):
+
+    table_name = 'irc_events_search'
+
+    #: text search configuration used on PostgreSQL
+    language = 'simple'
+
+    # ComponentBase methods
+    def activate(self):
+        self.backend = self.table = None
+
+    def connect_signals(self):
+        from ilog.irc.signals import irc_events_flushed
+        database_setup.connect(self.on_database_setup)
+        irc_events_flushed.connect(self.on_irc_events_flushed)
+
+    def on_database_setup(self, emitter):
+        engine = dbm.database_engine
+        if engine.name == 'sqlite':
+            self.backend = 'sqlite'
+            self.table = sqlalchemy.Table(self.table_name,
+                sqlalchemy.MetaData(),
+                sqlalchemy.Column('rowid', sqlalchemy.Integer,
+                                  primary_key=True),
+                sqlalchemy.Column('message', sqlalchemy.Text),
+                sqlalchemy.Column('nick', sqlalchemy.String(30)),
+                sqlalchemy.Column('channel_id', sqlalchemy.Integer),
+                sqlalchemy.Column('stamp', sqlalchemy.DateTime),
+            )
+            engine.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                "message, nick UNINDEXED, channel_id UNINDEXED, "
+                "stamp UNINDEXED, tokenize='unicode61')" % self.table_name
+            )
+        elif engine.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import TSVECTOR
+            self.backend = 'postgresql'
+            self.table = sqlalchemy.Table(self.table_name,
+                sqlalchemy.MetaData(),
+                sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                sqlalchemy.Column('channel_id', sqlalchemy.Integer),
+                sqlalchemy.Column('nick', sqlalchemy.String(30)),
+                sqlalchemy.Column('stamp', sqlalchemy.DateTime),
+                sqlalchemy.Column('message', sqlalchemy.Text),
+                sqlalchemy.Column('document', TSVECTOR),
+            )
+            sqlalchemy.Index('ix_%s_document' % self.table_name,
+                             self.table.c.document, postgresql_using='gin')
+            sqlalchemy.Index('ix_%s_channel_id_stamp' % self.table_name,
+                             self.table.c.channel_id, self.table.c.stamp)
+            self.table.create(engine, checkfirst=True)
+        else:
+            log.warn("Full-text search is not supported on %s databases",
+                     engine.name)
+
+    def on_irc_events_flushed(self, emitter, events=None):
+        if self.backend is None:
+            return
+        try:
+            self.index(events)
+        except Exception, err:
+            log.exception(err)
+
+    # SearchIndex Methods
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def index(self, events):
+        rows = [{
+            'channel_id': event['channel_id'],
+            'nick': event['nick'],
+            'stamp': event['stamp'],
+            'message': event['clean_message'],
+        } for event in events if event['clean_message']]
+        if not rows:
+            return
+
+        if self.backend == 'postgresql':
+            for row in rows:
+                row['document_source'] = row['message']
+            insert = self.table.insert().values(
+                document=sqlalchemy.func.to_tsvector(
+                    self.language, sqlalchemy.bindparam('document_source')
+                )
+            )
+        else:
+            insert = self.table.insert()
+        dbm.database_engine.execute(insert, rows)
+
+    def purge(self, since=None, until=None, channel_id=None):
+        """Removes the indexed messages of `channel_id`, or of every channel,
+        between `since` and `until`."""
+        if self.backend is None:
+            return
+        table = self.table
+        criteria = []
+        if channel_id is not None:
+            criteria.append(table.c.channel_id==channel_id)
+        if since is not None:
+            criteria.append(table.c.stamp>=since)
+        if until is not None:
+            criteria.append(table.c.stamp<until)
+        result = dbm.database_engine.execute(
+            table.delete(criteria and sqlalchemy.and_(*criteria) or None)
+        )
+        log.info("Removed %s indexed IRC messages", result.rowcount)
+
+    def search(self, terms, channel_id=None, nick=None, since=None,
+               until=None, cursor=None, per_page=25):
+        """Returns a :class:`~ilog.database.KeysetPagination` with the best
+        matches of `terms`, optionally filtered by channel, nick and time
+        range, coming after `cursor`.
+
+        Every match is ranked and paged through ordered on its rank, lowest
+        first, and id. Only a page of matches is kept while sorting, a
+        bounded top-N sort, not all of them.
+        """
+        table = self.table
+        if self.backend == 'postgresql':
+            query = sqlalchemy.func.plainto_tsquery(self.language, terms)
+            # Best matches first
+            rank = -sqlalchemy.func.ts_rank_cd(table.c.document, query)
+            criteria = [table.c.document.op('@@')(query)]
+            row_id = table.c.id
+        else:
+            # Quote each of the terms so that FTS5 query syntax isn't
+            # interpreted, they're implicitly AND'ed
+            query = ' '.join(['"%s"' % term.replace('"', '""')
+                              for term in terms.split()])
+            rank = sqlalchemy.literal_column('rank')
+            criteria = [sqlalchemy.literal_column(self.table_name).match(query)]
+            row_id = table.c.rowid
+
+        if channel_id is not None:
+            criteria.append(table.c.channel_id==channel_id)
+        if nick:
+            criteria.append(table.c.nick==nick)
+        if since is not None:
+            criteria.append(table.c.stamp>=since)
+        if until is not None:
+            criteria.append(table.c.stamp<until)
+
+        # Ranks are compared as integers, floats don't reliably survive the
+        # round trip through the cursor
+        candidates = sqlalchemy.select([
+            row_id.label('id'), table.c.channel_id, table.c.nick,
+            table.c.stamp, table.c.message,
+            sqlalchemy.cast(rank * 1000000000,
+                            sqlalchemy.BigInteger).label('rank')
+        ], sqlalchemy.and_(*criteria)).alias('candidates')
+        keys = (candidates.c.rank, candidates.c.id)
+
+        select = candidates.select()
+        if cursor is not None:
+            select = select.where(keyset_criteria(keys, cursor))
+        select = select.order_by(*keys).limit(per_page + 1)
+        items = dbm.database_engine.execute(select).fetchall()
+        return KeysetPagination(None, keys, cursor, per_page, items[:per_page],
+                                len(items) > per_page)
+
+search_index = SearchIndex(component_manager)
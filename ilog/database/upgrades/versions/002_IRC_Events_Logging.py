@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.upgrades.versions.002_IRC_Events_Logging
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Prepare the ``irc_events`` table to be written by the IRC logging core.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from migrate import *
+from ilog.database import dbm
+
+log = logging.getLogger('ilog.database.upgrades.002')
+
+metadata = dbm.MetaData()
+
+EVENT_TYPES = (
+    'message', 'action', 'notice', 'join', 'part', 'kick', 'topic'
+)
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    irc_events = dbm.Table('irc_events', metadata, autoload=True)
+    irc_event_types = dbm.Table('irc_event_types', metadata, autoload=True)
+
+    log.debug("Adding the nick column to the IRC events table")
+    dbm.Column('nick', dbm.String(30)).create(irc_events)
+    for name in ('raw_message', 'clean_message', 'message'):
+        irc_events.c[name].alter(type=dbm.Text)
+
+    log.debug("Adding the IRC event types")
+    migrate_engine.execute(irc_event_types.insert(),
+                           [{'type': type} for type in EVENT_TYPES])
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    irc_events = dbm.Table('irc_events', metadata, autoload=True)
+    irc_event_types = dbm.Table('irc_event_types', metadata, autoload=True)
+
+    migrate_engine.execute(
+        irc_event_types.delete().where(irc_event_types.c.type.in_(EVENT_TYPES))
+    )
+    for name in ('raw_message', 'clean_message', 'message'):
+        irc_events.c[name].alter(type=dbm.String(30))
+    irc_events.c.nick.drop()
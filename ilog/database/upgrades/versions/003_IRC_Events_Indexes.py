@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.upgrades.versions.003_IRC_Events_Indexes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Index the ``irc_events`` table for the per channel and time range
+    queries, and for the per type ones.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from migrate import *
+from ilog.database import dbm
+
+log = logging.getLogger('ilog.database.upgrades.003')
+
+metadata = dbm.MetaData()
+
+def get_indexes(irc_events):
+    return (
+        dbm.Index('ix_irc_events_channel_id_stamp_id', irc_events.c.channel_id,
+                  irc_events.c.stamp, irc_events.c.id),
+        dbm.Index('ix_irc_events_type_id_channel_id', irc_events.c.type_id,
+                  irc_events.c.channel_id)
+    )
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    irc_events = dbm.Table('irc_events', metadata, autoload=True)
+    for index in get_indexes(irc_events):
+        log.debug("Creating index %s", index.name)
+        index.create(migrate_engine)
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    irc_events = dbm.Table('irc_events', metadata, autoload=True)
+    for index in get_indexes(irc_events):
+        index.drop(migrate_engine)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.upgrades.versions.004_IRC_Events_Rendered_HTML
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Store the HTML rendering of the IRC events messages, with and without
+    formatting, along with the raw and clean messages. Existing events are
+    rendered by running ``ilog-render``.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from migrate import *
+from ilog.database import dbm
+from ilog.database.partitions import _partition_re
+
+log = logging.getLogger('ilog.database.upgrades.004')
+
+metadata = dbm.MetaData()
+
+COLUMNS = ('html_message', 'clean_html_message')
+
+def get_tables(migrate_engine):
+    # The IRC events partitions, if any, have the same columns
+    return [
+        dbm.Table(name, metadata, autoload=True)
+        for name in migrate_engine.table_names()
+        if name == 'irc_events' or _partition_re.match(name)
+    ]
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    for table in get_tables(migrate_engine):
+        log.debug("Adding the rendered HTML columns to %s", table.name)
+        for name in COLUMNS:
+            dbm.Column(name, dbm.Text).create(table)
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    for table in get_tables(migrate_engine):
+        for name in COLUMNS:
+            table.c[name].drop()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.upgrades.versions.005_Counters
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Add the counters table, seeded with the current totals of IRC events,
+    including those on partitions, channels and networks.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from migrate import *
+from ilog.database import dbm
+from ilog.database.partitions import _partition_re
+
+log = logging.getLogger('ilog.database.upgrades.005')
+
+metadata = dbm.MetaData()
+
+counters = dbm.Table('counters', metadata,
+    dbm.Column('name', dbm.String(50), primary_key=True),
+    dbm.Column('value', dbm.BigInteger, default=0)
+)
+
+def count_rows(migrate_engine, name):
+    table = dbm.Table(name, metadata, autoload=True)
+    return migrate_engine.execute(
+        dbm.select([dbm.func.count()], from_obj=[table])
+    ).scalar()
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    counters.create()
+
+    totals = {'irc_events': 0}
+    for name in migrate_engine.table_names():
+        if name == 'irc_events' or _partition_re.match(name):
+            totals['irc_events'] += count_rows(migrate_engine, name)
+    totals['channels'] = count_rows(migrate_engine, 'channels')
+    totals['networks'] = count_rows(migrate_engine, 'networks')
+    log.debug("Seeding the counters: %s", totals)
+    migrate_engine.execute(counters.insert(), [
+        {'name': name, 'value': value} for name, value in totals.iteritems()
+    ])
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    counters.drop()
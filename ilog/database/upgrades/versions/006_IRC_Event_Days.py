@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.database.upgrades.versions.006_IRC_Event_Days
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Add the IRC events day index. It's filled by the logging core, existing
+    events are indexed, in batches, once it starts.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from migrate import *
+from ilog.database import dbm
+
+log = logging.getLogger('ilog.database.upgrades.006')
+
+metadata = dbm.MetaData()
+
+irc_event_days = dbm.Table('irc_event_days', metadata,
+    dbm.Column('channel_id', dbm.ForeignKey('channels.id'), primary_key=True),
+    dbm.Column('day', dbm.Date, primary_key=True),
+    dbm.Column('table_name', dbm.String(40), default='irc_events'),
+    dbm.Column('first_id', dbm.Integer),
+    dbm.Column('last_id', dbm.Integer),
+    dbm.Column('count', dbm.Integer, default=0)
+)
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    # Referenced by the foreign key
+    dbm.Table('channels', metadata, autoload=True)
+    irc_event_days.create()
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    irc_event_days.drop()
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc
+    ~~~~~~~~
+
+    IRC logging core and bots.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
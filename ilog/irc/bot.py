@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc.bot
+    ~~~~~~~~~~~~
+
+    IRC bot which joins a network's channels and emits the events to log.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import re
+import logging
+import gevent
+from datetime import datetime
+from girclib import client, signals
+from ilog.common.convert import to_unicode
+from ilog.web.utils.jinjafilters import format_irc_message
+from .signals import irc_event_received
+
+log = logging.getLogger(__name__)
+
+_formatting_re = re.compile(
+    r'\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x16\x1d\x1f]'
+)
+
+def strip_irc_formatting(message):
+    """Remove the IRC formatting control codes from `message`."""
+    return _formatting_re.sub(u'', message)
+
+
+class NetworkBot(object):
+
+    #: seconds to wait before reconnecting after being disconnected
+    reconnect_delay = 30
+
+    def __init__(self, network, nick, password=None):
+        self.network_id = network.id
+        self.name = network.name
+        self.host = network.host
+        self.port = network.port
+        self.encoding = network.encoding or 'UTF-8'
+        self.nick = nick
+        self.password = password
+        self.channels = {}
+        self.stopping = self.signed_on = False
+        self.client = None
+
+    def __repr__(self):
+        return '<%s %r on %s:%s>' % (self.__class__.__name__, self.name,
+                                     self.host, self.port)
+
+    def add_channel(self, channel):
+        self.channels[channel.prefixed_name.lower()] = (
+            channel.id, channel.prefixed_name, channel.key
+        )
+        if self.signed_on:
+            self.join(channel.prefixed_name, channel.key)
+
+    def remove_channel(self, channel):
+        self.channels.pop(channel.prefixed_name.lower(), None)
+        if self.signed_on:
+            self.client.leave(channel.prefixed_name)
+
+    def start(self):
+        self.stopping = False
+        self.client = client.IRCClient(self.host, self.port, self.nick,
+                                       self.nick, self.nick)
+        signals.on_signed_on.connect(self.on_signed_on, sender=self.client)
+        signals.on_disconnected.connect(self.on_disconnected,
+                                        sender=self.client)
+        signals.on_privmsg.connect(self.on_privmsg, sender=self.client)
+        signals.on_action.connect(self.on_action, sender=self.client)
+        signals.on_notice.connect(self.on_notice, sender=self.client)
+        signals.on_user_joined.connect(self.on_user_joined, sender=self.client)
+        signals.on_user_left.connect(self.on_user_left, sender=self.client)
+        signals.on_user_kicked.connect(self.on_user_kicked, sender=self.client)
+        signals.on_topic_changed.connect(self.on_topic_changed,
+                                         sender=self.client)
+        log.info("Connecting to %s:%s", self.host, self.port)
+        self.client.connect()
+
+    def stop(self):
+        self.stopping = True
+        if self.client is not None:
+            self.client.disconnect()
+
+    def join(self, name, key=None):
+        log.debug("Joining %s on %s", name, self.name)
+        if key:
+            self.client.join(name, key)
+        else:
+            self.client.join(name)
+
+    def on_signed_on(self, emitter):
+        log.info("Signed on to %s", self.name)
+        self.signed_on = True
+        if self.password:
+            self.client.msg('NickServ', 'IDENTIFY %s' % self.password)
+        for channel_id, name, key in self.channels.values():
+            self.join(name, key)
+
+    def on_disconnected(self, emitter):
+        self.signed_on = False
+        if self.stopping:
+            return
+        log.warn("Disconnected from %s. Reconnecting in %s seconds.",
+                 self.name, self.reconnect_delay)
+        gevent.spawn_later(self.reconnect_delay, self.start)
+
+    def on_privmsg(self, emitter, channel=None, user=None, message=None):
+        self.log_event('message', channel, user, message)
+
+    def on_action(self, emitter, channel=None, user=None, message=None):
+        self.log_event('action', channel, user, message)
+
+    def on_notice(self, emitter, channel=None, user=None, message=None):
+        self.log_event('notice', channel, user, message)
+
+    def on_user_joined(self, emitter, channel=None, user=None):
+        self.log_event('join', channel, user)
+
+    def on_user_left(self, emitter, channel=None, user=None, message=None):
+        self.log_event('part', channel, user, message)
+
+    def on_user_kicked(self, emitter, channel=None, user=None, kicker=None,
+                       message=None):
+        self.log_event('kick', channel, kicker, message)
+
+    def on_topic_changed(self, emitter, channel=None, user=None, topic=None):
+        self.log_event('topic', channel, user, topic)
+
+    def decode(self, data):
+        if not data or isinstance(data, unicode):
+            return data or u''
+        return to_unicode(data, self.encoding)[1]
+
+    def log_event(self, type_id, channel, user, message=None):
+        channel_details = self.channels.get((channel or '').lower())
+        if channel_details is None:
+            # Private conversation or a channel we're not logging
+            return
+
+        message = self.decode(message)
+        event = {
+            'type_id': type_id,
+            'channel_id': channel_details[0],
+            'nick': self.decode(user).split(u'!', 1)[0],
+            'stamp': datetime.utcnow(),
+            'raw_message': message,
+            'clean_message': strip_irc_formatting(message),
+            # Rendered once here instead of on every page view
+            'html_message': unicode(format_irc_message(message)),
+            'clean_html_message': unicode(format_irc_message(message,
+                                                             strip=True)),
+        }
+        irc_event_received.send(self, event=event)
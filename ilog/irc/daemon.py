@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc.daemon
+    ~~~~~~~~~~~~~~~
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import gevent
+import gevent.monkey
+gevent.monkey.patch_all()
+from gevent.event import Event
+
+import os
+import socket
+import logging
+from flask.config import Config
+from st.daemon import BaseDaemon, BaseOptionParser
+from ilog import (__core_bin_name__, __bot_bin_name__, __broker_bin_name__,
+                  __render_bin_name__, __package_name__, __version__)
+from ilog.common import configdefaults
+
+log = logging.getLogger(__name__)
+
+
+class Daemon(BaseDaemon):
+
+    LOG_FMT = '%(asctime)s,%(msecs)03.0f [%(name)-30s][%(levelname)-8s] %(message)s'
+
+    bin_name = __core_bin_name__
+    config_file_name = "ilogcoreconfig.py"
+
+    def __init__(self, networks=(), worker_id=None, **kwargs):
+        super(Daemon, self).__init__(**kwargs)
+        self.networks = networks
+        self.worker_id = worker_id
+        self.bots = {}
+        self.channels = {}
+        self.scheduler = None
+
+    @classmethod
+    def get_option_parser(cls):
+        return BaseOptionParser(__package_name__, __version__)
+
+    @classmethod
+    def get_options_kwargs(cls, options):
+        return dict(pidfile=options.pidfile, logfile=options.logfile,
+                    detach_process=options.detach_process, uid=options.uid,
+                    gid=options.gid, working_directory=options.working_dir,
+                    loglevel=options.loglevel, process_name=cls.bin_name)
+
+    @classmethod
+    def cli(cls):
+        parser = cls.get_option_parser()
+        (options, args) = parser.parse_args()
+
+        if args:
+            parser.print_help()
+            print
+            parser.exit(1, "no args should be passed, only the available "
+                        "options\n")
+
+        cli = cls(**cls.get_options_kwargs(options))
+        return cli.run_daemon()
+
+    def load_config(self):
+        config = Config(os.path.abspath(self.working_directory))
+        config.from_object(configdefaults)
+        custom_config_file = os.path.join(config.root_path,
+                                          self.config_file_name)
+        try:
+            if os.path.isfile(custom_config_file):
+                config.from_pyfile(custom_config_file)
+                log.info("Loaded custom configuration from %r",
+                         custom_config_file)
+            else:
+                log.info("%s not found", custom_config_file)
+        except IOError:
+            log.info("No %r found. Using default configuration.",
+                     self.config_file_name)
+        return config
+
+    def run(self):
+        from ilog.common.signals import daemonized, running
+        from ilog.database import dbm
+        from ilog.database.signals import database_setup
+        logging.getLogger('sqlalchemy').setLevel(logging.ERROR)
+        logging.getLogger('migrate').setLevel(logging.INFO)
+        log.info("IRC Daemon Running")
+        self.import_components()
+        daemonized.send(self)
+
+        self.config = self.load_config()
+        dbm.native_unicode = self.config['SQLALCHEMY_NATIVE_UNICODE']
+        dbm.record_queries = self.config['SQLALCHEMY_RECORD_QUERIES']
+        dbm.pool_size = self.config['SQLALCHEMY_POOL_SIZE']
+        dbm.pool_timeout = self.config['SQLALCHEMY_POOL_TIMEOUT']
+        dbm.pool_recycle = self.config['SQLALCHEMY_POOL_RECYCLE']
+        dbm.group_commit = self.config['SQLALCHEMY_GROUP_COMMIT']
+        dbm.group_commit_window = self.config['SQLALCHEMY_GROUP_COMMIT_WINDOW']
+
+        from ilog.database.counters import counters
+        counters.flush_interval = self.config['COUNTERS_FLUSH_INTERVAL']
+        counters.cache_timeout = self.config['COUNTERS_CACHE_TIMEOUT']
+
+        self.stopped = Event()
+        database_setup.connect(self.on_database_setup)
+        self.start_transport()
+        running.send(self)
+        dbm.set_database_uri(self.config['SQLALCHEMY_DATABASE_URI'])
+        self.stopped.wait()
+
+    def import_components(self):
+        # Components need to be imported before the daemonized signal is sent
+        # in order to be activated
+        import ilog.irc.writer
+        import ilog.database.search
+        import ilog.database.counters
+        import ilog.database.days
+
+    def start_transport(self):
+        from ilog.irc.transport import EventsCollector
+        from ilog.irc.writer import writer
+        from ilog.database.partitions import partitions
+        writer.flush_size = self.config['IRC_EVENTS_FLUSH_SIZE']
+        writer.flush_interval = self.config['IRC_EVENTS_FLUSH_INTERVAL']
+        partitions.scheme = self.config['IRC_EVENTS_PARTITIONING']
+        partitions.retention_days = self.config['IRC_EVENTS_RETENTION_DAYS']
+
+        if self.config['IRC_EVENTS_BROKERED']:
+            self.transport = EventsCollector(
+                self.config['IRC_BROKER_ENDPOINTS'], bind=False
+            )
+        else:
+            self.transport = EventsCollector(
+                self.config['IRC_EVENTS_ENDPOINTS'], bind=True
+            )
+        self.transport.start()
+
+    def on_database_setup(self, emitter):
+        if not self.config['IRC_SCHEDULER_ENABLED']:
+            return
+        from ilog.irc.scheduler import ChannelScheduler
+        self.scheduler = ChannelScheduler(
+            self.config['IRC_SCHEDULER_HEARTBEATS_ENDPOINT'],
+            self.config['IRC_SCHEDULER_ASSIGNMENTS_ENDPOINT'],
+            interval=self.config['IRC_SCHEDULER_INTERVAL'],
+            timeout=self.config['IRC_SCHEDULER_TIMEOUT']
+        )
+        self.scheduler.start()
+        self.scheduler.load_channels()
+
+    def exit(self):
+        self.exited = False
+        from ilog.common.signals import undaemonized, shutdown
+        log.info("IRC Daemon Exiting...")
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.transport.stop()
+        def on_irc_shutdown(sender):
+            log.info("IRC Daemon Quitting...")
+            undaemonized.send(self)
+            self.stopped.set()
+            self.exited = True
+        shutdown.connect(on_irc_shutdown)
+        shutdown.send(self)
+
+
+class BotDaemon(Daemon):
+
+    bin_name = __bot_bin_name__
+
+    @classmethod
+    def get_option_parser(cls):
+        parser = super(BotDaemon, cls).get_option_parser()
+        parser.add_option('-n', '--network', action="append", default=[],
+                          dest="networks",
+                          help="Slug of a network this bot should log. Can "
+                               "be passed multiple times. Defaults to all "
+                               "networks. Ignored when the channels are "
+                               "assigned by the scheduler.")
+        parser.add_option('-w', '--worker-id', default=None,
+                          help="The identifier of this bot when the channels "
+                               "are assigned by the scheduler. Defaults to "
+                               "<hostname>-<pid>.")
+        return parser
+
+    @classmethod
+    def get_options_kwargs(cls, options):
+        kwargs = super(BotDaemon, cls).get_options_kwargs(options)
+        kwargs['networks'] = options.networks
+        kwargs['worker_id'] = options.worker_id
+        return kwargs
+
+    def import_components(self):
+        # The events are written by the logging core, not by the bots
+        pass
+
+    def start_transport(self):
+        from ilog.irc.scheduler import ChannelStats
+        from ilog.irc.transport import EventsPusher
+        self.stats = None
+        if self.config['IRC_SCHEDULER_ENABLED']:
+            self.stats = ChannelStats()
+        self.transport = EventsPusher(self.config['IRC_EVENTS_ENDPOINTS'],
+                                      hwm=self.config['IRC_EVENTS_HWM'],
+                                      stats=self.stats)
+        self.transport.start()
+
+    def on_database_setup(self, emitter):
+        if self.config['IRC_SCHEDULER_ENABLED']:
+            from ilog.irc.scheduler import WorkerAgent
+            if self.worker_id is None:
+                self.worker_id = '%s-%s' % (socket.gethostname(), os.getpid())
+            self.scheduler = WorkerAgent(
+                self.worker_id,
+                self.config['IRC_SCHEDULER_HEARTBEATS_ENDPOINT'],
+                self.config['IRC_SCHEDULER_ASSIGNMENTS_ENDPOINT'],
+                self.on_channels_assigned, self.stats,
+                interval=self.config['IRC_SCHEDULER_INTERVAL']
+            )
+            self.scheduler.start()
+            return
+
+        from ilog.database.models import Network
+        for network in Network.query.all():
+            if self.networks and network.slug not in self.networks:
+                continue
+            for channel in network.channels:
+                self.add_channel(channel, self.config['BOT_NICK'])
+
+    def on_channels_assigned(self, channel_ids, slot):
+        from ilog.database import dbm
+        from ilog.database.models import Channel
+        log.info("Assigned %s channels", len(channel_ids))
+        nick = self.config['BOT_NICK']
+        if slot:
+            # Several workers might be logging the same network
+            nick = '%s%s' % (nick, slot)
+
+        for channel_id in set(self.channels) - channel_ids:
+            self.remove_channel(self.channels[channel_id])
+
+        added_ids = channel_ids - set(self.channels)
+        if added_ids:
+            try:
+                for channel in Channel.query.filter(
+                                        Channel.id.in_(added_ids)).all():
+                    self.add_channel(channel, nick)
+            finally:
+                dbm.session.remove()
+
+    def add_channel(self, channel, nick):
+        from ilog.irc.bot import NetworkBot
+        bot = self.bots.get(channel.network_id)
+        if bot is None:
+            bot = NetworkBot(channel.network, nick,
+                             self.config['BOT_PASSWORD'])
+            self.bots[channel.network_id] = bot
+            gevent.spawn(bot.start)
+        bot.add_channel(channel)
+        self.channels[channel.id] = channel
+
+    def remove_channel(self, channel):
+        bot = self.bots.get(channel.network_id)
+        del self.channels[channel.id]
+        if bot is None:
+            return
+        bot.remove_channel(channel)
+        if not bot.channels:
+            bot.stop()
+            del self.bots[channel.network_id]
+
+    def exit(self):
+        for bot in self.bots.values():
+            bot.stop()
+        super(BotDaemon, self).exit()
+
+
+class BrokerDaemon(Daemon):
+
+    bin_name = __broker_bin_name__
+
+    def run(self):
+        from ilog.irc.transport import run_broker
+        log.info("IRC Events Broker Running")
+        self.config = self.load_config()
+        run_broker(self.config['IRC_EVENTS_ENDPOINTS'],
+                   self.config['IRC_BROKER_ENDPOINTS'])
+
+    def exit(self):
+        log.info("IRC Events Broker Exiting...")
+        self.exited = True
+
+
+class RenderDaemon(Daemon):
+    """Re-renders the HTML of the stored IRC events. To be run whenever the
+    IRC formatting rendering changes."""
+
+    bin_name = __render_bin_name__
+
+    def __init__(self, batch_size=1000, jobs=4, **kwargs):
+        super(RenderDaemon, self).__init__(**kwargs)
+        self.batch_size = batch_size
+        self.jobs = jobs
+
+    @classmethod
+    def get_option_parser(cls):
+        parser = super(RenderDaemon, cls).get_option_parser()
+        parser.add_option('-b', '--batch-size', default=1000, type="int",
+                          help="Number of events rendered and updated at "
+                               "once. Default: %default")
+        parser.add_option('-j', '--jobs', default=4, type="int",
+                          help="Number of batches being updated concurrently. "
+                               "Default: %default")
+        return parser
+
+    @classmethod
+    def get_options_kwargs(cls, options):
+        kwargs = super(RenderDaemon, cls).get_options_kwargs(options)
+        kwargs['batch_size'] = options.batch_size
+        kwargs['jobs'] = options.jobs
+        return kwargs
+
+    def import_components(self):
+        import ilog.database.partitions
+
+    def start_transport(self):
+        self.transport = None
+
+    def on_database_setup(self, emitter):
+        # Let the other database_setup handlers run first
+        gevent.spawn(self.render_all).link(lambda gt: self.stopped.set())
+
+    def render_all(self):
+        from ilog.database.models import IRCEvent
+        from ilog.database.partitions import partitions
+        tables = [IRCEvent.__table__] + [
+            partitions.tables[name] for name in sorted(partitions.tables)
+        ]
+        for table in tables:
+            self.render_table(table)
+        log.info("Done rendering IRC events")
+
+    def render_table(self, table):
+        from gevent.pool import Pool
+        from ilog.database import dbm
+        pool = Pool(self.jobs)
+        select = dbm.select([table.c.id, table.c.raw_message])
+        last_id, total = 0, 0
+        while True:
+            rows = dbm.database_engine.execute(
+                select.where(table.c.id>last_id).order_by(table.c.id)
+                      .limit(self.batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            total += len(rows)
+            # Rendering and updating a batch overlaps fetching the next one
+            pool.spawn(self.render_batch, table, rows)
+        pool.join()
+        log.info("Rendered %s IRC events on %s", total, table.name)
+
+    def render_batch(self, table, rows):
+        from ilog.database import dbm
+        from ilog.web.utils.jinjafilters import format_irc_message
+        update = table.update().where(
+            table.c.id==dbm.bindparam('event_id')
+        ).values(html_message=dbm.bindparam('html'),
+                 clean_html_message=dbm.bindparam('clean_html'))
+        values = [{
+            'event_id': row.id,
+            'html': unicode(format_irc_message(row.raw_message or u'')),
+            'clean_html': unicode(format_irc_message(row.raw_message or u'',
+                                                     strip=True))
+        } for row in rows]
+        connection = dbm.database_engine.connect()
+        transaction = connection.begin()
+        try:
+            connection.execute(update, values)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def exit(self):
+        log.info("IRC Events Render Exiting...")
+        self.stopped.set()
+        self.exited = True
+
+
+def start_daemon():
+    return Daemon.cli()
+
+def start_bot():
+    return BotDaemon.cli()
+
+def start_broker():
+    return BrokerDaemon.cli()
+
+def start_render():
+    return RenderDaemon.cli()
+
+if __name__ == '__main__':
+    start_daemon()
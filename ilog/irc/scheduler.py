@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc.scheduler
+    ~~~~~~~~~~~~~~~~~~
+
+    Spreads the logged channels across several bot worker processes.
+
+    Every worker periodically sends a heartbeat to the scheduler, which runs
+    on the logging core, reporting the message rate and the lag of each of
+    the channels it logs. Channels are placed on workers using a consistent
+    hash ring with bounded loads: a channel goes to the first worker found
+    clockwise from the channel's hash which still has capacity for the
+    channel's load. Channels stay on their worker while it has capacity for
+    them, so only new channels, those of removed workers and those over a
+    worker's capacity are placed again. A worker which stops sending
+    heartbeats is considered dead and its channels are placed among the
+    remaining ones.
+
+    The resulting assignments are published to all workers which then join
+    and leave channels accordingly.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+import logging
+import gevent
+import simplejson
+from bisect import bisect
+from hashlib import md5
+from .transport import context, zmq
+
+log = logging.getLogger(__name__)
+
+
+class HashRing(object):
+    """Consistent hash ring using `replicas` virtual nodes per node."""
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = set()
+        self._keys = []
+        self._ring = {}
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _hash(self, key):
+        return long(md5(str(key)).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in xrange(self.replicas):
+            self._ring[self._hash('%s:%s' % (node, replica))] = node
+        self._keys = sorted(self._ring)
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for replica in xrange(self.replicas):
+            del self._ring[self._hash('%s:%s' % (node, replica))]
+        self._keys = sorted(self._ring)
+
+    def iter_nodes(self, key):
+        """Yields each node once, clockwise from where `key` hashes to."""
+        if not self._keys:
+            return
+        seen = set()
+        start = bisect(self._keys, self._hash(key))
+        for idx in xrange(len(self._keys)):
+            node = self._ring[self._keys[(start + idx) % len(self._keys)]]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def get_node(self, key):
+        for node in self.iter_nodes(key):
+            return node
+
+
+class WorkerState(object):
+    def __init__(self, worker_id, slot):
+        self.worker_id = worker_id
+        self.slot = slot
+        self.last_seen = time.time()
+        #: channel_id -> (message rate, lag) as reported by the worker
+        self.channels = {}
+
+    @property
+    def lag(self):
+        return max([lag for rate, lag in self.channels.values()] or [0])
+
+
+class ChannelScheduler(object):
+    """Assigns the channels to the bot workers. Runs on the logging core."""
+
+    #: allowed load of a worker above the average load
+    balance_factor = 0.25
+    #: reported lag, in seconds, above which a worker gets half the capacity
+    max_lag = 5
+
+    def __init__(self, heartbeats_endpoint, assignments_endpoint,
+                 interval=5, timeout=15):
+        self.heartbeats_endpoint = heartbeats_endpoint
+        self.assignments_endpoint = assignments_endpoint
+        self.interval = interval
+        self.timeout = timeout
+        self.ring = HashRing()
+        self.workers = {}
+        self.channel_ids = set()
+        self.assignments = {}
+        self.greenlets = []
+
+    def start(self):
+        self.heartbeats = context.socket(zmq.PULL)
+        self.heartbeats.bind(self.heartbeats_endpoint)
+        self.publisher = context.socket(zmq.PUB)
+        self.publisher.bind(self.assignments_endpoint)
+        self.greenlets = [gevent.spawn(self.receive_heartbeats),
+                          gevent.spawn(self.supervise)]
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.heartbeats.close()
+        self.publisher.close()
+
+    def set_channels(self, channel_ids):
+        channel_ids = set(channel_ids)
+        if channel_ids != self.channel_ids:
+            self.channel_ids = channel_ids
+            self.rebalance()
+
+    def load_channels(self):
+        from ilog.database.models import Channel
+        from ilog.database import dbm
+        try:
+            self.set_channels(
+                [row[0] for row in dbm.session.query(Channel.id).all()]
+            )
+        finally:
+            dbm.session.remove()
+
+    def receive_heartbeats(self):
+        while True:
+            try:
+                heartbeat = simplejson.loads(self.heartbeats.recv())
+            except ValueError, err:
+                log.exception(err)
+                continue
+            self.on_heartbeat(heartbeat['worker'], heartbeat['channels'])
+
+    def on_heartbeat(self, worker_id, channels):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            used_slots = set(w.slot for w in self.workers.values())
+            slot = min(set(xrange(len(used_slots) + 1)) - used_slots)
+            log.info("Worker %r joined", worker_id)
+            worker = self.workers[worker_id] = WorkerState(worker_id, slot)
+            self.ring.add_node(worker_id)
+            self.rebalance()
+        worker.last_seen = time.time()
+        worker.channels = dict(
+            (int(channel_id), tuple(stats))
+            for channel_id, stats in channels.iteritems()
+        )
+
+    def supervise(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.load_channels()
+            now = time.time()
+            for worker in self.workers.values():
+                if now - worker.last_seen > self.timeout:
+                    log.warn("Worker %r stopped responding. Rebalancing its "
+                             "channels.", worker.worker_id)
+                    del self.workers[worker.worker_id]
+                    self.ring.remove_node(worker.worker_id)
+                    self.rebalance()
+            if self.is_overloaded():
+                self.rebalance()
+            self.publish()
+
+    def channel_load(self, channel_id):
+        for worker in self.workers.values():
+            if channel_id in worker.channels:
+                rate, lag = worker.channels[channel_id]
+                return 1 + rate
+        return 1
+
+    def capacities(self):
+        total_load = sum(self.channel_load(c) for c in self.channel_ids)
+        average = total_load / float(max(len(self.workers), 1))
+        capacities = {}
+        for worker in self.workers.values():
+            capacity = average * (1 + self.balance_factor)
+            if worker.lag > self.max_lag:
+                capacity /= 2
+            capacities[worker.worker_id] = max(capacity, 1)
+        return capacities
+
+    def is_overloaded(self):
+        capacities = self.capacities()
+        for worker_id, channel_ids in self.assignments.iteritems():
+            load = sum(self.channel_load(c) for c in channel_ids)
+            if load > capacities.get(worker_id, 0) * (1 + self.balance_factor):
+                return True
+        return False
+
+    def rebalance(self):
+        """Places the new channels, those of the removed workers and those
+        over the capacity of their worker. The other channels stay where
+        they are."""
+        capacities = self.capacities()
+        loads = dict((worker_id, 0) for worker_id in self.workers)
+        assignments = dict((worker_id, []) for worker_id in self.workers)
+        unassigned = set(self.channel_ids)
+        for worker_id, channel_ids in self.assignments.iteritems():
+            if worker_id not in assignments:
+                # Removed, its channels are placed again
+                continue
+            # Keep the lightest channels, moving as few as possible of the
+            # heaviest off an overloaded worker
+            for channel_id in sorted(unassigned.intersection(channel_ids),
+                                     key=self.channel_load):
+                channel_load = self.channel_load(channel_id)
+                if loads[worker_id] + channel_load <= capacities[worker_id]:
+                    loads[worker_id] += channel_load
+                    assignments[worker_id].append(channel_id)
+                    unassigned.discard(channel_id)
+        if unassigned:
+            log.debug("Placing channels %s", sorted(unassigned))
+
+        # Place the heaviest channels first so they get their preferred worker
+        channels = sorted(unassigned, key=self.channel_load, reverse=True)
+        for channel_id in channels:
+            channel_load = self.channel_load(channel_id)
+            chosen = None
+            for worker_id in self.ring.iter_nodes(channel_id):
+                if loads[worker_id] + channel_load <= capacities[worker_id]:
+                    chosen = worker_id
+                    break
+            if chosen is None:
+                if not loads:
+                    # No workers to assign channels to
+                    break
+                # Every worker is at capacity, use the least loaded one
+                chosen = min(loads, key=loads.get)
+            loads[chosen] += channel_load
+            assignments[chosen].append(channel_id)
+        self.assignments = assignments
+        log.debug("Channels assignments: %s", assignments)
+        self.publish()
+
+    def publish(self):
+        if not getattr(self, 'publisher', None):
+            return
+        self.publisher.send(simplejson.dumps({
+            'assignments': self.assignments,
+            'slots': dict((w.worker_id, w.slot) for w in self.workers.values())
+        }))
+
+
+class WorkerAgent(object):
+    """Sends heartbeats to the scheduler and applies the assignments it
+    publishes. Runs on each bot worker.
+
+    `on_assignment` is called with the set of channel ids this worker should
+    log and the worker's slot number whenever the assignment changes.
+    """
+
+    def __init__(self, worker_id, heartbeats_endpoint, assignments_endpoint,
+                 on_assignment, stats, interval=5):
+        self.worker_id = worker_id
+        self.heartbeats_endpoint = heartbeats_endpoint
+        self.assignments_endpoint = assignments_endpoint
+        self.on_assignment = on_assignment
+        self.stats = stats
+        self.interval = interval
+        self.channel_ids = self.slot = None
+        self.greenlets = []
+
+    def start(self):
+        self.heartbeats = context.socket(zmq.PUSH)
+        self.heartbeats.setsockopt(zmq.HWM, 1)
+        self.heartbeats.connect(self.heartbeats_endpoint)
+        self.subscriber = context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, '')
+        self.subscriber.connect(self.assignments_endpoint)
+        self.greenlets = [gevent.spawn(self.send_heartbeats),
+                          gevent.spawn(self.receive_assignments)]
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.heartbeats.close()
+        self.subscriber.close()
+
+    def send_heartbeats(self):
+        while True:
+            self.heartbeats.send(simplejson.dumps({
+                'worker': self.worker_id,
+                'channels': self.stats.collect(self.interval)
+            }))
+            gevent.sleep(self.interval)
+
+    def receive_assignments(self):
+        while True:
+            try:
+                message = simplejson.loads(self.subscriber.recv())
+            except ValueError, err:
+                log.exception(err)
+                continue
+            if self.worker_id not in message['assignments']:
+                continue
+            channel_ids = set(message['assignments'][self.worker_id])
+            slot = message['slots'][self.worker_id]
+            if channel_ids != self.channel_ids or slot != self.slot:
+                self.channel_ids, self.slot = channel_ids, slot
+                self.on_assignment(channel_ids, slot)
+
+
+class ChannelStats(object):
+    """Per channel message count and lag, reset on each :meth:`collect`."""
+
+    def __init__(self):
+        self.channels = {}
+
+    def record(self, channel_id, lag):
+        count, max_lag = self.channels.get(channel_id, (0, 0))
+        self.channels[channel_id] = (count + 1, max(max_lag, lag))
+
+    def collect(self, interval):
+        channels, self.channels = self.channels, {}
+        return dict(
+            (channel_id, (count / float(interval), lag))
+            for channel_id, (count, lag) in channels.iteritems()
+        )
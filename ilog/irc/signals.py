@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc.signals
+    ~~~~~~~~~~~~~~~~
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+from ilog.common.signals import signal
+
+irc_event_received = signal("irc-event-received", """\
+Emitted by a bot for each IRC event it should be logged. The event is passed
+as the `event` keyword argument, a dictionary suitable to be inserted on the
+`irc_events` table.
+""")
+
+irc_events_flushed = signal("irc-events-flushed", """\
+Emitted after a batch of IRC events has been written to the database. The
+written rows are passed as the `events` keyword argument.
+""")
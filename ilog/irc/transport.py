@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc.transport
+    ~~~~~~~~~~~~~~~~~~
+
+    ZeroMQ transport of IRC events between the bots and the logging core.
+
+    Each bot process connects a ``PUSH`` socket to the configured endpoints
+    while the logging core binds a ``PULL`` socket on them, which allows a
+    single core to absorb events from several bots on several hosts. To run
+    several cores, start a broker which binds both sides of a streamer and
+    make the cores connect to the broker's backend instead of binding.
+
+    Any ZeroMQ endpoint is supported, ``ipc://`` and ``tcp://localhost`` being
+    the ones to use on a single box.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import gevent
+import simplejson
+from calendar import timegm
+from datetime import datetime
+try:
+    from zmq import green as zmq
+except ImportError:
+    from gevent_zeromq import zmq
+from .signals import irc_event_received
+
+log = logging.getLogger(__name__)
+
+context = zmq.Context()
+
+
+def dump_event(event):
+    event = event.copy()
+    stamp = event['stamp']
+    event['stamp'] = timegm(stamp.utctimetuple()) + stamp.microsecond / 1e6
+    return simplejson.dumps(event)
+
+def load_event(data):
+    event = simplejson.loads(data)
+    event['stamp'] = datetime.utcfromtimestamp(event['stamp'])
+    return event
+
+
+class EventsPusher(object):
+    """Sends the IRC events emitted on this process to the logging core."""
+
+    def __init__(self, endpoints, hwm=100000, stats=None):
+        self.endpoints = endpoints
+        self.hwm = hwm
+        #: optional :class:`~ilog.irc.scheduler.ChannelStats`
+        self.stats = stats
+        self.socket = None
+
+    def start(self):
+        self.socket = context.socket(zmq.PUSH)
+        # Do not grow without bounds while no core is reachable
+        self.socket.setsockopt(zmq.HWM, self.hwm)
+        for endpoint in self.endpoints:
+            log.debug("Pushing IRC events to %s", endpoint)
+            self.socket.connect(endpoint)
+        irc_event_received.connect(self.on_irc_event_received)
+
+    def stop(self):
+        irc_event_received.disconnect(self.on_irc_event_received)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def on_irc_event_received(self, emitter, event=None):
+        self.push(event)
+
+    def push(self, event):
+        self.socket.send(dump_event(event))
+        if self.stats is not None:
+            # Time the event waited to be handed to the socket, which grows
+            # when the core is not keeping up
+            lag = datetime.utcnow() - event['stamp']
+            self.stats.record(event['channel_id'], lag.seconds +
+                              lag.microseconds / 1e6)
+
+
+class EventsCollector(object):
+    """Receives the IRC events pushed by the bots and emits them locally,
+    where they're picked up by :class:`~ilog.irc.writer.EventsWriter`.
+    """
+
+    def __init__(self, endpoints, bind=True, handler=None):
+        self.endpoints = endpoints
+        self.bind = bind
+        if handler is None:
+            handler = self.emit
+        self.handler = handler
+        self.socket = self.receiving = None
+        self.total_received = 0
+
+    def start(self):
+        self.socket = context.socket(zmq.PULL)
+        for endpoint in self.endpoints:
+            if self.bind:
+                log.debug("Collecting IRC events on %s", endpoint)
+                self.socket.bind(endpoint)
+            else:
+                log.debug("Collecting IRC events from broker on %s", endpoint)
+                self.socket.connect(endpoint)
+        self.receiving = gevent.spawn(self.receive)
+
+    def stop(self):
+        if self.receiving is not None:
+            self.receiving.kill()
+            self.receiving = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def emit(self, event):
+        irc_event_received.send(self, event=event)
+
+    def receive(self):
+        while True:
+            data = self.socket.recv()
+            try:
+                event = load_event(data)
+            except Exception, err:
+                log.exception(err)
+                continue
+            self.total_received += 1
+            self.handler(event)
+
+
+def run_broker(frontend, backend):
+    """Streams the events pushed to `frontend` by the bots to the logging cores
+    connected to `backend`. This call blocks forever.
+    """
+    import zmq as blocking_zmq
+    ctx = blocking_zmq.Context()
+    frontend_socket = ctx.socket(blocking_zmq.PULL)
+    for endpoint in frontend:
+        frontend_socket.bind(endpoint)
+    backend_socket = ctx.socket(blocking_zmq.PUSH)
+    for endpoint in backend:
+        backend_socket.bind(endpoint)
+    log.info("Brokering IRC events from %s to %s",
+             ', '.join(frontend), ', '.join(backend))
+    blocking_zmq.device(blocking_zmq.STREAMER, frontend_socket, backend_socket)
+
+
+if __name__ == '__main__':
+    # Throughput benchmark. Pushes events through `endpoint` and reports the
+    # messages per second and the end-to-end latency percentiles.
+    import sys
+    import time
+    from gevent.event import Event
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] [endpoint]")
+    parser.add_option('-c', '--count', default=100000, type="int",
+                      help="Number of events to send. Default: %default")
+    (options, args) = parser.parse_args()
+    endpoint = args and args[0] or 'ipc:///tmp/ilog-benchmark'
+
+    latencies = []
+    done = Event()
+
+    def on_event(event):
+        latencies.append(time.time() - event['sent'])
+        if len(latencies) == options.count:
+            done.set()
+
+    collector = EventsCollector([endpoint], handler=on_event)
+    collector.start()
+    pusher = EventsPusher([endpoint], hwm=0)
+    pusher.start()
+    gevent.sleep(0.5)   # Allow the sockets to connect
+
+    event = {
+        'type_id': 'message', 'channel_id': 1, 'nick': u'ilog',
+        'raw_message': u'\x02Hello\x02 \x0304World\x03',
+        'clean_message': u'Hello World',
+    }
+    start = time.time()
+    for idx in xrange(options.count):
+        event['stamp'] = datetime.utcnow()
+        event['sent'] = time.time()
+        pusher.push(event)
+        if idx % 1000 == 0:
+            # Allow the collector to run
+            gevent.sleep(0)
+    done.wait()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies)-1, int(len(latencies) * p))] * 1000
+    print "%s: %d events in %.2f secs" % (endpoint, options.count, elapsed)
+    print "  throughput: %.0f msg/s" % (options.count / elapsed)
+    print "  latency: p50 %.3f ms  p99 %.3f ms  max %.3f ms" % (
+        percentile(0.50), percentile(0.99), latencies[-1] * 1000
+    )
+    pusher.stop()
+    collector.stop()
+    sys.exit(0)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.irc.writer
+    ~~~~~~~~~~~~~~~
+
+    Buffered writer of IRC events.
+
+    Committing each logged line through the ORM session caps the logging core
+    at a few hundred lines per second. Instead, events are kept in memory and
+    written to the ``irc_events`` table in batches, either once
+    :attr:`EventsWriter.flush_size` events are waiting or every
+    :attr:`EventsWriter.flush_interval` seconds, whichever comes first. Each
+    batch is a single ``executemany`` insert inside a single transaction, or
+    one per partition when :mod:`ilog.database.partitions` is enabled.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import gevent
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.common.signals import shutdown
+from ilog.database import dbm
+from ilog.database.partitions import partitions
+from ilog.database.signals import database_setup
+from .signals import irc_event_received, irc_events_flushed
+
+log = logging.getLogger(__name__)
+
+
+class EventsWriter(ComponentBase):
+
+    #: number of buffered events which triggers an immediate flush
+    flush_size = 1000
+    #: maximum number of seconds an event waits in the buffer
+    flush_interval = 1
+
+    def activate(self):
+        self.buffer = []
+        self.flushing = self.timer = self.table = None
+        self.total_written = 0
+
+    def connect_signals(self):
+        irc_event_received.connect(self.on_irc_event_received)
+        database_setup.connect(self.on_database_setup)
+        shutdown.connect(self.on_shutdown)
+
+    def on_database_setup(self, emitter):
+        from ilog.database.models import IRCEvent
+        self.table = IRCEvent.__table__
+        self.timer = gevent.spawn(self.flush_periodically)
+        # Events might have been buffered while the database was being set up
+        self.schedule_flush()
+
+    def on_irc_event_received(self, emitter, event=None):
+        self.write(event)
+
+    def on_shutdown(self, emitter):
+        if self.timer is not None:
+            self.timer.kill()
+        if self.flushing is not None:
+            self.flushing.join()
+        if self.buffer:
+            log.info("Flushing %s buffered IRC events before shutting down",
+                     len(self.buffer))
+            self.flush()
+
+    def write(self, event):
+        self.buffer.append(event)
+        if len(self.buffer) >= self.flush_size:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        def reset_flushing(gt):
+            self.flushing = None
+
+        if self.table is None or not self.buffer:
+            # Database not yet setup or nothing to write
+            return
+
+        if self.flushing is None:
+            self.flushing = gevent.spawn(self.flush)
+            self.flushing.link(reset_flushing)
+
+    def flush_periodically(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            self.schedule_flush()
+
+    def flush(self):
+        while self.buffer:
+            events = self.buffer[:self.flush_size]
+            del self.buffer[:self.flush_size]
+
+            connection = dbm.database_engine.connect()
+            transaction = connection.begin()
+            try:
+                if partitions.enabled:
+                    partitions.insert(connection, events)
+                else:
+                    connection.execute(self.table.insert(), events)
+                transaction.commit()
+            except Exception, err:
+                log.exception(err)
+                transaction.rollback()
+                # Put the events back in front of the buffer, they will be
+                # retried on the next flush.
+                self.buffer[:0] = events
+                break
+            finally:
+                connection.close()
+
+            self.total_written += len(events)
+            log.trace("Wrote %s IRC events. %s waiting.",
+                      len(events), len(self.buffer))
+            irc_events_flushed.send(self, events=events)
+            # Allow other things to run
+            gevent.sleep(0)
+
+writer = EventsWriter(component_manager)
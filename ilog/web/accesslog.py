@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.accesslog
+    ~~~~~~~~~~~~~~~~~~
+
+    Non-blocking access log of the web server.
+
+    Each served request adds a record to a bounded buffer and returns right
+    away. A background greenlet takes the buffered records every
+    :attr:`AccessLog.interval` seconds, or as soon as
+    :attr:`AccessLog.batch_size` are waiting, and writes them in one go, from
+    a thread of the hub's pool when writing to a file so that disk I/O never
+    blocks the requests being served.
+
+    When the buffer is full, requests either wait for it to be written or,
+    with ``drop`` enabled, their records are dropped and counted.
+
+    Records are written as text lines or, for later analysis, one JSON
+    object per line with the request duration in seconds.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import time
+import logging
+import gevent
+from collections import deque
+from gevent.event import Event
+from gevent.pywsgi import WSGIHandler
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('text', 'json')
+
+
+class AccessLog(object):
+    """Buffers the access log records and writes them in batches.
+
+    :param filename: the file records are appended to. `None` passes them
+                     to the ``ilog.SERVE`` logger instead.
+    :param format: one of :data:`FORMATS`
+    :param size: the maximum number of records buffered
+    :param drop: drop the records when the buffer is full instead of making
+                 requests wait
+    """
+
+    LOG_FORMAT = ('%(client_ip)s "%(request_line)s"'
+                  ' %(status_code)s %(body_length)s %(wall_seconds).6f secs')
+
+    #: seconds between each write of the buffered records
+    interval = 1
+    #: number of buffered records which triggers a write
+    batch_size = 1000
+
+    def __init__(self, filename=None, format='text', size=10000, drop=False):
+        if format not in FORMATS:
+            raise RuntimeError("Access log format \"%s\" not supported" %
+                               format)
+        self.filename = filename
+        self.format = format
+        self.size = size
+        self.drop = drop
+        self.buffer = deque()
+        #: number of records dropped, and written
+        self.dropped = self.written = 0
+        #: number of records which couldn't be formatted
+        self.failed = 0
+        self.reported_dropped = 0
+        self.file = None
+        self.logger = logging.getLogger('ilog.SERVE')
+        self.wakeup = Event()
+        self.drained = Event()
+        self.drained.set()
+        self.writer = None
+
+    def start(self):
+        if self.filename is not None:
+            self.file = os.open(self.filename,
+                                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.writer = gevent.spawn(self.write_periodically)
+
+    def stop(self):
+        """Stops the background writer and writes what's buffered."""
+        if self.writer is not None:
+            self.writer.kill()
+            self.writer = None
+        self.flush()
+        if self.file is not None:
+            os.close(self.file)
+            self.file = None
+
+    def add(self, record):
+        """Buffers `record`, a dictionary, to be written."""
+        while len(self.buffer) >= self.size:
+            if self.drop or self.writer is None:
+                self.dropped += 1
+                return
+            # Wait for the writer to make room
+            self.drained.clear()
+            self.wakeup.set()
+            self.drained.wait()
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    def write_periodically(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception, err:
+                log.exception(err)
+
+    def flush(self):
+        if self.dropped != self.reported_dropped:
+            log.warning("Dropped %s access log records, %s since last "
+                        "reported", self.dropped,
+                        self.dropped - self.reported_dropped)
+            self.reported_dropped = self.dropped
+        if not self.buffer:
+            self.drained.set()
+            return
+        records = list(self.buffer)
+        self.buffer.clear()
+        # Requests waiting for room can go on
+        self.drained.set()
+
+        lines = []
+        for record in records:
+            # A bad record doesn't lose the whole batch
+            try:
+                lines.append(self.format_record(record))
+            except Exception, err:
+                self.failed += 1
+                log.error("Failed to format access log record %r: %s",
+                          record, err)
+        if not lines:
+            return
+        if self.file is None:
+            for line in lines:
+                self.logger.info(line)
+        else:
+            data = '\n'.join(lines) + '\n'
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            gevent.get_hub().threadpool.apply(os.write, (self.file, data))
+        self.written += len(lines)
+
+    def format_record(self, record):
+        if self.format == 'json':
+            return json.dumps(record)
+        return self.LOG_FORMAT % record
+
+
+def decode(value):
+    """Decodes `value`, as sent by the client, replacing what isn't UTF-8."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class AccessLogHandler(WSGIHandler):
+    """Handler of the WSGI server adding a record of each request to the
+    server's :class:`AccessLog`, its `access_log` attribute."""
+
+    def log_request(self):
+        access_log = getattr(self.server, 'access_log', None)
+        if access_log is None:
+            return WSGIHandler.log_request(self)
+        client_address = self.client_address
+        if isinstance(client_address, tuple):
+            client_address = client_address[0]
+        environ = self.environ or {}
+        duration = (self.time_finish or time.time()) - self.time_start
+        access_log.add({
+            'time': self.time_start,
+            'client_ip': client_address or '-',
+            'request_line': decode(getattr(self, 'requestline', '') or ''),
+            'method': decode(environ.get('REQUEST_METHOD')),
+            'path': decode(environ.get('PATH_INFO')),
+            'query': decode(environ.get('QUERY_STRING') or None),
+            'status_code': (getattr(self, 'status', None) or '000').split()[0],
+            'body_length': self.response_length or 0,
+            'wall_seconds': duration,
+            'referer': decode(environ.get('HTTP_REFERER')),
+            'user_agent': decode(environ.get('HTTP_USER_AGENT')),
+            'pid': os.getpid()
+        })
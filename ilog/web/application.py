@@ -22,8 +22,15 @@ from flaskext.sass import Sass
 from ilog.common.signals import running, shutdown
 from ilog.database import dbm, signals
 from ilog.web import defaults
+from ilog.web.utils.conditional import set_conditional_headers
 from .signals import webapp_setup_complete, webapp_shutdown, after_identity_account_loaded
 from .mail import mail
+from .lastlogin import last_logins
+from .pagecache import page_cache
+from .probes import probes
+from ilog.database.search import search_index
+from ilog.database.counters import counters
+from ilog.database.days import day_index
 
 log = logging.getLogger(__name__)
 
@@ -31,12 +38,20 @@ class Application(Flask):
     def __init__(self):
         Flask.__init__(self, 'ilog.web')
         self.config.from_object(defaults)
+        #: the directory the daemon runs on, where what's written at runtime
+        #: goes, unlike :attr:`root_path`, the package's directory
+        self.working_directory = os.getcwd()
+        #: the number of worker processes serving the application, ``0`` if
+        #: it's served by the daemon's process
+        self.workers = 0
         running.connect(self.on_running_signal)
         signals.database_upgraded.connect(self.on_database_upgraded)
 
     def on_running_signal(self, daemon):
         log.trace("Got running signal")
-        self.config.root_path = daemon.working_directory
+        self.config.root_path = self.working_directory = \
+                                    os.path.abspath(daemon.working_directory)
+        self.workers = getattr(daemon, 'workers', 0)
         custom_config_file_name = "ilogwebconfig.py"
         try:
             custom_config_file = os.path.join(
@@ -63,7 +78,13 @@ class Application(Flask):
         dbm.pool_size = self.config.get('SQLALCHEMY_POLL_SIZE', 5)
         dbm.pool_timeout = self.config.get('SQLALCHEMY_POLL_TIMEOUT', 10)
         dbm.pool_recycle = self.config.get('SQLALCHEMY_POLL_RECYCLE', 3600)
+        dbm.group_commit = self.config.get('SQLALCHEMY_GROUP_COMMIT', False)
+        dbm.group_commit_window = self.config.get(
+            'SQLALCHEMY_GROUP_COMMIT_WINDOW', 0.002
+        )
         dbm.set_database_uri(self.config['SQLALCHEMY_DATABASE_URI'])
+        counters.flush_interval = self.config.get('COUNTERS_FLUSH_INTERVAL', 5)
+        counters.cache_timeout = self.config.get('COUNTERS_CACHE_TIMEOUT', 10)
 
         cache.init_app(self)
 
@@ -98,17 +119,31 @@ class Application(Flask):
 
         # Setup views
         from .views.main import main
+        from .views.search import search
+        from .views.logs import logs
         from .views.account import account
         from .views.admin import admin
         from .views.admin.accounts import accounts
         from .views.admin.channels import channels
         from .views.admin.networks import networks
+        from .views.admin.probes import probes as probe_jobs
         self.register_blueprint(main)
+        self.register_blueprint(search)
         self.register_blueprint(account)
         self.register_blueprint(admin)
         self.register_blueprint(accounts)
         self.register_blueprint(channels)
         self.register_blueprint(networks)
+        self.register_blueprint(probe_jobs)
+        self.register_blueprint(logs)
+
+        if self.config.get('COMPRESS_RESPONSES', True):
+            from .compress import CompressionMiddleware
+            self.wsgi_app = CompressionMiddleware(
+                self.wsgi_app, self.static_folder, self.static_url_path,
+                min_size=self.config.get('COMPRESS_MIN_SIZE', 500),
+                level=self.config.get('COMPRESS_LEVEL', 6)
+            )
 
         from ilog.web.utils.jinjafilters import format_irc_message
         self.jinja_env.filters['ircformat'] = format_irc_message
@@ -302,24 +337,15 @@ def account_related_actions(sender, account=None):
 
 @app.context_processor
 def get_total_events():
-    @cache.cached(timeout=10, key_prefix='total_irc_events')
-    def get_total_events_from_db():
-        from ilog.database.models import IRCEvent
-        return IRCEvent.query.count()
-
-    @cache.cached(timeout=10, key_prefix='total_irc_channels')
-    def get_total_channels_from_db():
-        from ilog.database.models import Channel
-        return Channel.query.count()
-
-    @cache.cached(timeout=10, key_prefix='total_irc_networks')
-    def get_total_netwokrs_from_db():
-        from ilog.database.models import Network
-        return Network.query.count()
-
-    return dict(total_events_logged=get_total_events_from_db(),
-                total_channels_logged=get_total_channels_from_db(),
-                total_networks_logged=get_total_netwokrs_from_db())
+    try:
+        totals = counters.get_all()
+    except Exception, err:
+        # Database has not yet been setup
+        log.debug("Failed to read the counters: %s", err)
+        totals = {}
+    return dict(total_events_logged=totals.get('irc_events', 0),
+                total_channels_logged=totals.get('channels', 0),
+                total_networks_logged=totals.get('networks', 0))
 
 @request_started.connect_via(app)
 def on_request_started(app):
@@ -344,6 +370,19 @@ def on_request_started(app):
         session['_redirect_target'] = redirect_target
 
 
+def remove_database_session(response_or_exc):
+    # Release the request's session, its greenlet might serve more requests
+    if dbm.session is not None:
+        dbm.session.remove()
+    return response_or_exc
+
+app.after_request(set_conditional_headers)
+
+if hasattr(app, 'teardown_request'):
+    app.teardown_request(remove_database_session)
+else:
+    app.after_request(remove_database_session)
+
 @request_finished.connect_via(app)
 def on_request_finished(app, response):
     if request.path.startswith(app.static_url_path):
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.compress
+    ~~~~~~~~~~~~~~~~~
+
+    Compression of the web application responses.
+
+    :class:`CompressionMiddleware` compresses the responses, as they're
+    streamed, for clients accepting it, with Brotli if the ``brotli`` module
+    is available, gzip otherwise. Small responses and already compressed
+    content are sent as is.
+
+    Static files are compressed ahead of time by the ``compress_static``
+    setup command, which writes a ``.gz`` copy of each one next to it. The
+    middleware serves those copies directly when they're up to date::
+
+        python setup.py compress_static
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import zlib
+import gzip
+import logging
+import mimetypes
+import subprocess
+from distutils import log as distutils_log
+from distutils.cmd import Command
+from werkzeug import Headers, Response, Request, wrap_file
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript',
+                      'application/x-javascript', 'application/json',
+                      'application/xml', 'application/rss+xml',
+                      'image/svg+xml', 'image/x-icon',
+                      'application/vnd.ms-fontobject', 'font/',
+                      'application/x-font-')
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.html', '.txt', '.svg', '.ico',
+                           '.ttf', '.otf', '.eot', '.json', '.xml')
+
+
+def is_compressible(content_type):
+    return content_type is not None and content_type.startswith(
+        COMPRESSIBLE_TYPES
+    )
+
+
+class CompressionMiddleware(object):
+    """Compresses the responses of the wrapped WSGI `app`.
+
+    :param app: the WSGI application to wrap
+    :param static_folder: the directory static files are served from, to
+                          look for their precompressed copies
+    :param static_url_path: the URL static files are served under
+    :param min_size: responses smaller than this many bytes aren't compressed
+    :param level: the gzip compression level
+    """
+
+    def __init__(self, app, static_folder=None, static_url_path=None,
+                 min_size=500, level=6):
+        self.app = app
+        self.static_folder = static_folder and os.path.abspath(static_folder)
+        self.static_url_path = static_url_path
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            # No body to compress
+            return self.app(environ, start_response)
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and accepted.quality('br') > 0:
+            encoding = 'br'
+        elif accepted.quality('gzip') > 0:
+            encoding = 'gzip'
+        else:
+            return self.app(environ, start_response)
+
+        if self.static_folder is not None and accepted.quality('gzip') > 0:
+            filename = self.get_precompressed(environ)
+            if filename is not None:
+                return self.serve_precompressed(environ, start_response,
+                                                filename)
+
+        # The ETags we add the encoding to must still match for the app
+        suffix = '-%s"' % encoding
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and suffix in if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(suffix, '"')
+            suffixed = True
+        else:
+            suffixed = False
+
+        state = {}
+        def compressing_start_response(status, headers, exc_info=None):
+            headers = Headers(headers)
+            etag = headers.get('ETag')
+            if self.should_compress(status, headers):
+                state['compressor'] = self.get_compressor(encoding)
+                headers.pop('Content-Length', None)
+                headers['Content-Encoding'] = encoding
+                if etag and etag.endswith('"'):
+                    # The compressed body is not the same entity
+                    headers['ETag'] = etag[:-1] + suffix
+            elif status.startswith('304') and suffixed and etag and \
+                                                        etag.endswith('"'):
+                # Still valid, as the compressed body the client has
+                headers['ETag'] = etag[:-1] + suffix
+            if is_compressible(headers.get('Content-Type')):
+                vary = headers.get('Vary')
+                if not vary:
+                    headers['Vary'] = 'Accept-Encoding'
+                elif 'accept-encoding' not in vary.lower():
+                    headers['Vary'] = vary + ', Accept-Encoding'
+            return start_response(status, headers.to_list(), exc_info)
+
+        app_iter = self.app(environ, compressing_start_response)
+        return self.compress(app_iter, state)
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200') or 'Content-Encoding' in headers:
+            return False
+        if not is_compressible(headers.get('Content-Type')):
+            return False
+        length = headers.get('Content-Length')
+        if length is not None and int(length) < self.min_size:
+            return False
+        return True
+
+    def get_compressor(self, encoding):
+        """Returns the functions compressing a chunk, flushing what was
+        compressed so far and finishing the compressed stream."""
+        if encoding == 'br':
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=5)
+            return compressor.process, compressor.flush, compressor.finish
+        # 16 + MAX_WBITS writes the gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return (compressor.compress,
+                lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                compressor.flush)
+
+    def compress(self, app_iter, state):
+        try:
+            for chunk in app_iter:
+                compressor = state.get('compressor')
+                if compressor is None:
+                    yield chunk
+                    continue
+                elif not chunk:
+                    continue
+                compress, flush, finish = compressor
+                # Streamed responses reach the client as they're produced,
+                # not once the compressor's buffer is full
+                chunk = compress(chunk) + flush()
+                if chunk:
+                    yield chunk
+            if state.get('compressor') is not None:
+                yield state['compressor'][2]()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def get_precompressed(self, environ):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.static_url_path + '/') or \
+                                        environ['REQUEST_METHOD'] != 'GET':
+            return None
+        filename = os.path.normpath(os.path.join(
+            self.static_folder, path[len(self.static_url_path) + 1:]
+        ))
+        if not filename.startswith(self.static_folder + os.sep):
+            return None
+        try:
+            if os.path.getmtime(filename + '.gz') < \
+                                        os.path.getmtime(filename):
+                # Outdated
+                return None
+        except OSError:
+            return None
+        return filename
+
+    def serve_precompressed(self, environ, start_response, filename):
+        request = Request(environ)
+        compressed = filename + '.gz'
+        content_type = mimetypes.guess_type(filename)[0] or \
+                                                    'application/octet-stream'
+        mtime = os.path.getmtime(filename)
+        response = Response(wrap_file(environ, open(compressed, 'rb')),
+                            mimetype=content_type, direct_passthrough=True)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.content_length = os.path.getsize(compressed)
+        response.cache_control.public = True
+        response.cache_control.max_age = 43200
+        response.set_etag('%d-%d-gzip' % (mtime, response.content_length))
+        response.last_modified = int(mtime)
+        return response.make_conditional(request)(environ, start_response)
+
+
+class compress_static(Command):
+    """Writes a gzip compressed copy of each of the static files, compiling
+    the SCSS themes first if a ``sass`` binary is available."""
+
+    description = 'precompress the web application static files'
+    user_options = [
+        ('static-dir=', 'd', 'the static files directory '
+                             '[default: ilog/web/static]'),
+        ('sass-bin=', None, 'the sass binary used to compile the SCSS '
+                            'themes [default: sass]'),
+        ('min-size=', None, 'smaller files are not compressed '
+                            '[default: 500]'),
+        ('force', 'f', 'compress files even if they are up to date')
+    ]
+    boolean_options = ['force']
+
+    def initialize_options(self):
+        self.static_dir = None
+        self.sass_bin = 'sass'
+        self.min_size = 500
+        self.force = False
+
+    def finalize_options(self):
+        if self.static_dir is None:
+            self.static_dir = os.path.join(os.path.dirname(__file__),
+                                           'static')
+        self.min_size = int(self.min_size)
+
+    def run(self):
+        self.compile_themes()
+        for dirpath, dirnames, filenames in os.walk(self.static_dir):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if name.endswith('.gz'):
+                    if not os.path.isfile(filename[:-3]):
+                        distutils_log.info("removing stale %s", filename)
+                        os.unlink(filename)
+                    continue
+                if not name.lower().endswith(COMPRESSIBLE_EXTENSIONS) or \
+                            os.path.getsize(filename) < self.min_size:
+                    continue
+                self.compress_file(filename)
+
+    def compile_themes(self):
+        for name in os.listdir(self.static_dir):
+            if not name.endswith('.scss'):
+                continue
+            source = os.path.join(self.static_dir, name)
+            target = source[:-5] + '.css'
+            if not self.force and os.path.isfile(target) and \
+                    os.path.getmtime(target) >= os.path.getmtime(source):
+                continue
+            distutils_log.info("compiling %s", source)
+            try:
+                subprocess.check_call([self.sass_bin, source, target])
+            except (OSError, subprocess.CalledProcessError), err:
+                distutils_log.warn("failed to compile %s: %s", source, err)
+
+    def compress_file(self, filename):
+        compressed = filename + '.gz'
+        mtime = os.path.getmtime(filename)
+        if not self.force and os.path.isfile(compressed) and \
+                                os.path.getmtime(compressed) >= mtime:
+            return
+        distutils_log.info("compressing %s", filename)
+        source = open(filename, 'rb')
+        try:
+            target = gzip.GzipFile(compressed, 'wb', 9, mtime=mtime)
+            try:
+                target.write(source.read())
+            finally:
+                target.close()
+        finally:
+            source.close()
+        # Mark it as up to date with the source
+        os.utime(compressed, (mtime, mtime))
@@ -11,32 +11,40 @@
 import gevent
 import gevent.monkey
 gevent.monkey.patch_all()
-from gevent import wsgi, pool
+from gevent import wsgi, pool, socket
 
+import os
+import time
+import errno
+import signal
 import logging
 from st.daemon import BaseDaemon, BaseOptionParser
 from ilog import __web_bin_name__, __package_name__, __version__
-
-class FilelikeLogger(object):
-    LOG_FORMAT = ('%(client_ip)s "%(request_line)s"'
-                  ' %(status_code)s %(body_length)s %(wall_seconds).6f secs')
-
-    def __init__(self):
-        self.log = logging.getLogger('ilog.SERVE')
-
-    def write(self, line):
-        self.log.info(line.strip())
+from ilog.web.accesslog import AccessLog, AccessLogHandler, FORMATS
 
 class Daemon(BaseDaemon):
 
     LOG_FMT = '%(asctime)s,%(msecs)03.0f [%(name)-30s][%(levelname)-8s] %(message)s'
 
+    #: seconds a stopping worker waits for the requests being served
+    graceful_timeout = 30
+
     def __init__(self, serve_host="127.0.0.1", serve_port=5000,
-                 use_reloader=False, **kwargs):
+                 use_reloader=False, workers=0, access_log=None,
+                 access_log_format='text', access_log_size=10000,
+                 access_log_drop=False, **kwargs):
         super(Daemon, self).__init__(**kwargs)
         self.serve_host = serve_host
         self.serve_port = serve_port
         self.use_reloader = use_reloader
+        self.workers = workers
+        self.access_log = AccessLog(access_log, access_log_format,
+                                    access_log_size, access_log_drop)
+        self.server = None
+        #: on the master process, worker pid -> worker number
+        self.worker_pids = None
+        #: on a worker process, its number
+        self.worker = None
 
     def prepare(self):
         super(Daemon, self).prepare()
@@ -51,6 +59,28 @@ class Daemon(BaseDaemon):
         parser.add_option('--use-reloader', default=False, action="store_true",
                           help="Use Werkzeug's reloader. DO NOT USE THIS IN "
                                "PRODUCTION!!!")
+        parser.add_option('-w', '--workers', default=0, type="int",
+                          help="Number of worker processes serving requests "
+                               "on the same socket. Send SIGHUP to restart "
+                               "them one at a time. Default: %default, serve "
+                               "from this process.")
+        parser.add_option('--access-log', default=None,
+                          help="File the access log is appended to. "
+                               "Default: the 'ilog.SERVE' logger.")
+        parser.add_option('--access-log-format', default='text',
+                          choices=FORMATS,
+                          help="Format of the access log records, one of "
+                               "%s. The JSON records include the request "
+                               "duration. Default: %%default" %
+                               ', '.join(FORMATS))
+        parser.add_option('--access-log-buffer', default=10000, type="int",
+                          help="Number of access log records buffered before "
+                               "being written. Default: %default")
+        parser.add_option('--access-log-drop', default=False,
+                          action="store_true",
+                          help="Drop, and count, the access log records when "
+                               "the buffer is full instead of waiting for it "
+                               "to be written.")
         (options, args) = parser.parse_args()
 
         if args:
@@ -64,46 +94,220 @@ class Daemon(BaseDaemon):
                   detach_process=options.detach_process, uid=options.uid,
                   gid=options.gid, working_directory=options.working_dir,
                   loglevel=options.loglevel, use_reloader=options.use_reloader,
+                  workers=options.workers,
+                  access_log=options.access_log,
+                  access_log_format=options.access_log_format,
+                  access_log_size=options.access_log_buffer,
+                  access_log_drop=options.access_log_drop,
                   process_name=__web_bin_name__)
         return cli.run_daemon()
 
     def run(self):
-        from ilog.web.application import app
-        from ilog.common.signals import daemonized, running
         logging.getLogger('sqlalchemy').setLevel(logging.ERROR)
         logging.getLogger('migrate').setLevel(logging.INFO)
         logging.getLogger(__name__).info("Webserver Daemon Running")
+        if self.workers > 0:
+            if self.use_reloader:
+                logging.getLogger(__name__).warning(
+                    "The reloader is not used with worker processes"
+                )
+            return self.run_master()
+        self.serve((self.serve_host, self.serve_port))
+
+    def serve(self, listener, ready_fd=None):
+        from ilog.web.application import app
+        from ilog.common.signals import daemonized, running
         daemonized.send(self)
         def start_serving():
-            wsgi.WSGIServer(
-                (self.serve_host, self.serve_port),
+            self.server = wsgi.WSGIServer(
+                listener,
                 app,
-                log=FilelikeLogger(),
+                handler_class=AccessLogHandler,
                 spawn=pool.Pool(10000) # do not accept more than 10000 connections
-            ).serve_forever()
+            )
+            self.server.access_log = self.access_log
+            self.server.serve_forever()
 
-        if self.use_reloader:
+        if self.use_reloader and self.worker is None:
             import werkzeug.serving
             start_serving = werkzeug.serving.run_with_reloader(start_serving)
 
+        # Each worker writes its own records, appending them to the same file
+        self.access_log.start()
         logging.getLogger(__name__).info("before spawning serve")
         serve = gevent.spawn(start_serving)
         logging.getLogger(__name__).info("after spawning serve")
         running.send(self)
         logging.getLogger(__name__).info("running signal sent")
+        if ready_fd is not None:
+            # Tell the master we're serving
+            os.write(ready_fd, '.')
+            os.close(ready_fd)
 
         serve.join()
 
+    # Prefork support
+    def run_master(self):
+        log = logging.getLogger(__name__)
+        # Bound once, before forking, the workers all accept on it
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.serve_host, self.serve_port))
+        listener.listen(1024)
+        listener.setblocking(0)
+        self.listener = listener
+
+        self.worker_pids = {}
+        #: pids of the workers being stopped
+        self.retired = set()
+        self.stopping = False
+        self.hup_watcher = gevent.signal(signal.SIGHUP, self.restart_workers)
+        started = {}
+        for number in range(self.workers):
+            started[number] = time.time()
+            self.spawn_worker(number)
+        log.info("Started %s workers serving on %s:%s", self.workers,
+                 self.serve_host, self.serve_port)
+
+        # Supervise the workers, until they're all stopped
+        while not self.stopping or self.worker_pids:
+            for pid, number, status in self.reap_workers():
+                if pid in self.retired:
+                    self.retired.discard(pid)
+                    continue
+                log.error("Worker %s (pid %s) died with status %s",
+                          number, pid, status)
+                if time.time() - started.get(number, 0) < 1:
+                    # Don't respawn crashing workers in a tight loop
+                    gevent.sleep(1)
+                if not self.stopping:
+                    started[number] = time.time()
+                    self.spawn_worker(number)
+            gevent.sleep(0.5)
+
+    def spawn_worker(self, number):
+        """Forks worker `number` and waits for it to be serving."""
+        log = logging.getLogger(__name__)
+        ready_read, ready_write = os.pipe()
+        pid = gevent.fork()
+        if pid == 0:
+            # The worker. Nothing holding connections, the database engine,
+            # the mail queue, was created on the master, it's all set up from
+            # here on.
+            os.close(ready_read)
+            self.hup_watcher.cancel()
+            self.worker_pids = None
+            self.worker = number
+            status = 0
+            try:
+                self.serve(self.listener, ready_write)
+                # Serving stopped, wait for the shutdown to complete
+                while not getattr(self, 'exited', True):
+                    gevent.sleep(0.1)
+            except BaseException, err:
+                log.exception(err)
+                status = 1
+            # Never run the master's exit handlers, like the pidfile removal
+            os._exit(status)
+
+        os.close(ready_write)
+        self.worker_pids[pid] = number
+        try:
+            socket.wait_read(ready_read, timeout=self.graceful_timeout)
+            log.info("Worker %s (pid %s) serving", number, pid)
+        except socket.timeout:
+            log.warning("Worker %s (pid %s) did not start serving in time",
+                        number, pid)
+        finally:
+            os.close(ready_read)
+        return pid
+
+    def reap_workers(self):
+        """Returns the pid, number and exit status of the workers which
+        exited."""
+        reaped = []
+        while self.worker_pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            number = self.worker_pids.pop(pid, None)
+            if number is not None:
+                reaped.append((pid, number, status))
+        return reaped
+
+    def stop_worker(self, pid):
+        """Gracefully stops the worker `pid`, killing it if it takes too
+        long."""
+        self.retired.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        deadline = time.time() + self.graceful_timeout + 5
+        while pid in self.worker_pids and time.time() < deadline:
+            gevent.sleep(0.1)
+        if pid in self.worker_pids:
+            logging.getLogger(__name__).warning(
+                "Worker %s (pid %s) did not stop in time, killing it",
+                self.worker_pids[pid], pid
+            )
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def restart_workers(self):
+        """Rolling restart of the workers. A new one is started before each
+        of the old ones is stopped, requests keep being served meanwhile."""
+        def restart():
+            logging.getLogger(__name__).info("Restarting workers")
+            for pid, number in sorted(self.worker_pids.items(),
+                                      key=lambda item: item[1]):
+                if self.stopping:
+                    break
+                self.spawn_worker(number)
+                self.stop_worker(pid)
+        gevent.spawn(restart)
+
+    def stop_workers(self):
+        self.stopping = True
+        gevent.joinall([gevent.spawn(self.stop_worker, pid)
+                        for pid in self.worker_pids.keys()])
+        self.listener.close()
+        logging.getLogger(__name__).info("Webserver Daemon Quitting...")
+        self.exited = True
+
     def exit(self):
         self.exited = False
+        if self.worker_pids is not None:
+            # The master
+            logging.getLogger(__name__).info("Stopping the workers...")
+            gevent.spawn(self.stop_workers)
+            return
+
         from ilog.web.application import app
         from ilog.common.signals import undaemonized, shutdown
         logging.getLogger(__name__).info("Webserver Daemon Exiting...")
         def on_web_shutdown(sender):
             logging.getLogger(__name__).info("Webserver Daemon Quitting...")
+            self.access_log.stop()
             undaemonized.send(self)
             self.exited = True
         shutdown.connect(on_web_shutdown)
+        if self.worker is not None:
+            # Finish serving the current requests before shutting down
+            def stop_serving():
+                if self.server is not None:
+                    self.server.stop(timeout=self.graceful_timeout)
+                logging.getLogger(__name__).debug("Shutdown webserver")
+                app.shutdown()
+            gevent.spawn(stop_serving)
+            return
         logging.getLogger(__name__).debug("Shutdown webserver")
         app.shutdown()
 
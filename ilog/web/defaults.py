@@ -41,6 +41,29 @@ CACHE_DEFAULT_TIMEOUT=3600  # One hour
 CACHE_KEY_PREFIX='ilog_'
 CACHE_MEMCACHED_SERVERS=''
 
+# Seconds an account's resolved permissions are cached for. Changes made on
+# any process invalidate them right away, through the cache settings above,
+# unless "null", in which case changes made on other processes don't.
+IDENTITY_CACHE_TIMEOUT=300
+
+# Accounts last login tracking
+LAST_LOGIN_FLUSH_INTERVAL=60    # Seconds between each bulk write
+LAST_LOGIN_GRANULARITY=300      # Seconds before a last login is updated again
+
+# Cache of the past days' log pages shown to anonymous visitors. None
+# disables it, "disk" stores them on LOG_PAGE_CACHE_DIR, by default "cache/pages"
+# on the working directory, and "cache" through the above cache settings.
+LOG_PAGE_CACHE=None
+LOG_PAGE_CACHE_DIR=None
+LOG_PAGE_CACHE_TIMEOUT=604800   # Seconds pages are kept by the "cache" backend
+LOG_PAGE_CACHE_GRACE=3600       # Seconds after a day is over before it's cached
+
+
+# Responses compression. Static files are served from their precompressed
+# copies, written by "python setup.py compress_static", when up to date.
+COMPRESS_RESPONSES=True
+COMPRESS_MIN_SIZE=500           # Smaller responses are sent uncompressed
+COMPRESS_LEVEL=6                # gzip compression level, 1 to 9
 
 # Former RPXNow, now Janrain Settings
 JANRAIN_API_KEY = ''
@@ -58,6 +81,33 @@ DEFAULT_MAIL_SENDER=''
 MAIL_SUPPRESS_SEND=False
 MAIL_FAIL_SILENTLY=True
 DEFAULT_MAX_EMAILS=None
+# Number of messages sent at the same time, each over its own connection
+MAIL_WORKERS=4
+# Seconds a connection to the SMTP server is kept open waiting for messages
+MAIL_IDLE_TIMEOUT=10
+# Seconds sending a message can take
+MAIL_SEND_TIMEOUT=30
+# Failed messages are retried after MAIL_RETRY_DELAY seconds, twice as long
+# on each attempt up to MAIL_MAX_RETRY_DELAY, and given up on after
+# MAIL_MAX_ATTEMPTS attempts.
+MAIL_RETRY_DELAY=60
+MAIL_MAX_RETRY_DELAY=3600
+MAIL_MAX_ATTEMPTS=8
+# Directory of the spool of unsent messages. Defaults to "spool/mail" under
+# the daemon's working directory.
+MAIL_SPOOL_DIR=None
+# Wait for each queued message to be written to disk
+MAIL_SPOOL_SYNC=True
+
+# IRC server probes, run when adding networks and channels. Results are kept
+# for PROBE_CACHE_TIMEOUT seconds, PROBE_FAILURE_CACHE_TIMEOUT if failed,
+# through the cache settings above. With the "null" cache and several workers
+# they're shared on PROBE_CACHE_DIR, by default "cache/probes" on the working
+# directory.
+PROBE_TIMEOUT=30
+PROBE_CACHE_TIMEOUT=600
+PROBE_FAILURE_CACHE_TIMEOUT=30
+PROBE_CACHE_DIR=None
 
 # WTForms Settings
 CSRF_ENABLED=True
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.lastlogin
+    ~~~~~~~~~~~~~~~~~~
+
+    Write-behind tracking of the accounts' last login.
+
+    Instead of updating the account's row on every authenticated request,
+    the time an account was last seen is kept in memory and all of them are
+    written in one bulk ``UPDATE`` every :attr:`LastLoginTracker.interval`
+    seconds. An account seen again within
+    :attr:`LastLoginTracker.granularity` seconds of its last recorded time
+    is not written again.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import gevent
+from datetime import datetime, timedelta
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.database import dbm
+from ilog.web.signals import webapp_setup_complete, webapp_shutdown
+
+log = logging.getLogger(__name__)
+
+
+class LastLoginTracker(ComponentBase):
+
+    #: seconds between each write of the pending last logins
+    interval = 60
+    #: seconds an account's recorded last login is considered current
+    granularity = 300
+
+    def activate(self):
+        #: account id -> last login waiting to be written
+        self.pending = {}
+        #: account id -> last login written or pending
+        self.recorded = {}
+        self.timer = None
+
+    def connect_signals(self):
+        webapp_setup_complete.connect(self.on_webapp_setup_complete)
+        webapp_shutdown.connect(self.on_webapp_shutdown)
+
+    def on_webapp_setup_complete(self, app):
+        self.interval = app.config.get('LAST_LOGIN_FLUSH_INTERVAL',
+                                       self.interval)
+        self.granularity = app.config.get('LAST_LOGIN_GRANULARITY',
+                                          self.granularity)
+        if self.timer is None:
+            self.timer = gevent.spawn(self.flush_periodically)
+
+    def on_webapp_shutdown(self, app):
+        if self.timer is not None:
+            self.timer.kill()
+            self.timer = None
+        self.flush()
+
+    def touch(self, account_id, stamp=None):
+        """Record that `account_id` was just seen."""
+        if stamp is None:
+            stamp = datetime.utcnow()
+        recorded = self.recorded.get(account_id)
+        if recorded is not None and \
+                stamp - recorded < timedelta(seconds=self.granularity):
+            return
+        self.recorded[account_id] = self.pending[account_id] = stamp
+
+    def flush_periodically(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        # Forget what's too old to prevent further writes anyway
+        expired = datetime.utcnow() - timedelta(seconds=self.granularity)
+        for account_id, stamp in self.recorded.items():
+            if stamp < expired:
+                del self.recorded[account_id]
+
+        if not self.pending or dbm.database_engine is None:
+            return
+        pending, self.pending = self.pending, {}
+
+        from ilog.database.models import Account
+        accounts = Account.__table__
+        try:
+            dbm.database_engine.execute(
+                accounts.update().where(
+                    accounts.c.id==dbm.bindparam('account_id')
+                ).values(last_login=dbm.bindparam('stamp')),
+                [{'account_id': account_id, 'stamp': stamp}
+                 for account_id, stamp in pending.iteritems()]
+            )
+        except Exception, err:
+            log.exception(err)
+            # Retry on the next flush, unless seen again meanwhile
+            for account_id, stamp in pending.iteritems():
+                self.pending.setdefault(account_id, stamp)
+            return
+        log.trace("Updated the last login of %s accounts", len(pending))
+
+last_logins = LastLoginTracker(component_manager)
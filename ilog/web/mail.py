@@ -3,25 +3,60 @@
     ilog.web.mail
     ~~~~~~~~~~~~~
 
+    Messages are sent in the background by up to :attr:`EMailManager.workers`
+    senders at the same time. Each sender keeps its connection to the SMTP
+    server open while there are messages to send and, when the server
+    supports it, pipelines the commands of each message, waiting for the
+    server once per message instead of once per command.
+
+    Queued messages are kept on a :class:`~ilog.web.mailspool.MailSpool`
+    until they're sent, those not sent by a process which stopped are sent
+    by the next one starting up.
+
+    Messages failing to be sent are retried, each time waiting twice as long,
+    up to :attr:`EMailManager.max_attempts` times. While the SMTP server, or
+    the recipients' domain, is failing nothing else is sent to it.
+
+    Running this module benchmarks the delivery against a local stand-in
+    SMTP server::
+
+        python -m ilog.web.mail --messages 2000 --latency 0.005
+
 
     :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
     :license: BSD, see LICENSE for more details.
 """
 
 import os
+import glob
+import time
+import heapq
+import random
+import socket
 import cPickle
 import logging
+import smtplib
+import itertools
 import gevent
+from collections import deque
 from datetime import datetime
+from gevent.event import Event
 from gevent.pool import Pool
-from gevent.queue import Empty, JoinableQueue, PriorityQueue, Queue
+from gevent.queue import Empty, PriorityQueue
 from flaskext.mail import Mail, Message as BaseMessage, email_dispatched
 from ilog.common import component_manager
 from ilog.common.interfaces import ComponentBase
+from ilog.web.mailspool import MailSpool
 from ilog.web.signals import webapp_setup_complete, webapp_shutdown
 
 log = logging.getLogger(__name__)
 
+#: priority of the messages someone is waiting for, like confirmations
+HIGH_PRIORITY = 10
+NORMAL_PRIORITY = 0
+#: priority of bulk messages, like notifications
+LOW_PRIORITY = -10
+
 class SendMessageTimeout(Exception):
     """Exception raised when sending a message takes too long."""
 
@@ -34,15 +69,167 @@ class Message(BaseMessage):
         ).strip()
         return response
 
+class SMTPConnection(object):
+    """A connection to the SMTP server, reused for many messages.
+
+    :param mail: the :class:`~flaskext.mail.Mail` instance holding the SMTP
+                 server settings
+    """
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.connection = mail.connect()
+        self.host = None
+        self.pipelining = False
+        self.num_emails = 0
+
+    @property
+    def connected(self):
+        return self.host is not None or self.mail.suppress
+
+    def open(self):
+        if self.mail.suppress:
+            return
+        self.host = self.connection.configure_host()
+        if self.host is None:
+            # Failing silently is for the senders, there's no one waiting
+            # here, the message is kept
+            raise socket.error("Failed to connect to the SMTP server %s:%s" %
+                               (self.mail.server, self.mail.port))
+        self.host.ehlo_or_helo_if_needed()
+        self.pipelining = self.host.has_extn('pipelining')
+        self.num_emails = 0
+
+    def close(self):
+        host, self.host = self.host, None
+        if host is None:
+            return
+        try:
+            host.quit()
+        except (socket.error, smtplib.SMTPException):
+            host.close()
+
+    def send(self, message):
+        if not self.connected:
+            self.open()
+        if self.host is not None:
+            if self.pipelining:
+                self.send_pipelined(message)
+            else:
+                self.host.sendmail(message.sender, message.send_to,
+                                   str(message.get_response()))
+        email_dispatched.send(message, app=self.mail.app)
+        self.num_emails += 1
+        if self.num_emails == self.connection.max_emails:
+            # Start over on a new connection
+            self.close()
+
+    def send_pipelined(self, message):
+        """Sends `message` as :rfc:`2920` allows, the envelope commands all
+        at once, then the message data."""
+        host = self.host
+        recipients = list(message.send_to)
+        commands = ['mail FROM:%s' % smtplib.quoteaddr(message.sender)] + [
+            'rcpt TO:%s' % smtplib.quoteaddr(recipient)
+            for recipient in recipients
+        ] + ['data']
+        host.send(''.join(command + smtplib.CRLF for command in commands))
+        replies = [host.getreply() for command in commands]
+
+        sender_reply, data_reply = replies[0], replies[-1]
+        refused = dict(
+            (recipient, reply) for recipient, reply in
+            zip(recipients, replies[1:-1]) if reply[0] not in (250, 251)
+        )
+        if sender_reply[0] != 250 or len(refused) == len(recipients):
+            if data_reply[0] == 354:
+                # Nothing to deliver, end the data right away
+                host.send('.' + smtplib.CRLF)
+                host.getreply()
+            host.rset()
+            if sender_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(sender_reply[0],
+                                                sender_reply[1],
+                                                message.sender)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            host.rset()
+            raise smtplib.SMTPDataError(*data_reply)
+
+        data = smtplib.quotedata(str(message.get_response()))
+        if data[-2:] != smtplib.CRLF:
+            data += smtplib.CRLF
+        host.send(data + '.' + smtplib.CRLF)
+        code, response = host.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+
+class QueuedMessage(object):
+    """A message waiting to be sent. Messages are sent by priority, then in
+    the order queued."""
+
+    __slots__ = ('priority', 'sequence', 'spool_id', 'message', 'attempts')
+
+    def __init__(self, priority, sequence, spool_id, message):
+        self.priority = priority
+        self.sequence = sequence
+        self.spool_id = spool_id
+        self.message = message
+        self.attempts = 0
+
+    def __cmp__(self, other):
+        return cmp((-self.priority, self.sequence),
+                   (-other.priority, other.sequence))
+
+    @property
+    def domains(self):
+        return set(address.rsplit('@', 1)[-1].lower()
+                   for address in self.message.send_to)
+
+
 class EMailManager(ComponentBase):
 
+    #: the backup of the unsent messages of previous versions
     unsent_emails_pickle = 'unsent-emails.pickle'
 
+    #: number of messages sent at the same time, each over its own connection
+    workers = 4
+    #: seconds a sender keeps its connection open waiting for messages
+    idle_timeout = 10
+    #: seconds sending a message can take
+    send_timeout = 30
+    #: number of queued messages over which no more are read from the spool
+    replay_batch = 100
+    #: seconds before the first retry of a message, doubled on each attempt
+    retry_delay = 60
+    #: maximum seconds between two attempts
+    max_retry_delay = 3600
+    #: attempts after which a message is given up on
+    max_attempts = 8
+
     def activate(self):
         self.pool = Pool()
-        self.m_queue = JoinableQueue()
-        self.e_queue = Queue()
-        self.processing = self.q_message = None
+        #: queue of :class:`QueuedMessage`
+        self.m_queue = PriorityQueue()
+        self.senders = Pool(self.workers)
+        self.spool = None
+        self.sequence = itertools.count()
+        #: sender -> :class:`QueuedMessage` it's sending
+        self.sending = {}
+        #: number of senders waiting for messages
+        self.idle = 0
+        #: heap of ``(time, sequence, queued message)`` to send again
+        self.retries = []
+        self.retrier = None
+        self.retry_wakeup = Event()
+        #: recipients' domain, or `None` for the SMTP server itself ->
+        #: ``(failures, time before which nothing is sent to it)``
+        self.backoffs = {}
+        #: the last messages given up on, and why
+        self.dead_letters = deque(maxlen=100)
+        self.totals = {'sent': 0, 'retried': 0, 'dead_lettered': 0}
 
     def connect_signals(self):
         email_dispatched.connect(self.on_email_dispatched)
@@ -51,109 +238,355 @@ class EMailManager(ComponentBase):
 
     def on_email_dispatched(self, message, app):
         log.trace("Email dispatched... %s", message)
-        self.q_message = None
 
     def on_webapp_setup_complete(self, app):
         self.smtp = Mail(app)
+        self.workers = app.config.get('MAIL_WORKERS', self.workers)
+        self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT',
+                                           self.idle_timeout)
+        self.send_timeout = app.config.get('MAIL_SEND_TIMEOUT',
+                                           self.send_timeout)
+        self.retry_delay = app.config.get('MAIL_RETRY_DELAY',
+                                          self.retry_delay)
+        self.max_retry_delay = app.config.get('MAIL_MAX_RETRY_DELAY',
+                                              self.max_retry_delay)
+        self.max_attempts = app.config.get('MAIL_MAX_ATTEMPTS',
+                                           self.max_attempts)
+        self.senders = Pool(self.workers)
+        self.spool = MailSpool(
+            app.config.get('MAIL_SPOOL_DIR') or
+                os.path.join(app.working_directory, 'spool', 'mail'),
+            sync=app.config.get('MAIL_SPOOL_SYNC', True)
+        )
+        self.spool.open()
+        self.pool.spawn(self.replay_spool)
         self.load_unsent_messages()
 
+    def replay_spool(self):
+        """Queues the unsent messages of stopped processes, a few at a
+        time."""
+        for spool_id, priority, message in self.spool.claim():
+            while self.m_queue.qsize() >= self.replay_batch:
+                gevent.sleep(1)
+            self.enqueue(QueuedMessage(priority, self.sequence.next(),
+                                       spool_id, message))
+
     def load_unsent_messages(self):
+        # The unsent emails saved by previous versions are moved to the
+        # spool. Claim them by renaming them first, since several web
+        # workers might be loading them.
+        base, ext = os.path.splitext(self.unsent_emails_pickle)
+        claimed = '%s.loading-%d' % (base, os.getpid())
+        for filename in glob.glob(base + '*' + ext):
+            try:
+                os.rename(filename, claimed)
+            except OSError:
+                # Claimed by another process
+                continue
+            try:
+                unsent_emails = cPickle.load(open(claimed, 'rb'))
+                log.debug("Loaded %s unsent emails from file backup",
+                          len(unsent_emails))
+                for message in unsent_emails:
+                    self.send(message)
+            except Exception, err:
+                log.exception(err)
+
+            try:
+                os.unlink(claimed)
+            except OSError:
+                pass
+            except Exception, err:
+                log.exception(err)
+
+    def on_webapp_shutdown(self, app):
+        # What the senders were sending is still on the spool
+        self.senders.kill()
+        if self.retrier is not None:
+            self.retrier.kill()
+        if self.spool is not None:
+            unsent = self.m_queue.qsize() + len(self.retries) + \
+                                                            len(self.sending)
+            if unsent:
+                log.warning("%s unsent messages are kept on the spool",
+                            unsent)
+            self.spool.close()
+
+    def get_counters(self):
+        """Returns how many messages are queued, waiting to be retried and
+        being sent, and how many were sent, retried and given up on."""
+        counters = {'queued': self.m_queue.qsize(),
+                    'scheduled': len(self.retries),
+                    'in_flight': len(self.sending)}
+        counters.update(self.totals)
+        return counters
+
+    def schedule_processing(self):
+        # Another sender when the idle ones won't take all the messages
+        if self.m_queue.qsize() > self.idle and not self.senders.full():
+            self.senders.spawn(self.process_messages)
+
+    def send(self, message, priority=NORMAL_PRIORITY):
+        """Queues `message`. Those with a higher `priority`, like
+        :data:`HIGH_PRIORITY`, are sent first."""
         try:
-            unsent_emails = cPickle.load(open(self.unsent_emails_pickle, 'rb'))
-            log.debug("Loaded %s unsent emails from file backup",
-                      len(unsent_emails))
-            for message in unsent_emails:
-                self.pool.spawn(self.send, message)
-        except IOError:
-            # File does not exist
-            pass
+            spool_id = self.spool.append(message, priority)
         except Exception, err:
+            # Still worth trying to send it
             log.exception(err)
+            spool_id = None
+        self.enqueue(QueuedMessage(priority, self.sequence.next(), spool_id,
+                                   message))
+
+    def enqueue(self, queued):
+        self.m_queue.put(queued, block=False)
+        self.schedule_processing()
 
+    def process_messages(self):
+        """Sends the queued messages over a single connection, until there
+        are none for :attr:`idle_timeout` seconds."""
+        sender = gevent.getcurrent()
+        connection = SMTPConnection(self.smtp)
+        try:
+            while True:
+                log.trace("Messages waiting to be sent: %s",
+                          self.m_queue.qsize())
+                self.idle += 1
+                try:
+                    queued = self.m_queue.get(timeout=self.idle_timeout)
+                except Empty:
+                    # No messages waiting to be sent
+                    break
+                finally:
+                    self.idle -= 1
+                self.sending[sender] = queued
+                try:
+                    self.send_message(connection, queued)
+                finally:
+                    del self.sending[sender]
+        finally:
+            connection.close()
+
+    def send_message(self, connection, queued):
+        backoff = self.get_backoff(queued)
+        if backoff > time.time():
+            # The server, or the recipients' domain, is failing. Don't insist.
+            self.schedule_retry(queued, backoff)
+            return
+
+        message = queued.message
+        log.debug("Sending message to \"%s\"", ", ".join(message.send_to))
+        queued.attempts += 1
+        timeout = gevent.Timeout(self.send_timeout, SendMessageTimeout())
+        timeout.start()
         try:
-            os.unlink(self.unsent_emails_pickle)
-        except OSError:
-            pass
+            connection.send(message)
+        except SendMessageTimeout, err:
+            log.debug("Sending message took too long.")
+            # Whatever the server got, start over on a new connection
+            connection.close()
+            self.failed(queued, err)
         except Exception, err:
-            log.exception(err)
+            if not isinstance(err, (smtplib.SMTPResponseException,
+                                    smtplib.SMTPRecipientsRefused)):
+                # Not a refusal, the connection might be unusable
+                connection.close()
+            self.failed(queued, err)
+        else:
+            self.spool.acknowledge(queued.spool_id)
+            self.totals['sent'] += 1
+            for key in [None] + list(queued.domains):
+                self.backoffs.pop(key, None)
+        finally:
+            timeout.cancel()
 
-    def save_unsent_messages(self):
-        unsent_messages = []
-        if self.q_message:
-            unsent_messages.append(self.q_message)
+    # Retries
+    def failed(self, queued, err):
+        """Schedules `queued` to be sent again, unless the failure, `err`, is
+        permanent or it was attempted too many times already."""
+        permanent, keys = self.classify_failure(queued, err)
+        if permanent or queued.attempts >= self.max_attempts:
+            log.error("Giving up on the message to \"%s\" after %s "
+                      "attempts: %s", ", ".join(queued.message.send_to),
+                      queued.attempts, err)
+            self.dead_letters.append((err, queued.message))
+            self.totals['dead_lettered'] += 1
+            self.spool.acknowledge(queued.spool_id)
+            return
 
-        while True:
-            try:
-                message = self.m_queue.get(block=False)
-                unsent_messages.append(message)
-            except Empty:
-                break
+        log.warning("Failed to send the message to \"%s\", attempt %s: %s",
+                    ", ".join(queued.message.send_to), queued.attempts, err)
+        now = time.time()
+        for key in keys:
+            failures, until = self.backoffs.get(key, (0, 0))
+            if until <= now:
+                # Only backs off further once the previous delay is over,
+                # not for each of the messages failing meanwhile
+                self.backoffs[key] = (failures + 1,
+                                      now + self.get_delay(failures + 1))
+        self.totals['retried'] += 1
+        self.schedule_retry(queued, max(now + self.get_delay(queued.attempts),
+                                        self.get_backoff(queued)))
 
-        # Error messages are going to be saved too
-        while True:
-            try:
-                err, priority, message = self.e_queue.get(block=False)
-                unsent_messages.append(message)
-            except Empty:
-                break
+    def classify_failure(self, queued, err):
+        """Returns whether the failure, `err`, is permanent and, if not, what
+        to back off from, the recipients' domains or, `None`, the server."""
+        if isinstance(err, smtplib.SMTPRecipientsRefused):
+            temporary = [address for address, (code, response) in
+                         err.recipients.iteritems() if code < 500]
+            return not temporary, set(address.rsplit('@', 1)[-1].lower()
+                                      for address in temporary)
+        elif isinstance(err, (smtplib.SMTPConnectError,
+                              smtplib.SMTPHeloError,
+                              smtplib.SMTPAuthenticationError)):
+            return False, [None]
+        elif isinstance(err, smtplib.SMTPResponseException):
+            return err.smtp_code >= 500, queued.domains
+        elif isinstance(err, (socket.error, smtplib.SMTPException,
+                              SendMessageTimeout)):
+            return False, [None]
+        # Building the message failed, it will again
+        return True, []
 
-        if unsent_messages:
-            log.debug("Saving %s unsent emails to backup file.",
-                      len(unsent_messages))
+    def get_delay(self, attempts):
+        """Seconds to wait after `attempts` failed, jittered so that messages
+        failing together aren't all retried together."""
+        delay = min(self.max_retry_delay,
+                    self.retry_delay * 2 ** min(attempts - 1, 16))
+        return delay * random.uniform(0.5, 1)
 
-            unsent_emails_pickle = open(self.unsent_emails_pickle, 'wb')
-            cPickle.dump(unsent_messages, unsent_emails_pickle)
-            unsent_emails_pickle.close()
+    def get_backoff(self, queued):
+        """Returns the time before which `queued` shouldn't be sent."""
+        return max([self.backoffs.get(key, (0, 0))[1]
+                    for key in [None] + list(queued.domains)])
 
-    def on_webapp_shutdown(self, app):
-        log.warning("Waiting to send all messages before shutting down!!!")
-        self.save_unsent_messages()
+    def schedule_retry(self, queued, when):
+        heapq.heappush(self.retries, (when, queued.sequence, queued))
+        if self.retrier is None:
+            self.retrier = self.pool.spawn(self.process_retries)
+        elif self.retries[0][2] is queued:
+            # Due before what the retrier is waiting for
+            self.retry_wakeup.set()
 
-    def schedule_processing(self):
-        def reset_processing(gt):
-            self.processing = None
+    def process_retries(self):
+        try:
+            while self.retries:
+                self.retry_wakeup.clear()
+                delay = self.retries[0][0] - time.time()
+                if delay > 0:
+                    self.retry_wakeup.wait(delay)
+                    continue
+                when, sequence, queued = heapq.heappop(self.retries)
+                self.enqueue(queued)
+        finally:
+            self.retrier = None
 
-        if self.processing is None:
-            self.processing = self.pool.spawn(self.process_messages)
-            self.processing.link(reset_processing)
+mail = EMailManager(component_manager)
 
-    def send(self, message, priority=0):
-        self.m_queue.put(message, block=False)
-        self.schedule_processing()
 
-    def process_messages(self):
-        while True:
-            if self.q_message:
-                # There's a message being processed
-                break
+if __name__ == '__main__':
+    # Delivery benchmark. Sends messages to a local stand-in SMTP server,
+    # which answers each batch of commands after `latency` seconds as a
+    # remote one would, over a new connection per message, as previously
+    # done, and with the senders. Reports the messages sent per second.
+    from gevent import monkey
+    monkey.patch_all()
+    import shutil
+    import tempfile
+    from flask import Flask
+    from gevent.server import StreamServer
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-n', '--messages', default=1000, type="int",
+                      help="Number of messages to send. Default: %default")
+    parser.add_option('-w', '--workers', default=8, type="int",
+                      help="Number of senders. Default: %default")
+    parser.add_option('-l', '--latency', default=0.002, type="float",
+                      help="Seconds the server takes to answer. "
+                           "Default: %default")
+    parser.add_option('--no-pipelining', default=True, dest='pipelining',
+                      action="store_false",
+                      help="The server does not support pipelining")
+    (options, args) = parser.parse_args()
+    # The trace level is added to the loggers by the daemons
+    log.trace = lambda *args, **kwargs: None
 
-            log.trace("Messages waiting to be sent: %s", self.m_queue.qsize())
-            timeout = gevent.Timeout(5, SendMessageTimeout())
-            try:
-                self.q_message = self.m_queue.get(block=False)
-                log.debug("Sending message to \"%s\"",
-                          ", ".join(self.q_message.send_to))
-                self.smtp.send(self.q_message)
-                self.m_queue.task_done()
-                self.q_message = None
-                # Allow other things to run
-                gevent.sleep(0)
-            except SendMessageTimeout:
-                log.debug("Sending message took too long. Requeing.")
-                self.m_queue.task_done()
-                self.m_queue.put(self.q_message, block=False)
-                self.q_message = None
-            except Empty:
-                # No messages waiting to be sent. In case we're waiting for all
-                # messages to be send before shuting down, state that we're
-                # ready to be shutdown
+    received = [0]
+    def handle(sock, address):
+        sock.sendall('220 localhost ESMTP stand-in\r\n')
+        buffered, in_data, quit = '', False, False
+        while not quit:
+            chunk = sock.recv(65536)
+            if not chunk:
                 break
-            except Exception, err:
-                log.exception(err)
-                self.m_queue.task_done()
-                self.e_queue.put((err, self.q_message), block=False)
-                self.q_message = None
-            finally:
-                timeout.cancel()
+            lines = (buffered + chunk).split('\r\n')
+            buffered = lines.pop()
+            replies = []
+            for line in lines:
+                if in_data:
+                    if line == '.':
+                        in_data = False
+                        received[0] += 1
+                        replies.append('250 Ok')
+                    continue
+                command = line[:4].upper()
+                if command == 'EHLO':
+                    replies.extend(['250-localhost', options.pipelining and
+                                    '250 PIPELINING' or '250 8BITMIME'])
+                elif command == 'DATA':
+                    in_data = True
+                    replies.append('354 End data with <CR><LF>.<CR><LF>')
+                elif command == 'QUIT':
+                    quit = True
+                    replies.append('221 Bye')
+                else:
+                    replies.append('250 Ok')
+            if replies:
+                gevent.sleep(options.latency)
+                sock.sendall(''.join(reply + '\r\n' for reply in replies))
+        sock.close()
 
-mail = EMailManager(component_manager)
+    server = StreamServer(('127.0.0.1', 0), handle)
+    server.start()
+    app = Flask(__name__)
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.server_port)
+
+    def make_messages():
+        return [Message('Benchmark %d' % idx, sender='ilog@localhost',
+                        recipients=['user%d@localhost' % idx],
+                        body='Hello World!\n' * 20)
+                for idx in xrange(options.messages)]
+
+    def report(name, start):
+        elapsed = time.time() - start
+        print "%-28s %6d messages in %6.2f secs, %8.1f messages/s" % (
+            name, received[0], elapsed, received[0] / elapsed
+        )
+        received[0] = 0
+
+    messages = make_messages()
+    smtp = Mail(app)
+    start = time.time()
+    for message in messages:
+        smtp.send(message)
+    report("Connection per message:", start)
+
+    spool_directory = tempfile.mkdtemp()
+    for workers in sorted(set([1, options.workers])):
+        mail.activate()
+        mail.smtp = smtp
+        mail.senders = Pool(workers)
+        mail.spool = MailSpool(spool_directory)
+        mail.spool.open()
+        messages = make_messages()
+        start = time.time()
+        for message in messages:
+            mail.send(message)
+        while mail.totals['sent'] + mail.totals['dead_lettered'] < \
+                                                            options.messages:
+            gevent.sleep(0.01)
+        report("%d sender(s):" % workers, start)
+        mail.senders.kill()
+        mail.spool.close()
+    shutil.rmtree(spool_directory)
+    server.stop()
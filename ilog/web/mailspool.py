@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.mailspool
+    ~~~~~~~~~~~~~~~~~~
+
+    On disk spool of the messages waiting to be sent.
+
+    Each message is appended to the spool when it's queued and an
+    acknowledgement of it is appended once it's sent, nothing is ever
+    rewritten. The spool is made of segment files, each written by a single
+    process, which holds a lock on it. Once a segment is over
+    :attr:`MailSpool.segment_size` bytes a new one is started, and it's
+    removed when all of its messages were sent.
+
+    When a process stops, cleanly or not, the lock on its segments is
+    released and the messages on them which weren't acknowledged are
+    claimed, and read one at a time, by the next process starting up.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import time
+import zlib
+import errno
+import fcntl
+import struct
+import cPickle
+import logging
+import gevent
+
+log = logging.getLogger(__name__)
+
+#: record kind, payload length and checksum
+HEADER = struct.Struct('!cII')
+OFFSET = struct.Struct('!Q')
+
+MESSAGE = 'M'
+ACKNOWLEDGED = 'A'
+
+
+def read_records(filename):
+    """Yields the offset, kind and payload of the records of the segment
+    `filename`, up to the first one not completely written."""
+    segment = open(filename, 'rb')
+    try:
+        offset = 0
+        while True:
+            header = segment.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            kind, length, checksum = HEADER.unpack(header)
+            payload = segment.read(length)
+            if len(payload) < length or \
+                            zlib.crc32(payload) & 0xffffffff != checksum:
+                log.warning("Mail spool segment %s is truncated at %s",
+                            filename, offset)
+                break
+            yield offset, kind, payload
+            offset += HEADER.size + length
+    finally:
+        segment.close()
+
+
+class Segment(object):
+
+    def __init__(self, path, fd, size=0, pending=0):
+        self.path = path
+        self.fd = fd
+        self.size = size
+        #: number of messages not acknowledged
+        self.pending = pending
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def write(self, kind, payload, sync=False):
+        record = HEADER.pack(kind, len(payload),
+                             zlib.crc32(payload) & 0xffffffff) + payload
+        offset = self.size
+        os.write(self.fd, record)
+        self.size += len(record)
+        if sync:
+            # Don't block the other greenlets on the disk
+            gevent.get_hub().threadpool.apply(os.fsync, (self.fd,))
+        return offset
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                log.exception(err)
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MailSpool(object):
+    """The spool of messages on `directory`.
+
+    :param directory: the directory the segments are written to
+    :param segment_size: size in bytes after which a new segment is started
+    :param sync: wait for the messages to be on disk before they're queued
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, sync=True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        #: segment name -> :class:`Segment`, those written or claimed by
+        #: this process
+        self.segments = {}
+        self.current = None
+        self.sequence = 0
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self.rotate()
+
+    def close(self):
+        """Closes the segments, the messages not acknowledged are kept on
+        them."""
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+        self.current = None
+
+    def rotate(self):
+        previous = self.current
+        self.sequence += 1
+        path = os.path.join(self.directory, '%d-%d-%d.spool' % (
+            time.time() * 1000, os.getpid(), self.sequence
+        ))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.current = self.segments[os.path.basename(path)] = \
+                                                            Segment(path, fd)
+        if previous is not None and previous.pending == 0:
+            self.remove(previous)
+
+    def remove(self, segment):
+        log.debug("Removing mail spool segment %s", segment.name)
+        self.segments.pop(segment.name, None)
+        segment.remove()
+
+    def append(self, message, priority=0):
+        """Writes `message`, sent with `priority`, to the spool and returns
+        its id, to acknowledge it with."""
+        if self.current.size >= self.segment_size:
+            self.rotate()
+        segment = self.current
+        offset = segment.write(MESSAGE, cPickle.dumps((priority, message), 2),
+                               self.sync)
+        segment.pending += 1
+        return segment.name, offset
+
+    def acknowledge(self, spool_id):
+        """Marks the message `spool_id` as sent."""
+        if spool_id is None:
+            return
+        name, offset = spool_id
+        segment = self.segments.get(name)
+        if segment is None or segment.fd is None:
+            return
+        segment.pending -= 1
+        if segment.pending <= 0 and segment is not self.current:
+            # Nothing left on it
+            self.remove(segment)
+        else:
+            # Losing it to a crash only means sending the message twice
+            segment.write(ACKNOWLEDGED, OFFSET.pack(offset))
+
+    def claim(self):
+        """Yields the id, priority and message of each message not
+        acknowledged on the segments left by stopped processes."""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.spool') or name in self.segments:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            except OSError:
+                # Removed meanwhile
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Still being written, or claimed by another process
+                os.close(fd)
+                continue
+            if os.fstat(fd).st_nlink == 0:
+                # Completely replayed by another process meanwhile
+                os.close(fd)
+                continue
+            for spool_id, priority, message in self.replay(path, fd):
+                yield spool_id, priority, message
+
+    def replay(self, path, fd):
+        messages, acknowledged, size = 0, set(), 0
+        for offset, kind, payload in read_records(path):
+            if kind == MESSAGE:
+                messages += 1
+            elif kind == ACKNOWLEDGED:
+                acknowledged.add(OFFSET.unpack(payload)[0])
+            size = offset + HEADER.size + len(payload)
+        # Whatever follows the last complete record is garbage
+        os.ftruncate(fd, size)
+        segment = Segment(path, fd, size, messages - len(acknowledged))
+        if segment.pending <= 0:
+            segment.remove()
+            return
+        log.info("Claimed %s unsent messages from mail spool segment %s",
+                 segment.pending, segment.name)
+        self.segments[segment.name] = segment
+
+        for offset, kind, payload in read_records(path):
+            if kind != MESSAGE or offset in acknowledged:
+                continue
+            spool_id = (segment.name, offset)
+            try:
+                priority, message = cPickle.loads(payload)
+            except Exception, err:
+                log.exception(err)
+                self.acknowledge(spool_id)
+                continue
+            yield spool_id, priority, message
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.pagecache
+    ~~~~~~~~~~~~~~~~~~
+
+    Cache of the rendered log pages of past days.
+
+    Once a day is over, and :attr:`PageCache.grace` seconds passed for late
+    events to arrive, a channel's log page for that day rarely changes. The
+    page rendered for anonymous visitors is stored, per locale, timezone and
+    theme, and served from then on without reading the day's events.
+
+    What changes regardless, the links to the neighbouring days and the
+    totals on the header, is left out of the stored page as placeholders,
+    filled on each request. The page is stored along with the day's index
+    entry, last event id and count, and rendered again if the entry changed,
+    because of events written late, or is gone, because the day was dropped
+    for retention, both written by the logging core.
+
+    Pages are stored on a local directory, ``LOG_PAGE_CACHE = 'disk'``, or
+    through the configured :mod:`flaskext.cache` backend,
+    ``LOG_PAGE_CACHE = 'cache'``. They're also invalidated when events,
+    channels or networks are changed or removed through the web application.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import re
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from flask import request, session, Markup
+from flaskext.babel import get_locale, get_timezone
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.database.signals import models_committed
+from ilog.web.signals import webapp_setup_complete
+
+log = logging.getLogger(__name__)
+
+_safe_slug_re = re.compile(r'^[\w-]+$')
+
+BACKENDS = (None, 'disk', 'cache')
+
+#: stands for what changes after the page is stored, filled on each request
+PLACEHOLDER = '<!--ilog-page-cache:%s-->'
+
+
+class PageCache(ComponentBase):
+
+    #: one of :data:`BACKENDS`. `None` disables the cache.
+    backend = None
+    #: the directory pages are stored on by the ``disk`` backend
+    directory = None
+    #: seconds pages are kept by the ``cache`` backend
+    timeout = 7 * 24 * 3600
+    #: seconds after a day is over before its page is cached
+    grace = 3600
+
+    # ComponentBase methods
+    def activate(self):
+        self.cache = None
+
+    def connect_signals(self):
+        webapp_setup_complete.connect(self.on_webapp_setup_complete)
+        models_committed.connect(self.on_models_committed)
+
+    def on_webapp_setup_complete(self, app):
+        from ilog.web.application import cache
+        self.backend = app.config.get('LOG_PAGE_CACHE', self.backend)
+        if self.backend not in BACKENDS:
+            raise RuntimeError("Log page cache \"%s\" not supported" %
+                               self.backend)
+        self.directory = app.config.get('LOG_PAGE_CACHE_DIR') or \
+                os.path.join(app.working_directory, 'cache', 'pages')
+        self.timeout = app.config.get('LOG_PAGE_CACHE_TIMEOUT', self.timeout)
+        self.grace = app.config.get('LOG_PAGE_CACHE_GRACE', self.grace)
+        self.cache = cache
+
+    def on_models_committed(self, emitter, changes=()):
+        if self.backend is None:
+            return
+        from ilog.database.models import IRCEvent, Channel, Network
+        for model, operation in changes:
+            if isinstance(model, (Channel, Network)):
+                # Their names and slugs are on every page
+                self.invalidate()
+                return
+            elif isinstance(model, IRCEvent) and operation != 'insert':
+                try:
+                    channel = model.channel
+                    self.invalidate(channel.network.slug, channel.slug,
+                                    model.stamp.date())
+                except Exception, err:
+                    log.debug("Failed to find the page of %r: %s", model, err)
+                    self.invalidate()
+                    return
+
+    # PageCache methods
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def cacheable(self, network, channel, day):
+        """Whether the log page of `channel` on `day` can be cached for the
+        current request."""
+        if self.backend is None or request.method not in ('GET', 'HEAD'):
+            return False
+        if not (_safe_slug_re.match(network) and _safe_slug_re.match(channel)):
+            return False
+        closed = datetime(day.year, day.month, day.day) + \
+                    timedelta(days=1, seconds=self.grace)
+        if closed > datetime.utcnow():
+            return False
+        # The page must not hold anything specific to the visitor
+        return 'uid' not in session and '_flashes' not in session
+
+    def get_variant(self):
+        """Returns the key of what, besides the channel and day, changes the
+        rendered page."""
+        from ilog.web.application import app
+        return hashlib.md5('|'.join([
+            str(get_locale()), str(get_timezone()),
+            app.config.get('THEME_NAME', 'redmond')
+        ])).hexdigest()
+
+    def get_placeholders(self, *names):
+        """Returns the template context standing for `names` on the stored
+        page."""
+        return dict((name, Markup(PLACEHOLDER % name)) for name in names)
+
+    def fill(self, body, **values):
+        """Returns the stored page `body` with its placeholders replaced by
+        `values`."""
+        for name, value in values.iteritems():
+            if not isinstance(value, basestring):
+                value = str(value)
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            body = body.replace(PLACEHOLDER % name, value)
+        return body
+
+    def get(self, network, channel, day, version):
+        """Returns the stored log page of `channel` on `day`, `None` if it's
+        not stored or not of the day's `version`, a string, which is `None`
+        if the day is no longer logged. Outdated pages are discarded."""
+        if self.backend == 'disk':
+            path = self.get_path(network, channel, day)
+            try:
+                cached = open(path, 'rb').read()
+            except IOError:
+                return None
+            cached_version, body = cached.split('\n', 1)
+        else:
+            key = self.get_key(network, channel, day)
+            cached = self.cache.get(key)
+            if cached is None:
+                return None
+            cached_version, body = cached
+        if cached_version == version:
+            return body
+        log.debug("Discarding outdated log page of %s/%s/%s", network,
+                  channel, day)
+        try:
+            if self.backend == 'disk':
+                os.unlink(path)
+            else:
+                self.cache.delete(key)
+        except Exception, err:
+            log.debug("Failed to discard %s/%s/%s: %s", network, channel,
+                      day, err)
+        return None
+
+    def set(self, network, channel, day, version, body):
+        """Stores the rendered log page of `channel` on `day`, of the day's
+        `version`, and returns it encoded."""
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        try:
+            if self.backend == 'disk':
+                self.write(self.get_path(network, channel, day),
+                           '\n'.join([version, body]))
+            else:
+                self.cache.set(self.get_key(network, channel, day),
+                               (version, body), timeout=self.timeout)
+        except Exception, err:
+            log.exception(err)
+        return body
+
+    def invalidate(self, network=None, channel=None, day=None):
+        """Invalidates the cached pages of `channel` on `day`, all of the
+        channel's pages if `day` is `None` or everything if `channel` is
+        `None`."""
+        log.debug("Invalidating cached log pages of %s/%s/%s", network,
+                  channel, day)
+        if self.backend == 'disk':
+            path = self.directory
+            if channel is not None:
+                path = os.path.join(path, network, channel)
+                if day is not None:
+                    path = os.path.join(path, day.strftime('%Y-%m-%d'))
+            try:
+                shutil.rmtree(path)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    log.exception(err)
+        elif self.backend == 'cache':
+            # Keys can't be listed, move on to new ones instead. Never
+            # reusing a generation, even if the previous one expired.
+            if channel is None:
+                key = 'log-pages-generation'
+            else:
+                key = 'log-pages-generation-%s-%s' % (network, channel)
+            self.cache.set(key, int(time.time() * 1000), timeout=self.timeout)
+
+    def get_path(self, network, channel, day):
+        return os.path.join(self.directory, network, channel,
+                            day.strftime('%Y-%m-%d'),
+                            '%s.html' % self.get_variant())
+
+    def get_key(self, network, channel, day):
+        generations = self.cache.get_many(
+            'log-pages-generation',
+            'log-pages-generation-%s-%s' % (network, channel)
+        )
+        return 'log-page-%s-%s-%s-%s-%s-%s' % (
+            network, channel, day.strftime('%Y-%m-%d'), self.get_variant(),
+            generations[0] or 0, generations[1] or 0
+        )
+
+    def write(self, path, contents):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        # Write it aside and move it in place, never serving partial pages
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            temp_file = os.fdopen(fd, 'wb')
+            try:
+                temp_file.write(contents)
+            finally:
+                temp_file.close()
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+page_cache = PageCache(component_manager)
@@ -8,6 +8,7 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import time
 import logging
 from flask import g, session
 from flaskext.babel import _
@@ -16,8 +17,10 @@ from flaskext.wtf import fields, Form, ValidationError
 from sqlalchemy.exc import OperationalError
 from ilog.database import dbm
 from ilog.database.signals import database_setup
-from ilog.database.models import Account, Privilege
-from .application import app
+from ilog.database.models import Account, Group, Privilege
+from ilog.database.signals import models_committed
+from .application import app, cache
+from .lastlogin import last_logins
 from .signals import after_identity_account_loaded
 
 log = logging.getLogger(__name__)
@@ -42,12 +45,110 @@ admin_or_manager_permission = Permission(admin_role, manager_role)
 anonymous_permission = Permission()
 authenticated_permission = Permission(TypeNeed('authenticated'))
 
+_missing = object()
+
+
+class AccountIdentity(Identity):
+    """The identity of a signed in account. The account is only loaded from
+    the database when first accessed."""
+
+    def __init__(self, name, auth_type=None):
+        Identity.__init__(self, name, auth_type)
+        self._account = _missing
+
+    def _get_account(self):
+        if self._account is _missing:
+            self._account = Account.query.get(self.name)
+            if self._account is not None:
+                after_identity_account_loaded.send(app, account=self._account)
+        return self._account
+
+    def _set_account(self, account):
+        self._account = account
+
+    account = property(_get_account, _set_account)
+
+
+class NeedsCache(object):
+    """The needs each account provides, as resolved from its privileges and
+    groups, kept by each process for at most `timeout` seconds.
+
+    They're kept until any of those change, which every process sees through
+    the versions of the account's needs, and of everyone's, kept on the
+    application's cache. Only this process sees the changes with the
+    ``null`` cache backend.
+    """
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+        self.entries = {}
+
+    def get(self, account_id, resolve, timeout=None):
+        """Returns the needs of `account_id`, calling `resolve` for them if
+        they aren't cached or changed since. `None` is returned, and not
+        cached, if `resolve` returns it."""
+        versions = self.get_versions(account_id)
+        entry = self.entries.get(account_id)
+        if entry is not None:
+            needs, expires, cached_versions = entry
+            if expires >= time.time() and cached_versions == versions:
+                return needs
+            self.entries.pop(account_id, None)
+        needs = resolve()
+        if needs is not None:
+            if timeout is None:
+                timeout = self.timeout
+            self.entries[account_id] = (needs, time.time() + timeout,
+                                        versions)
+        return needs
+
+    def get_versions(self, account_id):
+        return tuple(cache.get_many(self.get_version_key(),
+                                    self.get_version_key(account_id)))
+
+    def get_version_key(self, account_id=None):
+        if account_id is None:
+            return 'identity-needs-version'
+        return 'identity-needs-version-%s' % account_id
+
+    def invalidate(self, account_id=None):
+        if account_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(account_id, None)
+        # For the other processes
+        cache.set(self.get_version_key(account_id), int(time.time() * 1000))
+
+needs_cache = NeedsCache()
+
+@models_committed.connect
+def on_models_committed(sender, changes=()):
+    for model, operation in changes:
+        if isinstance(model, (Privilege, Group)):
+            # Might affect any number of accounts
+            needs_cache.invalidate()
+            return
+        elif isinstance(model, Account):
+            needs_cache.invalidate(model.id)
+
+def get_account_needs(account):
+    needs = set([TypeNeed('authenticated')])
+    # The privileges that a user has
+    for privilege in account.privileges:
+        needs.add(ActionNeed(privilege.name))
+    for group in account.groups:
+        # And for each of the groups the user belongs to
+        for privilege in group.privileges:
+            # Add the group privileges to the user
+            needs.add(RoleNeed(privilege.name))
+    return frozenset(needs)
+
 
 @principal.identity_loader
 def load_request_identity():
     log.trace("Loading request identity. Session: %s", session)
     if "uid" in session:
-        identity = Identity(session['uid'], "cookie")
+        identity = AccountIdentity(session['uid'], "cookie")
     else:
         identity = AnonymousIdentity()
         identity.account = None
@@ -83,20 +184,28 @@ def save_request_identity(identity):
 @identity_loaded.connect_via(app)
 def on_identity_loaded(sender, identity):
     log.trace("Identity loaded: %s", identity)
+    if isinstance(identity, AnonymousIdentity):
+        identity.account = None
+        return
     try:
-        identity.account = account = Account.query.get(identity.name)
-        if account:
-            account.update_last_login()
-            identity.provides.add(TypeNeed('authenticated'))
-            # Update the privileges that a user has
-            for privilege in account.privileges:
-                identity.provides.add(ActionNeed(privilege.name))
-            for group in account.groups:
-                # And for each of the groups the user belongs to
-                for privilege in group.privileges:
-                    # Add the group privileges to the user
-                    identity.provides.add(RoleNeed(privilege.name))
-            after_identity_account_loaded.send(sender, account=identity.account)
+        if not isinstance(identity, AccountIdentity):
+            # Just signed in
+            identity.account = Account.query.get(identity.name)
+            if identity.account is not None:
+                after_identity_account_loaded.send(sender,
+                                                   account=identity.account)
+        # The account is only loaded if its needs aren't cached
+        needs = needs_cache.get(
+            identity.name,
+            lambda: identity.account and get_account_needs(identity.account),
+            app.config.get('IDENTITY_CACHE_TIMEOUT')
+        )
+        if needs is None:
+            return
+        identity.provides.update(needs)
+        # Written behind, not through the account which would be updated
+        # on every request
+        last_logins.touch(identity.name)
 
     except OperationalError:
         # Database has not yet been setup
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.probes
+    ~~~~~~~~~~~~~~~
+
+    Probes of the IRC servers networks and channels are added for.
+
+    A probe connects to the server, signs on and gathers what the server
+    announces, its ``ISUPPORT`` features, MOTD and encoding, or joins a
+    channel. That takes up to tens of seconds, so the results are kept for
+    :attr:`Probes.cache_timeout` seconds, failures for
+    :attr:`Probes.failure_cache_timeout`, and probes of the same server
+    requested while one is running wait for it instead of connecting again.
+
+    The results are kept through the configured :mod:`flaskext.cache`
+    backend, shared by the processes serving the web application. With the
+    ``null`` backend they're kept on the process serving it, or on the
+    ``PROBE_CACHE_DIR`` directory for the worker processes to share them.
+
+    Probes run in the background as :class:`ProbeJob`, which the admin
+    pages poll, so requests aren't held while servers answer. The jobs are
+    kept along with the results, for any process to report on them, and a
+    server is probed by a single process at a time.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import time
+import uuid
+import errno
+import hashlib
+import logging
+import gevent
+from gevent import socket
+from gevent.event import Event
+from werkzeug.contrib.cache import SimpleCache, FileSystemCache
+from girclib import client, signals
+from chardet.universaldetector import UniversalDetector
+from ilog.common import component_manager
+from ilog.common.interfaces import ComponentBase
+from ilog.web.signals import webapp_setup_complete
+
+log = logging.getLogger(__name__)
+
+
+class ProbeTimeout(Exception):
+    """Exception raised when probing takes too long."""
+
+
+class ProbeResult(object):
+    """What was found probing `host`:`port`, or joining `channel` on it.
+
+    `error` is `None` if the probe succeeded, otherwise one of ``timeout``,
+    ``unreachable``, ``refused``, ``unknown-host``, ``disconnected``,
+    ``no-response`` or ``error``, detailed by `error_detail`.
+    """
+
+    def __init__(self, host, port, channel=None):
+        self.host = host
+        self.port = port
+        self.channel = channel
+        #: the ``ISUPPORT`` features
+        self.features = None
+        #: the network name the server announced
+        self.network = None
+        #: the MOTD, not decoded
+        self.motd = None
+        #: the encoding the server announced, or the one detected
+        self.encoding = None
+        self.error = self.error_detail = None
+        self.stamp = time.time()
+
+    def __repr__(self):
+        return '<%s %s:%s%s %s>' % (
+            self.__class__.__name__, self.host, self.port,
+            self.channel and ' ' + self.channel or '', self.error or 'ok'
+        )
+
+
+class ServerProbe(object):
+    """Connects to the IRC server `host`:`port`, signs on and gathers what
+    it announces."""
+
+    def __init__(self, host, port, timeout=30):
+        self.result = ProbeResult(host, port)
+        self.timeout = timeout
+        #: what the probe is doing, ``connecting``, ``signing-on``,
+        #: ``gathering`` or ``joining``
+        self.step = 'connecting'
+        self.chardet = UniversalDetector()
+        self.signed_on = Event()
+        self.waiting_motd = Event()
+        self.waiting_isupport = Event()
+        self.disconnected = False
+
+    def connect_signals(self):
+        signals.on_motd.connect(self.on_motd, sender=self.client)
+        signals.on_rpl_isupport.connect(self.on_rpl_isupport,
+                                        sender=self.client)
+        signals.on_signed_on.connect(self.on_signed_on, sender=self.client)
+        signals.on_disconnected.connect(self.on_disconnected,
+                                        sender=self.client)
+
+    def on_motd(self, emitter, motd=None):
+        log.trace("Received a MOTD: %s", motd)
+        self.result.motd = '\n'.join(motd)
+        self.waiting_motd.set()
+
+    def on_rpl_isupport(self, emitter, options):
+        self.result.features = options._features
+        if options.has_feature('NETWORK'):
+            self.result.network = unicode(options.get_feature('NETWORK'))
+        if options.has_feature('CHARSET'):
+            charset = options.get_feature('CHARSET')
+            if not isinstance(charset, basestring) and len(charset)==1:
+                charset = charset[0]
+            log.debug(
+                "Server has presented us with an encoding to use: %s", charset
+            )
+            self.result.encoding = charset
+        self.waiting_isupport.set()
+
+    def on_signed_on(self, emitter):
+        self.signed_on.set()
+
+    def on_disconnected(self, emitter):
+        self.disconnected = True
+        self.signed_on.set()
+        self.waiting_isupport.set()
+        self.waiting_motd.set()
+
+    def gather(self):
+        """Waits for what the server announces after signing on."""
+        self.step = 'gathering'
+        self.waiting_isupport.wait(5)
+        self.waiting_motd.wait(10)
+        if self.result.encoding is None:
+            if self.result.motd:
+                self.chardet.feed(self.result.motd)
+            self.chardet.close()
+            log.debug("Detected encoding: %s", self.chardet.result)
+            self.result.encoding = self.chardet.result.get('encoding') or \
+                                                                    'utf-8'
+
+    def run(self):
+        """Probes the server and returns the :class:`ProbeResult`."""
+        result = self.result
+        start = time.time()
+        nick = "ILog-%s" % id(self)
+        self.client = client.IRCClient(result.host, result.port, nick, nick,
+                                       nick)
+        self.connect_signals()
+        log.trace("Attempting to connect to %s:%s", result.host, result.port)
+        timeout = gevent.Timeout(self.timeout, ProbeTimeout())
+        try:
+            timeout.start()
+            self.client.connect(self.timeout)
+            self.step = 'signing-on'
+            self.signed_on.wait()           # Wait until we're signed on
+            if self.disconnected:
+                result.error = 'disconnected'
+            else:
+                self.gather()
+        except ProbeTimeout:
+            if not self.signed_on.is_set():
+                log.trace("Timeout while connecting to %s:%s", result.host,
+                          result.port)
+                result.error = 'timeout'
+        except Exception, err:
+            if not hasattr(err, 'errno'):
+                raise
+            log.trace("Error while connecting to %s:%s  %s", result.host,
+                      result.port, err)
+            if err.errno == errno.EHOSTUNREACH:
+                result.error = 'unreachable'
+            elif err.errno == errno.ECONNREFUSED:
+                result.error = 'refused'
+            elif err.errno in (socket._socket.EAI_NODATA,
+                               socket._socket.EAI_NONAME):
+                result.error = 'unknown-host'
+            else:
+                result.error = 'error'
+                result.error_detail = unicode(err)
+        finally:
+            timeout.cancel()
+            signals.on_disconnected.disconnect(self.on_disconnected,
+                                               sender=self.client)
+            try:
+                self.client.disconnect()
+            except Exception, err:
+                log.exception(err)
+            del self.client
+            log.trace("Probing %s:%s took %.2f secs", result.host,
+                      result.port, time.time() - start)
+
+        if result.error is None and not self.signed_on.is_set():
+            result.error = 'no-response'
+        return result
+
+
+class ChannelProbe(ServerProbe):
+    """Connects to the IRC server `host`:`port` and joins `channel`."""
+
+    def __init__(self, host, port, channel, timeout=30):
+        ServerProbe.__init__(self, host, port, timeout)
+        self.result.channel = channel
+
+    def on_motd(self, emitter, motd=None):
+        log.trace("Received a MOTD: %s", motd)
+
+    def on_signed_on(self, emitter):
+        self.step = 'joining'
+        signals.on_joined.connect(self.on_joined, sender=self.client)
+        self.client.join(self.result.channel)
+
+    def on_joined(self, emitter, channel):
+        log.trace("Successfully joined %s", channel)
+        self.client.leave(channel)
+        self.signed_on.set()
+
+    def gather(self):
+        pass
+
+
+class ProbeJob(object):
+    """A probe run in the background, by this process or another one. Its
+    `result` is `None` until it's done."""
+
+    def __init__(self, key, step='connecting', result=None, id=None):
+        self.id = id or uuid.uuid4().hex
+        self.key = key
+        #: what the probe is doing, ``done`` once it's over
+        self.step = result is not None and 'done' or step
+        self.result = result
+        #: the probe and the greenlet running it, on the process running it
+        self.probe = self.greenlet = None
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    @property
+    def local(self):
+        return self.greenlet is not None
+
+
+class Probes(ComponentBase):
+
+    #: seconds the results of successful probes are kept
+    cache_timeout = 600
+    #: seconds the results of failed probes are kept
+    failure_cache_timeout = 30
+    #: seconds a probe can take
+    timeout = 30
+    #: seconds between each check of the jobs run by other processes
+    poll_interval = 0.5
+
+    # ComponentBase methods
+    def activate(self):
+        #: where the results and jobs are kept, replaced by the application's
+        #: cache
+        self.store = SimpleCache()
+        #: job id -> job, of those running on this process
+        self.jobs = {}
+
+    def connect_signals(self):
+        webapp_setup_complete.connect(self.on_webapp_setup_complete)
+
+    def on_webapp_setup_complete(self, app):
+        from ilog.web.application import cache
+        if app.config.get('CACHE_TYPE', 'null') != 'null':
+            self.store = cache
+        elif app.workers > 0:
+            # Each worker would only see its own jobs
+            self.store = FileSystemCache(
+                app.config.get('PROBE_CACHE_DIR') or
+                os.path.join(app.working_directory, 'cache', 'probes')
+            )
+        self.cache_timeout = app.config.get('PROBE_CACHE_TIMEOUT',
+                                            self.cache_timeout)
+        self.failure_cache_timeout = app.config.get(
+            'PROBE_FAILURE_CACHE_TIMEOUT', self.failure_cache_timeout
+        )
+        self.timeout = app.config.get('PROBE_TIMEOUT', self.timeout)
+
+    # Probes methods
+    def submit_server(self, host, port, job_id=None):
+        """Starts probing the IRC server `host`:`port` and returns the
+        :class:`ProbeJob`. The job `job_id`, of a previous probe of that
+        server, is returned instead while it's kept."""
+        host = host.strip().lower()
+        return self.submit((host, port, None), job_id, ServerProbe, host,
+                           port)
+
+    def submit_channel(self, host, port, channel, job_id=None):
+        """Starts joining `channel` on the IRC server `host`:`port` and
+        returns the :class:`ProbeJob`. The job `job_id`, of a previous join
+        of that channel, is returned instead while it's kept."""
+        host = host.strip().lower()
+        return self.submit((host, port, channel.lower()), job_id,
+                           ChannelProbe, host, port, channel)
+
+    def probe_server(self, host, port):
+        """Returns the :class:`ProbeResult` of probing the IRC server
+        `host`:`port`, waiting for it."""
+        return self.wait(self.submit_server(host, port))
+
+    def probe_channel(self, host, port, channel):
+        """Returns the :class:`ProbeResult` of joining `channel` on the IRC
+        server `host`:`port`, waiting for it."""
+        return self.wait(self.submit_channel(host, port, channel))
+
+    def get_job(self, job_id):
+        """Returns the job `job_id`, `None` if there's none or it expired."""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        state = self.store.get(self.get_key('job', job_id))
+        if state is None:
+            return None
+        key, step, result = state
+        return ProbeJob(key, step, result, job_id)
+
+    def wait(self, job, timeout=None):
+        """Waits up to `timeout` seconds for `job` and returns its result,
+        `None` if it's still running."""
+        if job.local:
+            job.greenlet.join(timeout)
+            return job.result
+        # Run by another process, see how it's doing once in a while
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not job.done:
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                gevent.sleep(min(self.poll_interval, remaining))
+            else:
+                gevent.sleep(self.poll_interval)
+            state = self.store.get(self.get_key('job', job.id))
+            if state is None:
+                # Its process stopped before it was done
+                break
+            job.key, job.step, job.result = state
+        return job.result
+
+    def submit(self, key, job_id, probe_class, *args):
+        if job_id is not None:
+            job = self.get_job(job_id)
+            if job is not None and job.key == key:
+                return job
+
+        result = self.get_cached(key)
+        if result is not None:
+            job = ProbeJob(key, result=result)
+            self.save(job)
+            return job
+
+        running_key = self.get_key('running', key)
+        job = self.get_running(running_key)
+        if job is not None:
+            # Everyone probing the same server meanwhile gets this one
+            return job
+        job = ProbeJob(key)
+        self.save(job)
+        # Unless another process just started probing it
+        self.store.add(running_key, job.id, timeout=self.timeout * 2)
+        if self.store.get(running_key) != job.id:
+            running = self.get_running(running_key)
+            if running is not None:
+                return running
+        job.probe = probe_class(*args, timeout=self.timeout)
+        job.greenlet = gevent.spawn(self.run, job)
+        self.jobs[job.id] = job
+        return job
+
+    def get_running(self, running_key):
+        job_id = self.store.get(running_key)
+        return job_id is not None and self.get_job(job_id) or None
+
+    def run(self, job):
+        probing = gevent.spawn(job.probe.run)
+        try:
+            try:
+                while not probing.ready():
+                    probing.join(self.poll_interval)
+                    if job.probe.step != job.step and not probing.ready():
+                        # Seen by the other processes polling the job
+                        job.step = job.probe.step
+                        self.save(job)
+                result = probing.get()
+            except Exception, err:
+                log.exception(err)
+                result = job.probe.result
+                result.error = 'error'
+                result.error_detail = unicode(err)
+            job.result = result
+            job.step = 'done'
+            self.store.set(self.get_key('result', job.key), result,
+                           timeout=result.error is None and
+                                   self.cache_timeout or
+                                   self.failure_cache_timeout)
+            self.save(job)
+            self.store.delete(self.get_key('running', job.key))
+        finally:
+            probing.kill(block=False)
+            self.jobs.pop(job.id, None)
+
+    def save(self, job):
+        if job.done:
+            # Polled a while longer
+            timeout = self.cache_timeout
+        else:
+            # Forgotten soon if its process stops
+            timeout = self.timeout * 2
+        self.store.set(self.get_key('job', job.id),
+                       (job.key, job.step, job.result), timeout=timeout)
+
+    def get_cached(self, key):
+        return self.store.get(self.get_key('result', key))
+
+    def get_key(self, kind, key):
+        # Host names and channels aren't safe memcached keys
+        return 'probe-%s-%s' % (kind, hashlib.md5(repr(key)).hexdigest())
+
+probes = Probes(component_manager)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.utils.conditional
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Conditional GET support.
+
+    A view passes the data its page depends on, which it already knows or
+    gets cheaply, to :func:`not_modified`, or declares how to get it with
+    :func:`conditional`. An ``ETag`` is computed from that data along with
+    the visitor, locale, timezone and theme and, when the browser already
+    holds that version of the page, ``304 Not Modified`` is answered without
+    rendering anything. Otherwise the ``ETag`` is set on the rendered page by
+    :func:`set_conditional_headers`.
+
+    The ``ETag`` is weak, parts of the page like the footer totals are not
+    accounted for.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+import hashlib
+from functools import wraps
+from flask import current_app, g, request, session
+from flaskext.babel import get_locale, get_timezone
+from ilog import __version__
+
+# Pages might change with the templates, which only do between restarts
+_started = time.time()
+
+
+def compute_etag(validators):
+    return hashlib.md5(repr([
+        __version__, _started, session.get('uid'), str(get_locale()),
+        str(get_timezone()), current_app.config.get('THEME_NAME')
+    ] + list(validators))).hexdigest()
+
+
+def is_not_modified(etag, last_modified=None):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag.strip('"') == etag:
+                return True
+        return False
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= \
+                                                    request.if_modified_since
+    return False
+
+
+def not_modified(validators, last_modified=None):
+    """Returns a ``304 Not Modified`` response if the browser's copy of the
+    page, which depends on `validators`, is current, `None` otherwise.
+
+    `validators` is a sequence of values, anything with a stable `repr`, that
+    change whenever the page does. `last_modified` is the time the page
+    changed, if known."""
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        # Flashed messages are shown once, whatever the page
+        return None
+    etag = compute_etag(validators)
+    g.conditional = (etag, last_modified)
+    if not is_not_modified(etag, last_modified):
+        return None
+    response = current_app.response_class(status=304)
+    return set_conditional_headers(response)
+
+
+def conditional(validator):
+    """Decorator for views whose page only changes with what `validator`
+    returns when called with the view's arguments. See :func:`not_modified`.
+    The validator returning `None` means it can't tell, the view just runs.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            validators = validator(*args, **kwargs)
+            if validators is not None:
+                response = not_modified(validators)
+                if response is not None:
+                    return response
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def set_conditional_headers(response):
+    """Response hook setting the validators computed by :func:`not_modified`
+    for the current request."""
+    conditional = getattr(g, 'conditional', None)
+    if conditional is None or response.status_code not in (200, 304) or \
+                                            'ETag' in response.headers:
+        return response
+    etag, last_modified = conditional
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Always check with us before using the browser's copy
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(('Accept-Language', 'Cookie'))
+    return response
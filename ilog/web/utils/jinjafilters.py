@@ -8,7 +8,7 @@
 """
 # http://twistedmatrix.com/trac/attachment/ticket/3844/parse-irc-formatting.diff
 
-import copy
+import re
 from jinja2 import Markup, escape
 
 IRC_COLORS = {
@@ -30,175 +30,106 @@ IRC_COLORS = {
     15: "light-grey"
 }
 
-class PartAttributes(object):
-    def __init__(self, attributes=None):
-        if attributes is None:
-            attributes = set()
-        self.attributes = attributes
-        self.foreground = None
-        self.background = None
-
-    def toggle(self, attr):
-        if attr in self.attributes:
-            self.attributes.remove(attr)
-        else:
-            self.attributes.add(attr)
-
-    def copy(self):
-        return copy.deepcopy(self)
-
-    def reset_colors(self):
-        self.foreground = None
-        self.background = None
-
-    def has_colors(self):
-        return self.foreground is not None or self.background is not None
-
-    def __nonzero__(self):
-        if self.attributes:
-            return True
-        elif self.foreground is not None or self.background is not None:
-            return True
-        return False
-
-    def __repr__(self):
-        attrs = list(self.attributes)
-        if self.has_colors():
-            attrs.append('color=[%s,%s]' % (self.foreground, self.background))
-        if attrs:
-            return " attributes=(%s)" % ', '.join(attrs).rstrip()
-        return ' ' + ', '.join(attrs).rstrip()
-        return '<%s%s>' % (type(self).__name__, attrs.rstrip())
-
-class PartState(object):
-
-    formating = {
-        '\x0f': 'off',
-        '\x02': 'bold',
-        '\x03': 'color',
-        '\x1d': 'italic',
-        '\x16': 'reverse',
-        '\x1f': 'underline'
-    }
-
-    def __init__(self, strip=False):
-        self.strip = strip
-        self.state = "text"
-        self._buffer = ""
-        self._attrs = PartAttributes()
-        self._result = []
-
-
-    def complete(self):
-        self.emit()
-        return FormattedIrcMessage(self._result)
-
-    def process(self, char):
-        getattr(self, 'process_%s' % self.state)(char)
-
-    def emit(self):
-        if self.strip:
-            self._attrs = PartAttributes()
-
-        if self._buffer:
-            self._result.append(Part(self._attrs, self._buffer))
-            self._buffer = ''
-        self._attrs = self._attrs.copy()
+# Toggled attributes, as bit flags, in the order their classes are rendered
+BOLD, ITALIC, REVERSE, UNDERLINE = 1, 2, 4, 8
+
+ATTRIBUTES = (
+    (BOLD, 'bold'),
+    (ITALIC, 'italic'),
+    (REVERSE, 'reverse'),
+    (UNDERLINE, 'underline')
+)
+
+TOGGLES = {
+    u'\x02': BOLD,
+    u'\x1d': ITALIC,
+    u'\x16': REVERSE,
+    u'\x1f': UNDERLINE
+}
 
-    def process_text(self, char):
-        formatting = self.formating.get(char, None)
-        if formatting == "color":
-            self.emit()
-            self.state = "foreground"
+# A color code is "\x03" followed by up to two foreground digits, optionally
+# followed by a comma and up to two background digits. A comma right after
+# the foreground digits is always part of the code.
+_formatting_re = re.compile(
+    u'([\x02\x0f\x16\x1d\x1f])|\x03(?:([0-9]{1,2})(?:(,)([0-9]{0,2}))?)?'
+)
+
+# (foreground, background, attributes) -> opening span tag
+_span_cache = {}
+
+
+def _open_span(state):
+    tag = _span_cache.get(state)
+    if tag is None:
+        foreground, background, attributes = state
+        classes = []
+        if foreground in IRC_COLORS:
+            classes.append("irc-fg-%s" % IRC_COLORS[foreground])
+        if background in IRC_COLORS:
+            classes.append("irc-bg-%s" % IRC_COLORS[background])
+        for flag, name in ATTRIBUTES:
+            if attributes & flag:
+                classes.append("irc-%s" % name)
+        if classes:
+            tag = '<span class="%s">' % ' '.join(classes)
         else:
-            if formatting is None:
-                self._buffer += char
-            else:
-                if self._buffer:
-                    self.emit()
+            tag = '<span>'
+        _span_cache[state] = tag
+    return tag
 
-                if formatting == "off":
-                    self._attrs = PartAttributes()
-                else:
-                    self._attrs.toggle(formatting)
 
-    def process_foreground(self, char):
-        # Color codes may only be a maximum of two characters.
-        if char.isdigit() and len(self._buffer) < 2:
-            self._buffer += char
-        else:
-            if self._buffer:
-                self._attrs.foreground = int(self._buffer)
+def format_irc_message(message, strip=False):
+    """Render the IRC formatting codes in `message` as HTML, each run of text
+    between formatting codes becoming a ``<span>`` with the CSS classes of
+    the attributes in effect. When `strip` is true, the formatting codes are
+    removed and no classes are rendered.
+    """
+    output = []
+    append = output.append
+    foreground = background = None
+    attributes = 0
+    state = (None, None, 0)
+    position = 0
+    length = len(message)
+
+    for match in _formatting_re.finditer(message):
+        start, end = match.span()
+        if start > position:
+            append(_open_span(state))
+            append(escape(message[position:start]))
+            append('</span>')
+        position = end
+
+        toggle, fg_digits, comma, bg_digits = match.groups()
+        if toggle is not None:
+            if toggle == u'\x0f':
+                foreground = background = None
+                attributes = 0
             else:
-                # If there were no digits, then this has been an empty color
-                # code and we can reset the color state.
-                self._attrs.reset_colors()
-
-            if char == ',' and self._buffer:
-                # If there's a comma and it's not the first thing, move on to
-                # the background state.
-                self._buffer = ''
-                self.state = 'background'
+                attributes ^= TOGGLES[toggle]
+        elif fg_digits is None:
+            # Empty color code, reset the colors
+            foreground = background = None
+        elif end == length:
+            # The digits of a color code ending the message are kept as text
+            if comma is None:
+                position = end - len(fg_digits)
             else:
-                # Otherwise, this is a bogus color code, fall back to text.
-                self._buffer = ''
-                self.state = 'text'
-                self.emit()
-                self.process(char)
-
-    def process_background(self, char):
-        # Color codes may only be a maximum of two characters.
-        if char.isdigit() and len(self._buffer) < 2:
-            self._buffer += char
+                foreground = int(fg_digits)
+                position = end - len(bg_digits)
         else:
-            if self._buffer:
-                self._attrs.background = int(self._buffer)
-                self._buffer = ''
-
-            self.emit()
-            self.state = 'text'
-            self.process(char)
-
-class Part(object):
-    def __init__(self, attributes, text):
-        self.attributes = attributes
-        self.text = text
+            foreground = int(fg_digits)
+            if bg_digits:
+                background = int(bg_digits)
+        if not strip:
+            state = (foreground, background, attributes)
 
-    def __repr__(self):
-        return '<%s%r text="%s">' % (type(self).__name__, self.attributes, self.text)
+    if position < length:
+        append(_open_span(state))
+        append(escape(message[position:]))
+        append('</span>')
+    return Markup(u''.join(output))
 
-    def __html__(self):
-        output = '<span'
-        if self.attributes:
-            classes = []
-            if self.attributes.foreground is not None:
-                classes.append("irc-fg-%s" % IRC_COLORS[self.attributes.foreground])
-            if self.attributes.background is not None:
-                classes.append("irc-bg-%s" % IRC_COLORS[self.attributes.background])
-            for attribute in self.attributes.attributes:
-                classes.append("irc-%s" % attribute)
-            output += ' class="%s"' % ' '.join(classes)
-        return "%s>%s</span>" % (output, escape(self.text))
-
-class FormattedIrcMessage(object):
-    def __init__(self, parts):
-        self.parts = parts
-
-    def __repr__(self):
-        return '<%s %r>' % (type(self).__name__, self.parts)
-
-    def __html__(self):
-        output = ""
-        for part in self.parts:
-            output += part.__html__()
-        return output
-
-def format_irc_message(message, strip=False):
-    state = PartState(strip)
-    for char in message:
-        state.process(char)
-#    print state.complete()
-    return Markup(state.complete())
 
 if __name__ == '__main__':
     txts = [
@@ -227,7 +158,7 @@ if __name__ == '__main__':
         "\x0301BLACK\x03",
         "\x0300WHITE\x03"
     ]
-    txts = [
+    txts += [
 #        u'sakha.v-irc.ru Message of the Day -',
 u'\x0313,5*\x035 -----------------\x038__\x035--------\x038__\x035-----\x038___________\x035--\x038_____\x035---------------------\x0313*',
 #u'\x0313,5* * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * \x0313',
@@ -336,3 +267,16 @@ u'\x0313,5*\x035 -----------------\x038__\x035--------\x038__\x035-----\x038____
         print txt
         formatted = format_irc_message(txt)
         print formatted + '\n'
+
+    # Micro-benchmark, formats the sample messages over and over
+    import timeit
+    rounds = 2000
+    for strip in (False, True):
+        elapsed = timeit.timeit(
+            lambda: [format_irc_message(txt, strip) for txt in txts],
+            number=rounds
+        )
+        print "strip=%s: %d messages in %.3f secs, %.2f us/message" % (
+            strip, rounds * len(txts), elapsed,
+            elapsed / (rounds * len(txts)) * 1e6
+        )
@@ -24,7 +24,7 @@ from ilog.web.application import app, config, menus, redirect_to, redirect_back
 from ilog.web.forms import (DeleteAccountForm, LoginForm, RegisterForm,
                             ProfileForm, ExtraEmailForm, AccountEmails,
                             DeleteEmailForm, AddEmailForm)
-from ilog.web.mail import mail, Message
+from ilog.web.mail import mail, Message, HIGH_PRIORITY
 from ilog.web.permissions import authenticated_permission, admin_permission
 
 log = logging.getLogger(__name__)
@@ -247,7 +247,7 @@ def profile_extra_email():
                                account=account, activation_url=activation_url)
         message.body = body
         log.trace("Sending confirmation email.")
-        mail.send(message)
+        mail.send(message, HIGH_PRIORITY)
         log.trace("Sent confirmation email.")
         flash(_("An email has been sent to confirm the email address "
                 "%(email_address)s.", email_address=email.address))
@@ -346,7 +346,7 @@ def register():
             )
         )
         message.body = body
-        gevent.spawn_later(1, mail.send, message)
+        gevent.spawn_later(1, mail.send, message, HIGH_PRIORITY)
         flash(_("An email has been sent to confirm your email address"))
         return redirect_to('account.profile')
     return render_template('account/register.html', form=form)
@@ -438,7 +438,7 @@ def add_email():
         )
         message.body = body
         log.trace("Sending confirmation email.")
-        mail.send(message)
+        mail.send(message, HIGH_PRIORITY)
         log.trace("Sent confirmation email.")
         flash(_("An email has been sent to confirm the email address "
                 "%(email_address)s.", email_address=email.address))
@@ -509,7 +509,7 @@ def resend_activation_email(address=None):
                 "the email address", address=email.address))
 
     for message in messages:
-        gevent.spawn_later(1, mail.send, message)
+        gevent.spawn_later(1, mail.send, message, HIGH_PRIORITY)
 
     return redirect_back('account.profile')
 
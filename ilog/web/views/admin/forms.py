@@ -8,225 +8,124 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import gevent
 import logging
-import errno
-from datetime import datetime
-from gevent import socket
-from gevent.event import Event
-from girclib import client, signals
-from chardet.universaldetector import UniversalDetector
 from ilog.web.forms import FormBase, _DBBoundForm
-from flask import flash, Markup, session
+from ilog.web.probes import probes
+from flask import flash, request, Markup
 from flaskext.babel import gettext as _
 from flaskext.wtf import *
 from flaskext.wtf.html5 import *
 
 log = logging.getLogger(__name__)
 
-class ValidationTimeout(Exception):
-    pass
+def get_probe_error(result):
+    """Returns the validation error message of the failed probe `result`."""
+    host, port = result.host, result.port
+    if result.error == 'timeout':
+        return _("Timeout while establish a connection to %(host)s:%(port)s."
+                 " Are the details correct?", host=host, port=port)
+    elif result.error == 'unreachable':
+        return _("Could not establish a connection to %(host)s:%(port)s. "
+                 "Is the port number correct?", host=host, port=port)
+    elif result.error == 'refused':
+        return _("Could not establish a connection to %(host)s:%(port)s. "
+                 "Connection refused!", host=host, port=port)
+    elif result.error == 'unknown-host':
+        return _("Could not establish a connection to %(host)s:%(port)s. "
+                 "Is the host address correct?", host=host, port=port)
+    elif result.error == 'disconnected':
+        return _("We got disconnected from the server %(host)s:%(port)s.",
+                 host=host, port=port)
+    elif result.error == 'no-response':
+        return _("Could not establish a connection to %(host)s:%(port)s. "
+                 "Did not received a valid response from the IRC server.",
+                 host=host, port=port)
+    return _("Could not establish a connection to %(host)s:%(port)s. "
+             "Error returned: %(error)s", host=host, port=port,
+             error=result.error_detail)
+
 
 class Connectable(object):
-    def __init__(self, timeout=30):
-        self.timeout = timeout
-        self.chardet = UniversalDetector()
-
-    def feed_encoding_detector(self, text):
-        self.chardet.feed(text)
-        if self.chardet.done:
-            self.chardet.close()
-            self.waiting_encoding.set()
-
-    def detect_encoding(self):
-        if self.form._encoding is None:
-            self.chardet.close()
-            log.debug("Detected encoding: %s", self.chardet.result)
-            self.form.encoding.data = self.chardet.result.get('encoding', 'utf-8')
-
-    def on_disconnected(self, emitter):
-        if not self.validate_form:
-            self.failed_to_connect = _(
-                "We got disconnected from the server %(host)s:%(port)s.",
-                host=self.host, port=self.port
-            )
-        self.waiting_isupport.set()
-        self.waiting_motd.set()
-        self.validated.set()
-
-
-    def on_motd(self, emitter, motd=None):
-        log.trace("Received a MOTD: %s", motd)
-        self.form._motd = '\n'.join(motd)
-        self.waiting_motd.set()
-
-    def on_signed_on(self, emitter):
-        self.validate_form = True
-        self.validated.set()
-
-    def on_rpl_isupport(self, emitter, options):
-        self.form.isupport_options = options
-        self.waiting_isupport.set()
-        self.form.name.data = unicode(options.get_feature('NETWORK'))
-        if options.has_feature('CHARSET'):
-            charset = options.get_feature('CHARSET')
-            if not isinstance(charset, basestring) and len(charset)==1:
-                charset = charset[0]
-            self.form._encoding = charset
-            log.debug(
-                "Server has presented us with an encoding to use: %s", charset
-            )
-            self.waiting_encoding.set()
-        else:
-            self.waiting_motd.wait()
-            self.feed_encoding_detector(self.form._motd)
-
-    def on_notice(self, emitter, channel=None, user=None, message=None):
-        log.trace("Received _on_notice: %s", message)
-
-    def get_host(self):
-        return self.form.host.data
-
-    def get_port(self):
-        return self.form.port.data
-
-    def skip_connect(self):
-        if session.pop('skip-connect', ('', '')) == (self.host, self.port):
-            return True
-        db_entry = getattr(self.form, 'db_entry', None)
+    """Validates the IRC server on the form's host and port can be connected
+    to, filling the form with what the server announces.
+
+    The server is probed in the background. If that takes over `wait`
+    seconds the form is invalid meanwhile, with its `probe_job` set for the
+    page to poll it and submit the form again once it's done.
+    """
+
+    def __init__(self, wait=3):
+        self.wait = wait
+
+    def get_host(self, form):
+        return form.host.data
+
+    def get_port(self, form):
+        return form.port.data
+
+    def skip_connect(self, form, host, port):
+        db_entry = getattr(form, 'db_entry', None)
         if not db_entry:
             return False
-        return db_entry.host == self.host and db_entry.port == self.port
+        return db_entry.host == host and db_entry.port == port
 
-    def __call__(self, form, field):
-        self.validate_form = self.failed_to_connect = False
-        self.validated = Event()
-        self.waiting_motd = Event()
-        self.waiting_isupport = Event()
-        self.waiting_encoding = Event()
-        self.form = form
-        self.form.isupport_options = None
-        self.form._motd = self.form._encoding = None
-        self.host = self.get_host()
-        self.port = self.get_port()
-
-        if self.skip_connect():
-            self.on_signed_on(self)
-            return
+    def submit(self, form, host, port, job_id):
+        return probes.submit_server(host, port, job_id)
 
-        self.start = datetime.utcnow()
-        nick = "ILog-%s" % id(self)
-        self.client = client.IRCClient(self.host, self.port, nick, nick, nick)
-        signals.on_motd.connect(self.on_motd, sender=self.client)
-        signals.on_notice.connect(self.on_notice, sender=self.client)
-        signals.on_rpl_isupport.connect(self.on_rpl_isupport, sender=self.client)
-        signals.on_signed_on.connect(self.on_signed_on, sender=self.client)
-        signals.on_disconnected.connect(self.on_disconnected, sender=self.client)
-        log.trace("Attempting to connect to %s:%s", self.host, self.port)
-        timeout = gevent.Timeout(self.timeout, ValidationTimeout())
-        try:
-            timeout.start()
-            self.client.connect(self.timeout)
-            self.validated.wait()           # Wait until we're connected
-            self.waiting_isupport.wait(5)  # Wait for ISUPPORT, 10 secs
-            self.waiting_motd.wait(10)      # Wait for MOTD, 10 secs
-            self.waiting_encoding.wait(10)  # Wait encoding detection for 10 secs
-            self.detect_encoding()
-            session['skip-connect'] = (self.host, self.port)
-            signals.on_disconnected.disconnect(self.on_disconnected, sender=self.client)
-        except ValidationTimeout:
-            if not self.validate_form:
-                log.trace("Timeout while connecting to %s:%s", self.host, self.port)
-                raise ValidationError(_(
-                    "Timeout while establish a connection to %(host)s:%(port)s."
-                    " Are the details correct?", host=self.host, port=self.port)
-                )
-        except Exception, err:
-            if not hasattr(err, 'errno'):
-                raise
-            if err.errno == errno.EHOSTUNREACH:
-                log.trace("Wrong port number while connecting to %s:%s?",
-                          self.host, self.port)
-                raise ValidationError(_(
-                    "Could not establish a connection to %(host)s:%(port)s. "
-                    "Is the port number correct?", host=self.host, port=self.port)
-                )
-            elif err.errno == errno.ECONNREFUSED:
-                log.trace("Connection refused while connecting to %s:%s",
-                          self.host, self.port)
-                raise ValidationError(_(
-                    "Could not establish a connection to %(host)s:%(port)s. "
-                    "Connection refused!", host=self.host, port=self.port)
-                )
-            elif err.errno in (socket._socket.EAI_NODATA,
-                               socket._socket.EAI_NONAME):
-                log.trace("Wrong hostname while connecting to %s:%s?",
-                          self.host, self.port)
-                raise ValidationError(_(
-                    "Could not establish a connection to %(host)s:%(port)s. "
-                    "Is the host address correct?", host=self.host, port=self.port)
-                )
-
-            log.trace("Error while connecting to %s:%s  %s",
-                      self.host, self.port, err)
-            raise ValidationError(_(
-                    "Could not establish a connection to %(host)s:%(port)s. "
-                    "Error returned: %(error)s",
-                    host=self.host, port=self.port, error=err)
-                )
-
-        finally:
-            timeout.cancel()
-            from flaskext.babel import format_timedelta
-            log.trace("Connecting to server took %s",
-                      format_timedelta(self.start))
+    def apply(self, form, result):
+        form.isupport_features = result.features
+        if result.network:
+            form.name.data = result.network
+        form.encoding.data = result.encoding
+        if result.motd is not None and hasattr(form, 'motd'):
             try:
-                self.client.disconnect()
-            except Exception, err:
-                print 9999999, err
-                log.exception(err)
-            del self.client
-
-        if self.failed_to_connect:
-            raise ValidationError(self.failed_to_connect)
-        elif not self.validate_form:
-            raise ValidationError(_(
-                "Could not establish a connection to %(host)s:%(port)s. "
-                "Did not received a valid response from the IRC server.",
-                host=self.host, port=self.port)
-            )
+                form.motd.data = result.motd.decode(result.encoding,
+                                                    'replace')
+            except LookupError:
+                # Announced an encoding Python doesn't know about
+                form.motd.data = result.motd.decode('utf-8', 'replace')
 
-        self.form.motd.data = self.form._motd.decode(self.form.encoding.data)
+    def __call__(self, form, field):
+        form.isupport_features = form.probe_job = None
+        host, port = self.get_host(form), self.get_port(form)
+        if not host or not port or self.skip_connect(form, host, port):
+            return
+        # Probed once, then answered from the cache while the form is
+        # corrected and submitted again, or from the job the page waited for
+        job = self.submit(form, host, port,
+                          request.form.get('probe_job') or None)
+        result = probes.wait(job, self.wait)
+        if result is None:
+            form.probe_job = job
+            raise ValidationError(_(
+                "Still waiting for %(host)s:%(port)s to answer, the form "
+                "will be submitted again once it does.", host=host, port=port
+            ))
+        if result.error is not None:
+            raise ValidationError(get_probe_error(result))
+        self.apply(form, result)
 
 
 class Joinable(Connectable):
-    def on_motd(self, emitter, motd=None):
-        log.trace("Received a MOTD: %s", motd)
-
-    def on_signed_on(self, emitter):
-        signals.on_joined.connect(self.on_joined, sender=self.client)
-        self.client.join(self.form.name.data)
+    """Validates the channel named on the form can be joined."""
 
-    def on_joined(self, emitter, channel):
-        log.trace("Successfully joined %s", channel)
-        self.client.leave(channel)
-        self.validate_form = True
-        self.validated.set()
+    def get_host(self, form):
+        return form.network.data and form.network.data.host
 
-    def on_notice(self, emitter, channel=None, user=None, message=None):
-        log.trace("Received _on_notice: %s", message)
+    def get_port(self, form):
+        return form.network.data and form.network.data.port
 
-    def get_host(self):
-        return self.form.network.data.host
-
-    def get_port(self):
-        return self.form.network.data.port
-
-    def skip_connect(self):
-        db_entry = getattr(self.form, 'db_entry', None)
+    def skip_connect(self, form, host, port):
+        db_entry = getattr(form, 'db_entry', None)
         if not db_entry:
             return False
-        return self.form.db_entry.name == self.form.name
+        return db_entry.name == form.name.data
+
+    def submit(self, form, host, port, job_id):
+        return probes.submit_channel(host, port, form.name.data, job_id)
+
+    def apply(self, form, result):
+        pass
 
 
 # Network related forms
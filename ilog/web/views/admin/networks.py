@@ -9,7 +9,7 @@
 """
 
 
-from flask import Blueprint, request, url_for, render_template, flash, g, session
+from flask import Blueprint, request, url_for, render_template, flash, g
 from flaskext.babel import gettext as _
 from ilog.common import convert
 from ilog.database import dbm
@@ -71,8 +71,6 @@ def index(page=1):
 @networks.route('/add', methods=("GET", "POST"))
 @require_permissions((admin_permission, manager_permission), http_exception=403)
 def add():
-    if not request.values:
-        session.pop('skip-connect', None)
     form = AddNetwork(formdata=request.values.copy())
     if form.validate_on_submit():
         network = Network(
@@ -81,8 +79,8 @@ def add():
             port=form.data.get('port')
         )
 
-        if form.isupport_options is not None:
-            network.features = form.isupport_options._features
+        if form.isupport_features is not None:
+            network.features = form.isupport_features
 
         if form.data.get('motd', None) is not None:
             network.motd = NetworkMotd(form.data.get('motd'))
@@ -101,7 +99,6 @@ def add():
         network.created_by = account
         dbm.session.add(network)
         dbm.session.commit()
-        session.pop('skip-connect', None)
         flash(_("Network \"%(name)s\" added.", name=network.name))
         return redirect_to("admin.networks.edit", slug=network.slug)
 
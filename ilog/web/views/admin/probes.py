@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.views.admin.probes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Background IRC server probes, submitted and polled by the add network
+    and add channel pages.
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+from flask import Blueprint, request, url_for, jsonify, abort
+from ilog.database.models import Network
+from ilog.web.permissions import (admin_permission, manager_permission,
+                                  require_permissions)
+from ilog.web.probes import probes as prober
+from ilog.web.views.admin.forms import get_probe_error
+
+probes = Blueprint("admin.probes", __name__, url_prefix="/admin/probes")
+
+#: most seconds a status request waits for the job to finish
+MAX_WAIT = 25
+
+
+def job_status(job):
+    status = {
+        'id': job.id,
+        'step': job.step,
+        'done': job.done,
+        'url': url_for('admin.probes.status', job_id=job.id)
+    }
+    if job.done:
+        result = job.result
+        status.update(
+            ok=result.error is None,
+            error=result.error and get_probe_error(result),
+            network=result.network,
+            encoding=result.encoding
+        )
+    return jsonify(job=status)
+
+
+@probes.route('/server', methods=("POST",))
+@require_permissions((admin_permission, manager_permission), http_exception=403)
+def server():
+    host = request.form.get('host', '').strip()
+    port = request.form.get('port', type=int)
+    if not host or not port:
+        abort(400)
+    return job_status(prober.submit_server(host, port))
+
+
+@probes.route('/channel', methods=("POST",))
+@require_permissions((admin_permission, manager_permission), http_exception=403)
+def channel():
+    network_id = request.form.get('network', type=int)
+    network = network_id and Network.query.get(network_id)
+    name = request.form.get('name', '').strip()
+    if not network or not name:
+        abort(400)
+    return job_status(prober.submit_channel(network.host, network.port, name))
+
+
+@probes.route('/<job_id>')
+@require_permissions((admin_permission, manager_permission), http_exception=403)
+def status(job_id):
+    job = prober.get_job(job_id)
+    if job is None:
+        abort(404)
+    # Long polling, answered as soon as the job is done
+    wait = min(request.args.get('wait', 0, type=float), MAX_WAIT)
+    if wait > 0:
+        prober.wait(job, wait)
+    return job_status(job)
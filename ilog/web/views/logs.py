@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.views.logs
+    ~~~~~~~~~~~~~~~~~~~
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from datetime import datetime
+from itertools import groupby
+from flask import Blueprint, abort, render_template
+from ilog.database.days import day_index
+from ilog.database.models import Channel, Network
+from ilog.web.pagecache import page_cache
+from ilog.web.utils.conditional import not_modified
+
+log = logging.getLogger(__name__)
+
+logs = Blueprint('logs', __name__)
+
+
+def get_network_channel(network_slug, channel_slug):
+    network = Network.query.get(network_slug)
+    if network is None:
+        abort(404)
+    channel = Channel.query.get(channel_slug)
+    if channel is None or channel.network_id != network.id:
+        abort(404)
+    return network, channel
+
+
+@logs.route('/<network>/<channel>/')
+def archive(network, channel):
+    network, channel = get_network_channel(network, channel)
+    response = not_modified([network.name, channel.prefixed_name,
+                             tuple(day_index.get_summary(channel.id))])
+    if response is not None:
+        return response
+
+    months = [
+        (month, list(days)) for month, days in groupby(
+            day_index.get_days(channel.id),
+            key=lambda entry: entry.day.replace(day=1)
+        )
+    ]
+    return render_template('logs/archive.html', network=network,
+                           channel=channel, months=months)
+
+
+@logs.route('/<network>/<channel>/<day>')
+def day(network, channel, day):
+    try:
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+    except ValueError:
+        abort(404)
+
+    network, channel = get_network_channel(network, channel)
+    entry = day_index.get_day(channel.id, day)
+    previous, following = day_index.get_neighbours(channel.id, day)
+    response = not_modified([
+        network.name, channel.prefixed_name, day, previous, following,
+        entry is not None and (entry.last_id, entry.count) or None
+    ])
+    if response is not None:
+        return response
+
+    cacheable = page_cache.cacheable(network.slug, channel.slug, day)
+    if entry is None or not cacheable:
+        if cacheable:
+            # Nothing logged, or no longer, discards what might be stored
+            page_cache.get(network.slug, channel.slug, day, None)
+        events = entry is not None and day_index.get_events(entry) or []
+        return render_template('logs/day.html', network=network,
+                               channel=channel, day=day, events=events,
+                               previous=previous, following=following)
+
+    # The neighbouring days and the totals change after the day is over,
+    # they're filled on the stored page on each request
+    from ilog.web.application import get_total_events
+    version = '%s-%s' % (entry.last_id, entry.count)
+    page = page_cache.get(network.slug, channel.slug, day, version)
+    if page is None:
+        page = render_template('logs/day.html', network=network,
+                               channel=channel, day=day,
+                               events=day_index.get_events(entry),
+                               **page_cache.get_placeholders(
+                                   'day_links', 'total_events_logged',
+                                   'total_channels_logged',
+                                   'total_networks_logged'))
+        page = page_cache.set(network.slug, channel.slug, day, version, page)
+    day_links = render_template('logs/_day_links.html', network=network,
+                                channel=channel, previous=previous,
+                                following=following)
+    return page_cache.fill(page, day_links=day_links, **get_total_events())
@@ -13,7 +13,8 @@ from operator import itemgetter
 from flask import Blueprint, render_template, request
 from flaskext.babel import gettext as _
 from ilog.database import dbm
-from ilog.web.application import app, url_for, menus
+from ilog.web.application import app, url_for, menus, get_total_events
+from ilog.web.utils.conditional import conditional
 
 log = logging.getLogger(__name__)
 
@@ -30,12 +31,18 @@ menus.add_menu_entry(
     visiblewhen=lambda mi: request.blueprint=='main'
 )
 
+def get_totals():
+    # The totals are on the header of every page
+    return sorted(get_total_events().items())
+
 @main.route('/')
+@conditional(get_totals)
 def index():
     return render_template('index.html')
 
 
 @main.route('/libraries')
+@conditional(get_totals)
 def libraries():
     libraries_used = [
         ("http://flask.pocoo.org/", "Flask"),
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.views.search
+    ~~~~~~~~~~~~~~~~~~~~~
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from datetime import datetime, timedelta
+from flask import Blueprint, render_template, request, flash
+from flaskext.babel import gettext as _
+from ilog.database.models import Channel
+from ilog.database.search import search_index
+from ilog.web.application import menus
+
+log = logging.getLogger(__name__)
+
+search = Blueprint('search', __name__, url_prefix='/search')
+
+menus.add_menu_entry(
+    'nav', _("Search"), 'search.index', priority=-90,
+    activewhen=lambda mi: request.blueprint=='search'
+)
+
+
+def parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        flash(_("Invalid date \"%(date)s\". Use YYYY-MM-DD.", date=value),
+              "error")
+        return None
+
+
+def parse_cursor(value):
+    """Parses the cursor of a results page, ``<rank>:<id>``."""
+    try:
+        rank, row_id = value.split(':')
+        return int(rank), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_cursor(cursor):
+    return '%d:%d' % cursor
+
+
+@search.route('/')
+def index():
+    terms = request.args.get('q', u'').strip()
+    slug = request.args.get('channel', u'').strip()
+    nick = request.args.get('nick', u'').strip()
+    since = parse_date(request.args.get('since'))
+    until = parse_date(request.args.get('until'))
+    if until is not None:
+        # Include the whole "until" day
+        until += timedelta(days=1)
+    cursor = parse_cursor(request.args.get('after'))
+
+    channel = results = None
+    channels = {}
+    if slug:
+        channel = Channel.query.get(slug)
+        if channel is None:
+            flash(_("Channel \"%(slug)s\" not found.", slug=slug), "error")
+
+    if terms and not search_index.enabled:
+        flash(_("Search is not available."), "error")
+    elif terms and (channel is not None or not slug):
+        results = search_index.search(
+            terms, channel_id=channel and channel.id or None, nick=nick,
+            since=since, until=until, cursor=cursor
+        )
+        channel_ids = set(item.channel_id for item in results.items)
+        if channel_ids:
+            channels = dict(
+                (c.id, c) for c in
+                Channel.query.filter(Channel.id.in_(channel_ids)).all()
+            )
+
+    return render_template('search/index.html', terms=terms, slug=slug,
+                           nick=nick, since=request.args.get('since', ''),
+                           until=request.args.get('until', ''),
+                           results=results, channels=channels,
+                           format_cursor=format_cursor)
@@ -37,7 +37,9 @@ setup(name=ilog.__package_name__,
         "Flask-Mail>=0.6.1",
         "Flask-Principal>=0.2.1",
         "Flask-WTF>=0.5.2",
+        "gevent>=1.0",
         "pyzmq>=2.1.0,==2.1.0dev",
+        "gevent-zeromq",
         "procname",
         "psi"
       ],
@@ -62,14 +64,18 @@ setup(name=ilog.__package_name__,
       %s = ilog.irc.daemon:start_daemon
       %s  = ilog.irc.daemon:start_bot
       %s  = ilog.web.daemon:start_daemon
+      %s  = ilog.irc.daemon:start_broker
+      %s  = ilog.irc.daemon:start_render
 
       [distutils.commands]
       compile = babel.messages.frontend:compile_catalog
       extract = babel.messages.frontend:extract_messages
          init = babel.messages.frontend:init_catalog
        update = babel.messages.frontend:update_catalog
+      compress_static = ilog.web.compress:compress_static
       """ % (
-        ilog.__core_bin_name__, ilog.__bot_bin_name__, ilog.__web_bin_name__
+        ilog.__core_bin_name__, ilog.__bot_bin_name__, ilog.__web_bin_name__,
+        ilog.__broker_bin_name__, ilog.__render_bin_name__
       ),
       classifiers=[
           'Development Status :: 3 - Alpha',
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_probes
+    ~~~~~~~~~~~~~~~~~
+
+    Tests of the IRC server probes against a local fake IRC server::
+
+        python tests/test_probes.py
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+import unittest
+from gevent import socket
+from gevent.server import StreamServer
+from ilog.web import probes as probes_module
+from ilog.web.probes import probes
+
+if not hasattr(probes_module.log, 'trace'):
+    # The trace level is added to the loggers by the daemons
+    probes_module.log.trace = lambda *args, **kwargs: None
+
+
+class FakeIRCServer(StreamServer):
+    """Signs clients on, announcing the FakeNet network, and lets them join
+    channels, answering each command after `latency` seconds."""
+
+    def __init__(self, latency=0.2):
+        StreamServer.__init__(self, ('127.0.0.1', 0), self.handle)
+        self.latency = latency
+        #: number of connections handled
+        self.connections = 0
+
+    def handle(self, sock, address):
+        self.connections += 1
+        fileobj = sock.makefile()
+        server, nick = ':fake.server', '*'
+        def send(*lines):
+            sock.sendall(''.join(line + '\r\n' for line in lines))
+        while True:
+            line = fileobj.readline()
+            if not line:
+                break
+            parts = line.rstrip('\r\n').split(' ')
+            command = parts[0].upper()
+            gevent.sleep(self.latency)
+            if command == 'NICK':
+                nick = parts[1]
+            elif command == 'USER':
+                send('%s 001 %s :Welcome to the fake network' % (server, nick),
+                     '%s 005 %s NETWORK=FakeNet CHARSET=utf-8 :are supported '
+                     'by this server' % (server, nick),
+                     '%s 375 %s :- fake.server Message of the day -' %
+                                                            (server, nick),
+                     '%s 372 %s :- Nothing to see here' % (server, nick),
+                     '%s 376 %s :End of /MOTD command.' % (server, nick))
+            elif command == 'JOIN':
+                channel = parts[1].lstrip(':')
+                send(':%s!%s@localhost JOIN :%s' % (nick, nick, channel),
+                     '%s 366 %s %s :End of /NAMES list.' % (server, nick,
+                                                            channel))
+            elif command == 'PART':
+                send(':%s!%s@localhost PART %s' % (nick, nick, parts[1]))
+            elif command == 'PING':
+                send('%s PONG %s' % (server, ' '.join(parts[1:])))
+            elif command == 'QUIT':
+                send('ERROR :Closing link')
+                break
+        sock.close()
+
+
+class ProbesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Forgets the results and jobs of the previous tests
+        probes.activate()
+        self.server = FakeIRCServer()
+        self.server.start()
+        self.host, self.port = '127.0.0.1', self.server.server_port
+
+    def tearDown(self):
+        self.server.stop()
+
+    def forget_local_jobs(self):
+        # What another process serving the web application sees
+        probes.jobs.clear()
+
+    def test_probe_server(self):
+        job = probes.submit_server(self.host, self.port)
+        self.assertFalse(job.done)
+        result = probes.wait(job, 10)
+        self.assertEqual(job.step, 'done')
+        self.assertEqual(result.error, None)
+        self.assertEqual(result.network, u'FakeNet')
+        self.assertEqual(result.encoding, 'utf-8')
+        self.assertTrue('Nothing to see here' in result.motd)
+
+    def test_probe_channel(self):
+        result = probes.probe_channel(self.host, self.port, '#ilog')
+        self.assertEqual(result.error, None)
+        self.assertEqual(result.channel, '#ilog')
+
+    def test_probed_once_at_a_time(self):
+        jobs = [probes.submit_server(self.host, self.port) for idx in range(3)]
+        self.assertEqual(len(set(job.id for job in jobs)), 1)
+        probes.wait(jobs[0], 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_answered_from_the_cache(self):
+        probes.probe_server(self.host, self.port)
+        job = probes.submit_server(self.host.upper(), self.port)
+        self.assertTrue(job.done)
+        self.assertEqual(job.result.network, u'FakeNet')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_polled_from_another_process(self):
+        job = probes.submit_server(self.host, self.port)
+        self.forget_local_jobs()
+        remote = probes.get_job(job.id)
+        self.assertFalse(remote.local)
+        self.assertFalse(remote.done)
+        # Not probed again while it's running elsewhere
+        self.assertEqual(probes.submit_server(self.host, self.port).id, job.id)
+        result = probes.wait(remote, 10)
+        self.assertEqual(result.network, u'FakeNet')
+        self.assertEqual(remote.step, 'done')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_resubmitted_with_job(self):
+        job = probes.submit_server(self.host, self.port)
+        probes.wait(job, 10)
+        self.forget_local_jobs()
+        self.assertEqual(
+            probes.submit_server(self.host, self.port, job.id).id, job.id
+        )
+        # A job of another probe isn't reused
+        self.assertNotEqual(
+            probes.submit_channel(self.host, self.port, '#ilog', job.id).id,
+            job.id
+        )
+
+    def test_unknown_job(self):
+        self.assertEqual(probes.get_job('unknown'), None)
+
+    def test_wait_timeout(self):
+        self.server.latency = 1
+        job = probes.submit_server(self.host, self.port)
+        self.assertEqual(probes.wait(job, 0.1), None)
+        self.forget_local_jobs()
+        self.assertEqual(probes.wait(probes.get_job(job.id), 0.1), None)
+
+    def test_refused(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        try:
+            result = probes.probe_server('127.0.0.1', port)
+        finally:
+            closed.close()
+        self.assertEqual(result.error, 'refused')
+
+
+if __name__ == '__main__':
+    unittest.main()